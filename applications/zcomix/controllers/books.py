@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 
-from gluon.contrib import user_agent_parser
+from gluon.contrib.simplejson import dumps
+from applications.zcomix.modules.archives import ArchiveDownloader
+from applications.zcomix.modules.events import log_event
 from applications.zcomix.modules.books import \
+        book_manifest, \
         cover_image, \
+        manifest_version, \
         read_link
+from applications.zcomix.modules.caching import \
+        CACHE_SECONDS, \
+        cached_page
+from applications.zcomix.modules.images import \
+        CACHE_CONTROL, \
+        image_metadata
 from applications.zcomix.modules.links import CustomLinks
 from applications.zcomix.modules.stickon.sqlhtml import LocalSQLFORM
 
 
+@cached_page('book')
 def book():
     """Book page controller
 
@@ -53,12 +64,58 @@ def book():
     )
 
 
+def download():
+    """Download a book as a cbz archive.
+
+    request.args(0): id of book
+    """
+    return ArchiveDownloader().download(request, db)
+
+
 def index():
     """Books grid."""
     # This is no longer used
     redirect(URL(c='default', f='index'))
 
 
+def manifest():
+    """Reader manifest of a book, json. See modules/books.py book_manifest()
+
+    request.args(0): id of book
+    request.vars.v: string, version of the manifest, optional. A versioned
+        manifest never changes so it is cached by clients indefinitely.
+    """
+    session.forget(response)
+
+    book_record = None
+    if request.args(0):
+        book_record = db(db.book.id == request.args(0)).select(
+                db.book.id, db.book.updated_on).first()
+    if not book_record:
+        raise HTTP(404)
+
+    version = manifest_version(db, book_record)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['ETag'] = '"{v}"'.format(v=version)
+    response.headers['Cache-Control'] = CACHE_CONTROL \
+        if request.vars.v == version else 'public, max-age=0, must-revalidate'
+    if request.env.http_if_none_match == response.headers['ETag']:
+        raise HTTP(
+            304,
+            **{
+                'Cache-Control': response.headers['Cache-Control'],
+                'ETag': response.headers['ETag'],
+            }
+        )
+
+    # The version is part of the key, a new version is a new entry.
+    return cache.ram(
+        'manifest:{i}:{v}'.format(i=book_record.id, v=version),
+        lambda: dumps(book_manifest(db, book_record, version=version)),
+        time_expire=CACHE_SECONDS,
+    )
+
+
 def reader():
     """Read a book.
 
@@ -88,28 +145,47 @@ def reader():
     if response.view not in views:
         response.view = 'books/slider.html'
 
-    page_images = db(db.book_page.book_id == request.args(0)).select(
-            db.book_page.image
-            )
+    if request.vars.page is None:
+        # Count opening the book as a view, not every page turned.
+        log_event('view', book_record.id, auth_user_id=auth.user_id or 0)
+
+    # The slider and scroller load pages as they are read, from the
+    # manifest. Other views display every page.
+    lazy_views = ['books/scroller.html', 'books/slider.html']
+    page_images = []
+    metadata = {}
+    if response.view not in lazy_views:
+        page_images = db(db.book_page.book_id == request.args(0)).select(
+                db.book_page.image,
+                orderby=[db.book_page.page_no, db.book_page.id],
+                )
+        metadata = image_metadata(
+                db, [x.image for x in page_images if x.image])
+    page_count = db(db.book_page.book_id == request.args(0)).count()
     try:
         current_page = int(request.vars.page)
     except (TypeError, ValueError):
         current_page = 0
-    next_page = current_page + 1 if current_page + 1 < len(page_images) else 0
-    prev_page = current_page - 1 if current_page - 1 >= 0 else len(page_images) - 1
-
-    ua = user_agent_parser.detect(request.env.http_user_agent)
-    size = 'medium' if ua['is_mobile'] else 'original'
+    next_page = current_page + 1 if current_page + 1 < page_count else 0
+    prev_page = current_page - 1 if current_page - 1 >= 0 else page_count - 1
 
     return dict(
             auth_user=auth_user,
             book=book_record,
             creator=creator_record,
+            manifest_url=URL(
+                c='books',
+                f='manifest',
+                args=book_record.id,
+                vars={'v': manifest_version(db, book_record)},
+                extension=False,
+                ),
+            metadata=metadata,
             pages=page_images,
+            page_count=page_count,
             current_page=current_page,
             next_page=next_page,
             prev_page=prev_page,
-            size=size,
             )
 
 
@@ -4,6 +4,7 @@ Controllers for contributions.
 """
 
 from applications.zcomix.modules.books import default_contribute_amount
+from applications.zcomix.modules.events import log_event
 from applications.zcomix.modules.stickon.sqlhtml import LocalSQLFORM
 
 
@@ -67,12 +68,15 @@ def record():
 
     """
     if request.args(0) and request.vars.amount:
-        db.contribution.insert(
-            auth_user_id=auth.user_id or 0,
-            book_id=request.args(0),
-            time_stamp=request.now,
-            amount=request.vars.amount,
-            )
-        db.commit()
+        try:
+            log_event(
+                'contribution',
+                request.args(0),
+                auth_user_id=auth.user_id or 0,
+                amount=request.vars.amount,
+                )
+        except ValueError:
+            # Invalid book id or amount, the contribution is not recorded.
+            pass
 
     redirect(URL('paypal', args=request.args, vars=request.vars))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Creator controller functions"""
 
+from applications.zcomix.modules.caching import cached_page
 from applications.zcomix.modules.links import CustomLinks
 from applications.zcomix.modules.stickon.sqlhtml import LocalSQLFORM
 
@@ -12,6 +13,7 @@ def books():
     return dict()
 
 
+@cached_page('creator')
 def creator():
     """Creator page
     request.args(0): integer, id of creator.
@@ -7,10 +7,13 @@ from applications.zcomix.modules.books import \
     book_pages_as_json, \
     book_page_for_json, \
     read_link
+from applications.zcomix.modules.caching import \
+    invalidate_book, \
+    invalidate_creator
+from applications.zcomix.modules.fulltext import fulltext_index
 from applications.zcomix.modules.images import \
-    UploadImage, \
     img_tag, \
-    set_thumb_dimensions
+    queue_resize
 from applications.zcomix.modules.links import \
     CustomLinks, \
     ReorderLink
@@ -66,8 +69,15 @@ def book_edit():
         URL('static', 'js/book_edit.js')
     )
 
+    def onaccept(form):
+        """Callback for onaccept."""
+        fulltext_index(db).index_book(form.vars.id)
+        invalidate_book(form.vars.id)
+
     crud.settings.update_deletable = False
     crud.settings.formstyle = formstyle_bootstrap3_custom
+    crud.settings.create_onaccept = [onaccept]
+    crud.settings.update_onaccept = [onaccept]
     if request.args(0):
         # Reload page to prevent consecutive self-submit warnings
         crud.settings.update_next = URL('book_edit', args=request.args)
@@ -113,11 +123,17 @@ def book_link_edit():
             order_no=order_no,
         )
         db.commit()
+        invalidate_book(book_record.id)
+
+    def onupdate(form):
+        """Callback for onupdate."""
+        invalidate_book(book_record.id)
 
     crud.settings.update_deletable = False
     crud.settings.formstyle = formstyle_bootstrap3_custom
     if request.args(1):
         crud.settings.update_next = URL('book_links', args=request.args(0))
+        crud.settings.update_onaccept = [onupdate]
         form = crud.update(db.link, request.args(1))
     else:
         crud.settings.create_next = URL('book_links', args=request.args(0))
@@ -248,16 +264,18 @@ def book_pages_handler():
                 book_id=book_record.id,
                 page_no=page_no,
                 image=stored_filename,
+                image_filename=file.filename,
                 thumb_shrink=1,
             )
             db.commit()
-            resizer = UploadImage(db.book_page.image, stored_filename)
-            resizer.resize_all()
-            set_thumb_dimensions(db, page_id, resizer.dimensions(size='thumb'))
+            # Sizes are created by a background job. Until then the
+            # page is flagged as processing and the original is served.
+            queue_resize(db.book_page.image, stored_filename, record_id=page_id)
             book_page_ids.append(page_id)
         # Make sure page_no values are sequential
         reorder_query = (db.book_page.book_id == book_record.id)
         reorder(db.book_page.page_no, query=reorder_query)
+        invalidate_book(book_record.id)
         return book_pages_as_json(db, book_record.id, book_page_ids=book_page_ids)
     elif request.env.request_method == 'DELETE':
         do_error('Upload unavailable')
@@ -268,12 +286,14 @@ def book_pages_handler():
             book_page.image,
             nameonly=True,
         )
-        resizer = UploadImage(db.book_page.image, book_page.image)
-        resizer.delete_all()
+        filename = book_page.image_filename or filename
+        # The image files may be shared, they are deleted by
+        # resize_images.py --purge, see store_image().
         book_page.delete_record()
         # Make sure page_no values are sequential
         reorder_query = (db.book_page.book_id == book_record.id)
         reorder(db.book_page.page_no, query=reorder_query)
+        invalidate_book(book_record.id)
         return dumps({"files": [{filename: 'true'}]})
     else:
         # GET
@@ -322,6 +342,7 @@ def book_pages_reorder():
         direction=direction,
         query=(db.book_page.book_id == book_record.id),
     )
+    invalidate_book(book_record.id)
     return dumps({'success': True})
 
 
@@ -371,6 +392,7 @@ def book_release():
             release_date=datetime.datetime.today()
         )
         db.commit()
+        invalidate_book(book_record.id)
         # FIXME create torrent
         # FIXME add book to creator torrent
         # FIXME add book to ALL torrent
@@ -422,18 +444,17 @@ def creator():
     if not creator_record:
         redirect(URL('index'))
 
-    def custom_delete(oldname):
-        resizer = UploadImage(db.creator.image, oldname)
-        resizer.delete_all()
-
     def onupdate(form):
         """On update callback function"""
         if form.vars.image:
-            resizer = UploadImage(db.creator.image, form.vars.image)
-            resizer.resize_all()
-
-    # custom_delete is not defined in the model to keep the model lean.
-    db.creator.image.custom_delete = custom_delete
+            # The stored name is a hash, keep the uploaded filename.
+            image_filename = getattr(request.vars.image, 'filename', None)
+            if image_filename:
+                db(db.creator.id == form.vars.id).update(
+                    image_filename=image_filename)
+            queue_resize(db.creator.image, form.vars.image, record_id=form.vars.id)
+        fulltext_index(db).index_creator(creator_record.id)
+        invalidate_creator(creator_record.id)
 
     crud.settings.update_onaccept = [onupdate]
     # Reload page to prevent consecutive self-submit warnings
@@ -468,11 +489,17 @@ def creator_link_edit():
             order_no=order_no,
         )
         db.commit()
+        invalidate_creator(creator_record.id)
+
+    def onupdate(form):
+        """Callback for onupdate."""
+        invalidate_creator(creator_record.id)
 
     crud.settings.update_deletable = False
     crud.settings.formstyle = formstyle_bootstrap3_custom
     if request.args(0):
         crud.settings.update_next = URL('creator_links')
+        crud.settings.update_onaccept = [onupdate]
         form = crud.update(db.link, request.args(0))
     else:
         crud.settings.create_next = URL('creator_links')
@@ -585,6 +612,7 @@ def links():
                 order_no=order_no,
             )
             db.commit()
+            invalidate_book(book_record.id)
         else:
             order_no = db(db.creator_to_link.creator_id == creator_record.id).count() + 1
             db.creator_to_link.insert(
@@ -593,6 +621,7 @@ def links():
                 order_no=order_no,
             )
             db.commit()
+            invalidate_creator(creator_record.id)
 
     def ondelete(table, record_id):
         """Callback for ondelete."""
@@ -612,6 +641,10 @@ def links():
         db(to_link_table.link_id == record_id).delete()
         db.commit()
         links.reorder()
+        if book_record:
+            invalidate_book(book_record.id)
+        else:
+            invalidate_creator(creator_record.id)
 
     def row_link_id(row):
         return row.link.id if 'link' in row else 0
@@ -706,6 +739,10 @@ def order_no_handler():
     custom_links_id = record[filter_field]
     links = CustomLinks(custom_links_table, custom_links_id)
     links.move_link(request.args(1), request.args(2))
+    if request.args(0) == 'book_to_link':
+        invalidate_book(custom_links_id)
+    else:
+        invalidate_creator(custom_links_id)
 
     redirect(next_url, client_side=False)
 
@@ -797,6 +834,7 @@ def link_crud():
             db.creator_to_link.order_no,
             query=reorder_query,
         )
+        invalidate_creator(creator_record.id)
     return {
         'id': record_id,
         'rows': rows,
@@ -3,7 +3,9 @@
 
 import re
 import uuid
-from BeautifulSoup import BeautifulSoup
+from applications.zcomix.modules.caching import \
+    SEARCH_CACHE_SECONDS, \
+    cached_page
 from applications.zcomix.modules.links import CustomLinks
 from applications.zcomix.modules.search import Search
 from applications.zcomix.modules.stickon.sqlhtml import LocalSQLFORM
@@ -14,23 +16,30 @@ def box():
     return dict()
 
 
+@cached_page(
+    'search',
+    var_names=['after', 'creator_id', 'kw', 'o', 'period', 'released', 'view'],
+    time_expire=SEARCH_CACHE_SECONDS,
+)
 def cover_grid():
     """Search results cover grid.
 
     request.vars.o: string, orderby field, one of:
             'views' (default), 'newest', 'rating', 'contributions'
+    request.vars.after: string, cursor of the page, see Search.set()
     """
     search = Search()
-    search.set(db, request)
+    if not search.set_ranked(db, request):
+        search.set_rows(db, request)
+    search.set_cover_images(db, size='thumb')
 
-    # extract the paginator from the grid
-    soup = BeautifulSoup(str(search.grid))
-    paginator = soup.find('div', {'class': 'web2py_paginator grid_header '})
     return dict(
-            grid=search.grid,
+            cover_images=search.cover_images,
             items_per_page=search.paginate,
             orderby_field=search.orderby_field,
-            paginator=paginator,
+            paginator=search.paginator(request),
+            rows=search.rows,
+            start=search.start,
             )
 
 
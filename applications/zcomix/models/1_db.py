@@ -12,18 +12,8 @@
 # E0601: *Using variable %%r before assignment*
 # pylint: disable=E0601
 
-if not request.env.web2py_runtime_gae:
-    ## if NOT running on Google App Engine use SQLite or other DB
-    db = DAL('sqlite://storage.sqlite',pool_size=1,check_reserved=['all'])
-else:
-    ## connect to Google BigTable (optional 'google:datastore://namespace')
-    db = DAL('google:datastore')
-    ## store sessions and tickets there
-    session.connect(request, response, db=db)
-    ## or store session in Memcache, Redis, etc.
-    ## from gluon.contrib.memdb import MEMDB
-    ## from google.appengine.api.memcache import Client
-    ## session.connect(request, response, db = MEMDB(Client()))
+## The database connection, pooled, is opened by ModelDb. See
+## modules/stickon/tools.py
 
 ## by default give a view/generic.extension to all actions from localhost
 ## none otherwise. a pattern can be 'controller/function.extension'
@@ -40,9 +30,17 @@ from gluon import *
 from gluon.storage import Storage
 from gluon.tools import PluginManager
 from applications.zcomix.modules.stickon.tools import ModelDb
+from applications.zcomix.modules.caching import invalidate_profile
 from applications.zcomix.modules.creators import add_creator
+from applications.zcomix.modules.fulltext import index_profile
+from applications.zcomix.modules.images import \
+    set_image_ladder, \
+    store_image
 from applications.zcomix.modules.stickon.sqlhtml import formstyle_bootstrap3_custom
 
+# Controllers with forms requiring the IS_IN_DB validators below.
+VALIDATOR_CONTROLLERS = ['appadmin', 'contributions', 'profile']
+
 model_db = ModelDb(globals())
 db = model_db.db
 auth = model_db.auth
@@ -52,6 +50,11 @@ mail = model_db.mail
 local_settings = model_db.local_settings
 plugins = PluginManager()
 
+set_image_ladder(
+    widths=local_settings.image_widths,
+    encodings=local_settings.image_encodings,
+)
+
 ## create all tables needed by auth if not custom tables
 auth.define_tables(username=False, signature=False)
 
@@ -66,6 +69,10 @@ auth.settings.registration_requires_verification = True
 auth.settings.registration_requires_approval = False
 auth.settings.reset_password_requires_verification = True
 auth.settings.login_onaccept = lambda f: add_creator(f)
+auth.settings.profile_onaccept = [
+    lambda f: index_profile(f),
+    lambda f: invalidate_profile(f),
+]
 auth.settings.login_next = URL(c='profile', f='index')
 auth.settings.logout_next = URL('index')
 
@@ -126,6 +133,7 @@ db.define_table('book',
         'integer',
         writable=False,
         readable=False,
+        index=True,
     ),
     Field(
         'description',
@@ -201,10 +209,20 @@ db.define_table('book_page',
     Field(
         'image',
         'upload',
-        autodelete=True,
+        # Stored images are shared, see store_image(). They are deleted by
+        # private/bin/resize_images.py --purge once no record references
+        # them.
+        autodelete=False,
         requires = IS_IMAGE(),
         uploadfolder=os.path.join(request.folder, 'uploads', 'original'),
         uploadseparate=True,
+        custom_store=lambda f, n, p: store_image(db.book_page.image, f, n),
+        index=True,
+    ),
+    Field(
+        'image_filename',
+        writable=False,
+        readable=False,
     ),
     Field(
         'thumb_w',
@@ -222,11 +240,38 @@ db.define_table('book_page',
         default=1,
     ),
     format='%(page_no)s',
+    indexes={'book_page_book_id_page_no_idx': ['book_id', 'page_no']},
     migrate=True,
 )
 
-db.define_table('book_to_link',
+db.define_table('book_ranking',
+    Field('ranking'),
+    Field('rank_no', 'integer'),
+    Field('book_id', 'integer', index=True),
+    Field('name'),
+    Field('release_date', 'date'),
+    Field('reader'),
+    Field('created_on', 'datetime'),
+    Field('creator_id', 'integer'),
+    Field('creator_name'),
+    Field('value', 'double', default=0),
+    indexes={'book_ranking_ranking_rank_no': ['ranking', 'rank_no']},
+    migrate=True,
+)
+
+db.define_table('book_tally',
     Field('book_id', 'integer'),
+    Field('tally_date', 'date', index=True),
+    Field('contributions', 'double', default=0),
+    Field('rating_total', 'double', default=0),
+    Field('rating_count', 'integer', default=0),
+    Field('views', 'integer', default=0),
+    indexes={'book_tally_book_id_tally_date_idx': ['book_id', 'tally_date']},
+    migrate=True,
+)
+
+db.define_table('book_to_link',
+    Field('book_id', 'integer', index=True),
     Field('link_id', 'integer'),
     Field('order_no', 'integer'),
     migrate=True,
@@ -241,7 +286,7 @@ db.define_table('contribution',
         'book_id',
         'integer',
     ),
-    Field('time_stamp', 'datetime'),
+    Field('time_stamp', 'datetime', index=True),
     Field('amount', 'double'),
     migrate=True,
 )
@@ -252,6 +297,7 @@ db.define_table('creator',
         'integer',
         readable=False,
         writable=False,
+        index=True,
     ),
     Field('email',
         label='Contact email',
@@ -302,22 +348,40 @@ db.define_table('creator',
         comment='Provide a biography, for example, a few sentences similar to the first paragraph of a wikipedia article.'
     ),
     Field('image', 'upload',
-        autodelete=True,
+        autodelete=False,               # See book_page.image
         requires = IS_EMPTY_OR(IS_IMAGE()),
         uploadfolder=os.path.join(request.folder, 'uploads', 'original'),
         uploadseparate=True,
+        custom_store=lambda f, n, p: store_image(db.creator.image, f, n),
+        index=True,
+    ),
+    Field('image_filename',
+        writable=False,
+        readable=False,
     ),
     format='%(name)s',
     migrate=True,
 )
 
 db.define_table('creator_to_link',
-    Field('creator_id', 'integer'),
+    Field('creator_id', 'integer', index=True),
     Field('link_id', 'integer'),
     Field('order_no', 'integer'),
     migrate=True,
 )
 
+db.define_table('image_size',
+    Field('image', length=255),
+    Field('size'),
+    Field('width', 'integer'),
+    Field('height', 'integer'),
+    Field('bytes', 'integer'),
+    Field('format'),
+    Field('checksum'),
+    indexes={'image_size_image_size_idx': ['image', 'size']},
+    migrate=True,
+)
+
 db.define_table('link',
     Field('url',
         requires=IS_URL(),
@@ -337,6 +401,7 @@ db.define_table('page_comment',
     Field(
         'book_page_id',
         'integer',
+        index=True,
     ),
     Field('comment_text'),
     format='%(comment_text)s',
@@ -352,11 +417,23 @@ db.define_table('rating',
         'book_id',
         'integer',
     ),
-    Field('time_stamp', 'datetime'),
+    Field('time_stamp', 'datetime', index=True),
     Field('amount', 'double'),
     migrate=True,
 )
 
+db.define_table('event_log',
+    Field('name', index=True),
+    Field('flushed_on', 'datetime', index=True),
+    migrate=True,
+)
+
+db.define_table('tally_watermark',
+    Field('tablename'),
+    Field('max_id', 'integer', default=0),
+    migrate=True,
+)
+
 db.define_table('book_view',
     Field(
         'auth_user_id',
@@ -366,75 +443,80 @@ db.define_table('book_view',
         'book_id',
         'integer',
     ),
-    Field('time_stamp', 'datetime'),
+    Field('time_stamp', 'datetime', index=True),
     migrate=True,
 )
 
-db.book.creator_id.requires = IS_IN_DB(
-    db,
-    db.creator.id,
-    '%(name)s',
-    zero=None
-)
+model_db.mark('tables')
 
-db.book_page.book_id.requires = IS_IN_DB(
-    db,
-    db.book.id,
-    '%(name)s',
-    zero=None
-)
+if model_db.needs_validators(VALIDATOR_CONTROLLERS):
+    db.book.creator_id.requires = IS_IN_DB(
+        db,
+        db.creator.id,
+        '%(name)s',
+        zero=None
+    )
 
-db.contribution.auth_user_id.requires = IS_IN_DB(
-    db,
-    db.auth_user.id,
-    '%(last_name)s, %(first_name)s',
-    zero=None
-)
+    db.book_page.book_id.requires = IS_IN_DB(
+        db,
+        db.book.id,
+        '%(name)s',
+        zero=None
+    )
 
-db.contribution.book_id.requires = IS_IN_DB(
-    db,
-    db.book.id,
-    '%(name)s',
-    zero=None
-)
+    db.contribution.auth_user_id.requires = IS_IN_DB(
+        db,
+        db.auth_user.id,
+        '%(last_name)s, %(first_name)s',
+        zero=None
+    )
 
-db.creator.auth_user_id.requires = IS_IN_DB(
-    db,
-    db.auth_user.id,
-    '%(page_no)s',
-    zero=None
-)
+    db.contribution.book_id.requires = IS_IN_DB(
+        db,
+        db.book.id,
+        '%(name)s',
+        zero=None
+    )
 
-db.page_comment.book_page_id.requires = IS_IN_DB(
-    db,
-    db.book_page.id,
-    '%(last_name)s, %(first_name)s',
-    zero=None
-)
-db.rating.auth_user_id.requires = IS_IN_DB(
-    db,
-    db.auth_user.id,
-    '%(last_name)s, %(first_name)s',
-    zero=None
-)
+    db.creator.auth_user_id.requires = IS_IN_DB(
+        db,
+        db.auth_user.id,
+        '%(page_no)s',
+        zero=None
+    )
 
-db.rating.book_id.requires = IS_IN_DB(
-    db,
-    db.book.id,
-    '%(name)s',
-    zero=None
-)
+    db.page_comment.book_page_id.requires = IS_IN_DB(
+        db,
+        db.book_page.id,
+        '%(last_name)s, %(first_name)s',
+        zero=None
+    )
+    db.rating.auth_user_id.requires = IS_IN_DB(
+        db,
+        db.auth_user.id,
+        '%(last_name)s, %(first_name)s',
+        zero=None
+    )
 
-db.book_view.auth_user_id.requires = IS_IN_DB(
-    db,
-    db.auth_user.id,
-    '%(last_name)s, %(first_name)s',
-    zero=None
-)
+    db.rating.book_id.requires = IS_IN_DB(
+        db,
+        db.book.id,
+        '%(name)s',
+        zero=None
+    )
 
-db.book_view.book_id.requires = IS_IN_DB(
-    db,
-    db.book.id,
-    '%(name)s',
-    zero=None
-)
+    db.book_view.auth_user_id.requires = IS_IN_DB(
+        db,
+        db.auth_user.id,
+        '%(last_name)s, %(first_name)s',
+        zero=None
+    )
+
+    db.book_view.book_id.requires = IS_IN_DB(
+        db,
+        db.book.id,
+        '%(name)s',
+        zero=None
+    )
+
+model_db.mark('validators')
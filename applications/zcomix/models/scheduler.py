@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+scheduler.py
+
+Background job queue. Jobs are run by a scheduler worker:
+    python web2py.py -K zcomix
+"""
+# C0103: *Invalid name "%%s" (should match %%s)*
+# pylint: disable=C0103
+
+from gluon.scheduler import Scheduler
+from applications.zcomix.modules.events import flush_events
+from applications.zcomix.modules.images import resize_image
+
+scheduler = Scheduler(
+    db,
+    tasks=dict(
+        flush_events=flush_events,
+        resize_image=resize_image,
+    ),
+)
+current.app.scheduler = scheduler
+
+# This is the last model run.
+model_db.mark('scheduler')
+model_db.report_timing()
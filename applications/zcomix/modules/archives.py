@@ -0,0 +1,443 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Classes and functions related to book archives (cbz files).
+"""
+import glob
+import hashlib
+import os
+import re
+import struct
+import tempfile
+import time
+import zlib
+from gluon import *
+from gluon.globals import Response
+from gluon.streamer import DEFAULT_CHUNK_SIZE
+from applications.zcomix.modules.events import log_event
+from applications.zcomix.modules.images import UploadImage
+
+ARCHIVE_CONTENT_TYPE = 'application/x-cbz'
+ARCHIVE_EXTENSION = 'cbz'
+
+ZIP_VERSION = 20                        # 2.0, stored entries
+ZIP_MAX_SIZE = 0xFFFFFFFF               # zip64 is not supported
+
+regex_range = re.compile(r'^bytes=(?P<start>\d*)-(?P<stop>\d*)$')
+
+
+class ArchiveDownloader(Response):
+    """Class representing a book archive downloader"""
+
+    def download(self, request, db, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Stream a book as a cbz archive.
+
+        The archive is built on the fly as it is streamed. Range requests are
+        supported so interrupted downloads can be resumed. The archive of a
+        released book is cached on disk when it has been streamed in full.
+        A download event is logged unless the request continues a previous
+        download. See modules/events.py.
+
+        request.args(0): integer, id of book
+        """
+        current.session.forget(current.response)
+
+        book = None
+        if request.args(0):
+            query = (db.book.id == request.args(0))
+            book = db(query).select(db.book.ALL).first()
+        if not book:
+            raise HTTP(404)
+
+        archive = BookArchive(db, book)
+        if not archive.entries:
+            raise HTTP(404)
+
+        headers = self.headers
+        headers['Content-Type'] = ARCHIVE_CONTENT_TYPE
+        headers['Content-Disposition'] = \
+            'attachment; filename="%s"' % archive.filename().replace('"', '\"')
+        headers['ETag'] = archive.etag()
+        headers['Accept-Ranges'] = 'bytes'
+
+        if request.env.http_if_none_match == headers['ETag']:
+            raise HTTP(304, ETag=headers['ETag'])
+
+        # The size of a cached archive is that of its file, the layout,
+        # which reads every page, is only built if it is not cached.
+        cache_name = archive.cache_name() if book.release_date else None
+        cache_size = None
+        if cache_name:
+            try:
+                cache_size = os.stat(cache_name).st_size
+            except OSError:
+                pass
+        size = cache_size if cache_size is not None else archive.size
+
+        byte_range = parse_range(request, size, headers['ETag'])
+        if not byte_range or byte_range[0] == 0:
+            auth = current.app.auth if getattr(current, 'app', None) \
+                else None
+            log_event(
+                'download',
+                book.id,
+                auth_user_id=auth.user_id if auth else 0,
+            )
+
+        if cache_size is not None:
+            return self.stream(cache_name, chunk_size=chunk_size,
+                               request=request)
+
+        if byte_range:
+            start, stop = byte_range
+            headers['Content-Range'] = 'bytes %i-%i/%i' % \
+                (start, stop, archive.size)
+            headers['Content-Length'] = stop - start + 1
+            raise HTTP(
+                206,
+                archive.chunks(start, stop + 1, chunk_size=chunk_size),
+                **headers
+            )
+
+        headers['Content-Length'] = archive.size
+        chunks = archive.chunks(chunk_size=chunk_size)
+        if cache_name:
+            chunks = cache_while_streaming(chunks, cache_name)
+        raise HTTP(200, chunks, **headers)
+
+
+class BookArchive(object):
+    """Class representing the cbz archive of a book.
+
+    The archive is a zip file with one stored (uncompressed) entry per page.
+    Page images are already compressed so compressing them again gains
+    little. Since entries are stored, the archive size and the offset of
+    every byte is known before any data is sent.
+    """
+
+    def __init__(self, db, book):
+        """Constructor
+
+        Args:
+            db: gluon.dal.DAL instance
+            book: Row instance representing a book record.
+        """
+        self.db = db
+        self.book = book
+        self.entries = self.book_entries()
+        self._layout = None
+
+    def book_entries(self):
+        """Return the entries of the book archive.
+
+        Returns:
+            list of tuples (arcname, fullname)
+                arcname: string, name of page in archive, eg 001.jpg
+                fullname: string, full path name of page image file.
+        """
+        db = self.db
+        query = (db.book_page.book_id == self.book.id)
+        pages = db(query).select(
+            db.book_page.image,
+            orderby=db.book_page.page_no,
+        )
+        width = max(3, len(str(len(pages))))
+        entries = []
+        for count, page in enumerate(pages, 1):
+            if not page.image:
+                continue
+            fullname = UploadImage(db.book_page.image, page.image).fullname()
+            if not os.path.exists(fullname):
+                continue
+            extension = os.path.splitext(page.image)[1].lower()
+            arcname = '{n:0{w}d}{e}'.format(n=count, w=width, e=extension)
+            entries.append((arcname, fullname))
+        return entries
+
+    def cache_name(self):
+        """Return the name of the file the archive is cached in.
+
+        The name includes the etag so it changes if the pages change.
+
+        Returns:
+            string, full path name of cached archive file.
+        """
+        return os.path.join(
+            current.request.folder,
+            'uploads',
+            'archives',
+            'book.{i}.{e}.{x}'.format(
+                i=self.book.id,
+                e=self.etag().strip('"'),
+                x=ARCHIVE_EXTENSION,
+            )
+        )
+
+    def chunks(self, start=0, stop=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Generator of the archive data.
+
+        Args:
+            start: integer, offset of the first byte
+            stop: integer, offset after the last byte. Default: archive size
+            chunk_size: integer, maximum number of bytes per chunk
+
+        Returns:
+            string, data
+        """
+        if stop is None:
+            stop = self.size
+        offset = 0
+        for segment in self.layout():
+            if offset >= stop:
+                break
+            length = segment_length(segment)
+            if offset + length <= start:
+                offset += length
+                continue
+            seg_start = max(start - offset, 0)
+            seg_stop = min(stop - offset, length)
+            if isinstance(segment, str):
+                yield segment[seg_start:seg_stop]
+            else:
+                with open(segment[0], 'rb') as f:
+                    f.seek(seg_start)
+                    remaining = seg_stop - seg_start
+                    while remaining > 0:
+                        data = f.read(min(chunk_size, remaining))
+                        if not data:
+                            raise IOError(
+                                'File changed size: {f}'.format(f=segment[0]))
+                        remaining -= len(data)
+                        yield data
+            offset += length
+
+    def etag(self):
+        """Return the ETag of the archive.
+
+        Returns:
+            string, quoted entity tag
+        """
+        data = '|'.join([
+            '{a}:{n}:{s}:{m}'.format(a=a, n=os.path.basename(f), s=s, m=m)
+            for a, f, s, m in self.stats()
+        ])
+        return '"{h}"'.format(h=hashlib.md5(data).hexdigest()[:16])
+
+    def filename(self):
+        """Return the filename of the archive as presented to the user."""
+        name = re.sub(r'[^\w\- ]+', '', self.book.name or '').strip()
+        return '{n}.{x}'.format(n=name or 'book', x=ARCHIVE_EXTENSION)
+
+    def layout(self):
+        """Return the layout of the archive.
+
+        The CRC-32 of each page is required before its data is written so
+        the page files are read once to calculate them.
+
+        Returns:
+            list of segments, a segment is either a string of zip headers or
+                a tuple (fullname, bytes) for the data of a page.
+        """
+        if self._layout is not None:
+            return self._layout
+        segments = []
+        central = []
+        offset = 0
+        for arcname, fullname, size, mtime in self.stats():
+            dos_time, dos_date = dos_datetime(mtime)
+            crc = file_crc32(fullname)
+            header = struct.pack(
+                '<IHHHHHIIIHH',
+                0x04034b50,             # local file header signature
+                ZIP_VERSION,
+                0,                      # flags
+                0,                      # method: stored
+                dos_time,
+                dos_date,
+                crc,
+                size,                   # compressed size
+                size,                   # uncompressed size
+                len(arcname),
+                0,                      # extra field length
+            ) + arcname
+            central.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII',
+                0x02014b50,             # central file header signature
+                ZIP_VERSION,            # version made by
+                ZIP_VERSION,            # version needed to extract
+                0,
+                0,
+                dos_time,
+                dos_date,
+                crc,
+                size,
+                size,
+                len(arcname),
+                0,                      # extra field length
+                0,                      # file comment length
+                0,                      # disk number start
+                0,                      # internal file attributes
+                0644 << 16,             # external file attributes
+                offset,                 # offset of local header
+            ) + arcname)
+            segments.append(header)
+            segments.append((fullname, size))
+            offset += len(header) + size
+        directory = ''.join(central)
+        if offset + len(directory) > ZIP_MAX_SIZE:
+            raise SyntaxError('Archive too large: {o}'.format(o=offset))
+        end = struct.pack(
+            '<IHHHHIIH',
+            0x06054b50,                 # end of central dir signature
+            0,                          # number of this disk
+            0,                          # disk with the central directory
+            len(central),
+            len(central),
+            len(directory),
+            offset,
+            0,                          # comment length
+        )
+        segments.append(directory + end)
+        self._layout = segments
+        return self._layout
+
+    @property
+    def size(self):
+        """Return the size of the archive in bytes."""
+        return sum([segment_length(x) for x in self.layout()])
+
+    def stats(self):
+        """Return the file stats of the entries.
+
+        Returns:
+            list of tuples (arcname, fullname, bytes, mtime)
+        """
+        stats = []
+        for arcname, fullname in self.entries:
+            stat = os.stat(fullname)
+            stats.append((arcname, fullname, stat.st_size, int(stat.st_mtime)))
+        return stats
+
+
+def cache_while_streaming(chunks, cache_name):
+    """Generator that writes the chunks of a stream to a cache file.
+
+    The cache file is only created if the stream completes, ie the data is
+    written to a temporary file in the cache directory which is renamed when
+    the last chunk is written. Older archives of the book are removed.
+
+    Args:
+        chunks: iterable of strings, the data
+        cache_name: string, full path name of cache file
+
+    Returns:
+        string, data
+    """
+    cache_dir = os.path.dirname(cache_name)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    (fd, tmp_name) = tempfile.mkstemp(prefix='.archive_', dir=cache_dir)
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for data in chunks:
+                f.write(data)
+                yield data
+        # book.<id>.<etag>.cbz
+        pattern = '.'.join(cache_name.split('.')[:-2] + ['*', '*'])
+        for old in glob.glob(pattern):
+            os.unlink(old)
+        os.rename(tmp_name, cache_name)
+        completed = True
+    finally:
+        if not completed and os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+
+
+def dos_datetime(timestamp):
+    """Return the MS-DOS time and date of a timestamp as used in zip files.
+
+    Args:
+        timestamp: integer, seconds since the epoch
+
+    Returns:
+        tuple (time, date), integers
+    """
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+def file_crc32(fullname, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return the CRC-32 of a file.
+
+    Args:
+        fullname: string, full path name of file.
+
+    Returns:
+        integer, unsigned CRC-32
+    """
+    crc = 0
+    with open(fullname, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+    return crc & 0xFFFFFFFF
+
+
+def parse_range(request, size, entity_tag=None):
+    """Return the byte range of a Range request.
+
+    Args:
+        request: gluon.globals.Request instance
+        size: integer, size of the entity in bytes
+        entity_tag: string, ETag of the entity. If the request has an
+            If-Range header that does not match, the range is ignored.
+
+    Returns:
+        tuple (start, stop), offsets of the first and last bytes, or None if
+            the request is not a single range request.
+
+    Raises:
+        HTTP(416) if the range is not satisfiable.
+    """
+    byte_range = request.env.http_range
+    if not byte_range:
+        return None
+    if request.env.http_if_range and request.env.http_if_range != entity_tag:
+        return None
+    m = regex_range.match(byte_range.strip())
+    if not m or (not m.group('start') and not m.group('stop')):
+        return None
+    if m.group('start'):
+        start = int(m.group('start'))
+        stop = int(m.group('stop')) if m.group('stop') else size - 1
+    else:
+        # Suffix range, the last n bytes
+        start = max(size - int(m.group('stop')), 0)
+        stop = size - 1
+    stop = min(stop, size - 1)
+    if start > stop:
+        raise HTTP(416, **{'Content-Range': 'bytes */%i' % size})
+    return (start, stop)
+
+
+def segment_length(segment):
+    """Return the length of an archive layout segment.
+
+    Args:
+        segment: string or tuple (fullname, bytes), see BookArchive.layout()
+
+    Returns:
+        integer, number of bytes
+    """
+    if isinstance(segment, str):
+        return len(segment)
+    return segment[1]
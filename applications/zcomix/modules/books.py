@@ -5,14 +5,104 @@
 
 Book classes and functions.
 """
+import hashlib
 import os
 import stat
 from gluon import *
 from gluon.storage import Storage
 from gluon.contrib.simplejson import dumps
 from applications.zcomix.modules.images import \
+    SRCSET_SIZES, \
     UploadImage, \
-    img_tag
+    image_metadata, \
+    image_srcset, \
+    img_tag, \
+    size_names
+
+
+def book_manifest(db, book, version=None):
+    """Return the reader manifest of a book.
+
+    The manifest lists the pages of the book in order with their dimensions
+    and the url of each size. The pages are read with two queries regardless
+    of the number of pages.
+
+    Args:
+        db: gluon.dal.DAL instance
+        book: Row instance representing a book record.
+        version: string, version of the manifest. Default
+            manifest_version(db, book)
+
+    Returns:
+        dict,
+            {
+                'book_id': 1,
+                'version': '8f1a62a1d2f43e2c',
+                'page_count': 2,
+                'sizes': ['original', 'medium', 'thumb', 'w320', ...],
+                'pages': [
+                    {
+                        'id': 11,
+                        'page_no': 1,
+                        'processing': False,
+                        'dimensions': {'original': [1600, 2400], ...},
+                        'urls': {'original': '/zcomix/images/download/...'},
+                        'srcset': '/zcomix/images/download/... 320w, ...',
+                        'sizes': '(max-width: 1600px) 100vw, 1600px',
+                    },
+                    ...
+                ],
+            }
+        Sizes not created yet are not included in a page's dimensions and
+        urls. The original is always included in urls. The srcset and sizes
+        are the attributes of the IMG of the original, see img_tag(), they
+        are None if the page has no ladder sizes.
+    """
+    if version is None:
+        version = manifest_version(db, book)
+    records = db(db.book_page.book_id == book.id).select(
+        db.book_page.id,
+        db.book_page.page_no,
+        db.book_page.image,
+        db.book_page.thumb_w,
+        orderby=[db.book_page.page_no, db.book_page.id],
+    )
+    metadata = image_metadata(db, [x.image for x in records if x.image])
+    sizes = size_names()
+    pages = []
+    for record in records:
+        if not record.image:
+            continue
+        stored = metadata.get(record.image, {})
+        dimensions = {}
+        urls = {}
+        for size in sizes:
+            if size in stored:
+                dimensions[size] = [stored[size].width, stored[size].height]
+            if size in stored or size == 'original':
+                urls[size] = URL(
+                    c='images',
+                    f='download',
+                    args=record.image,
+                    vars={'size': size},
+                )
+        srcset, width = image_srcset(record.image, stored)
+        pages.append(dict(
+            id=record.id,
+            page_no=record.page_no,
+            processing=not record.thumb_w,
+            dimensions=dimensions,
+            urls=urls,
+            srcset=srcset,
+            sizes=SRCSET_SIZES.format(w=width) if srcset else None,
+        ))
+    return dict(
+        book_id=book.id,
+        version=version,
+        page_count=len(pages),
+        sizes=sizes,
+        pages=pages,
+    )
 
 
 def book_pages_as_json(db, book_id, book_page_ids=None):
@@ -35,22 +125,25 @@ def book_pages_as_json(db, book_id, book_page_ids=None):
             }
 
     """
-    pages = []
     query = (db.book_page.book_id == book_id)
     if book_page_ids:
         query = query & (db.book_page.id.belongs(book_page_ids))
-    records = db(query).select(db.book_page.id, orderby=db.book_page.page_no)
-    for record in records:
-        pages.append(book_page_for_json(db, record.id))
+    records = db(query).select(db.book_page.ALL, orderby=db.book_page.page_no)
+    metadata = image_metadata(
+        db, [x.image for x in records if x.image], size='original')
+    pages = [book_page_for_json(db, x, metadata=metadata) for x in records]
     return dumps(dict(files=pages))
 
 
-def book_page_for_json(db, book_page_id):
+def book_page_for_json(db, book_page_entity, metadata=None):
     """Return the book_page formated as json suitable for jquery-file-upload.
 
     Args:
         db: gluon.dal.DAL instance
-        book_page_id: integer, the id of the book_page record
+        book_page_entity: Row instance or integer, if integer, this is the id
+            of the book_page. The book_page record is read.
+        metadata: dict, the 'original' metadata of the image as returned by
+            image_metadata(). If None, the metadata is read.
 
     Returns:
         dict, containing book_page data suitable for jquery-file-upload
@@ -60,10 +153,17 @@ def book_page_for_json(db, book_page_id):
                     "url": "http:\/\/example.org\/files\/picture1.jpg",
                     "thumbnailUrl": "http:\/\/example.org\/files\/thumbnail\/picture1.jpg",
                     "deleteUrl": "http:\/\/example.org\/files\/picture1.jpg",
-                    "deleteType": "DELETE"
+                    "deleteType": "DELETE",
+                    "processing": false
                 },
+            processing is true while the resized versions of the image are
+            being created.
     """
-    book_page = db(db.book_page.id == book_page_id).select(db.book_page.ALL).first()
+    if hasattr(book_page_entity, 'id'):
+        book_page = book_page_entity
+    else:
+        book_page = db(db.book_page.id == book_page_entity).select(
+            db.book_page.ALL).first()
     if not book_page:
         return
 
@@ -71,11 +171,20 @@ def book_page_for_json(db, book_page_id):
         book_page.image,
         nameonly=True,
     )
-
-    try:
-        size = os.stat(original_fullname).st_size
-    except (KeyError, OSError):
-        size = 0
+    # Identical uploads share the stored image, the record keeps its own
+    # filename.
+    filename = book_page.image_filename or filename
+
+    if metadata is None:
+        metadata = image_metadata(db, [book_page.image], size='original')
+    if book_page.image in metadata:
+        size = metadata[book_page.image]['original'].bytes
+    else:
+        # Metadata is stored when the image is resized.
+        try:
+            size = os.stat(original_fullname).st_size
+        except (KeyError, OSError):
+            size = 0
 
     url = URL(
         c='images',
@@ -106,6 +215,7 @@ def book_page_for_json(db, book_page_id):
         thumbnailUrl=thumb,
         deleteUrl=delete_url,
         deleteType='DELETE',
+        processing=not book_page.thumb_w,
     )
 
 
@@ -123,6 +233,25 @@ def cover_image(db, book_id, size='original', img_attributes=None):
         db.book_page.ALL,
         orderby=db.book_page.page_no
     ).first()
+    return cover_image_for_page(
+        first_page,
+        size=size,
+        img_attributes=img_attributes
+    )
+
+
+def cover_image_for_page(first_page, size='original', img_attributes=None,
+                         metadata=None):
+    """Return html code suitable for the cover image of a book given its
+    first page.
+
+    Args:
+        first_page: Row instance representing a book_page record or None if
+            the book has no pages.
+        size: string, the size of the image. One of UploadImage.sizes.keys()
+        img_attributes: dict of attributes for IMG
+        metadata: dict, image metadata, see img_tag()
+    """
     image = first_page.image if first_page else None
 
     attributes = {}
@@ -161,7 +290,40 @@ def cover_image(db, book_id, size='original', img_attributes=None):
     if img_attributes:
         attributes.update(img_attributes)
 
-    return img_tag(image, size=size, img_attributes=attributes)
+    return img_tag(
+        image, size=size, img_attributes=attributes, metadata=metadata)
+
+
+def cover_images(db, book_ids, size='original', img_attributes=None):
+    """Return html code suitable for the cover images of a list of books.
+
+    Bulk version of cover_image(). The first pages of all books are read
+    with first_pages() so the number of queries does not depend on the
+    number of books.
+
+    Args:
+        db: gluon.dal.DAL instance
+        book_ids: list of integers, ids of book records
+        size: string, the size of the image. One of UploadImage.sizes.keys()
+        img_attributes: dict of attributes for IMG
+
+    Returns:
+        dict, {book_id: IMG or DIV instance}
+    """
+    pages = first_pages(db, book_ids)
+    metadata = None
+    if size == 'original':
+        metadata = image_metadata(
+            db, [x.image for x in pages.values() if x.image])
+    images = {}
+    for book_id in book_ids:
+        images[book_id] = cover_image_for_page(
+            pages.get(book_id, None),
+            size=size,
+            img_attributes=img_attributes,
+            metadata=metadata,
+        )
+    return images
 
 
 def default_contribute_amount(db, book_entity):
@@ -192,6 +354,77 @@ def default_contribute_amount(db, book_entity):
     return amount
 
 
+def first_pages(db, book_ids):
+    """Return the first page of each of a list of books.
+
+    The pages are read with two queries regardless of the number of books.
+
+    Args:
+        db: gluon.dal.DAL instance
+        book_ids: list of integers, ids of book records
+
+    Returns:
+        dict, {book_id: Row instance representing book_page record}
+            Books with no pages are not included.
+    """
+    if not book_ids:
+        return {}
+
+    min_page_no = db.book_page.page_no.min()
+    rows = db(db.book_page.book_id.belongs(book_ids)).select(
+        db.book_page.book_id,
+        min_page_no,
+        groupby=db.book_page.book_id,
+    )
+    queries = []
+    for r in rows:
+        queries.append(
+            (db.book_page.book_id == r.book_page.book_id) &
+            (db.book_page.page_no == r[min_page_no])
+        )
+    if not queries:
+        return {}
+
+    query = reduce(lambda x, y: x | y, queries)
+    pages = db(query).select(
+        db.book_page.ALL,
+        orderby=[db.book_page.book_id, db.book_page.page_no, db.book_page.id],
+    )
+    first = {}
+    for page in pages:
+        if page.book_id not in first:
+            first[page.book_id] = page
+    return first
+
+
+def manifest_version(db, book):
+    """Return the version of the reader manifest of a book.
+
+    The version changes when the book is updated or its pages are added,
+    deleted, reordered or resized. It is based on book.updated_on and the
+    ids, order and updated_on of the pages.
+
+    Args:
+        db: gluon.dal.DAL instance
+        book: Row instance representing a book record.
+
+    Returns:
+        string, version
+    """
+    pages = db(db.book_page.book_id == book.id).select(
+        db.book_page.id,
+        db.book_page.thumb_w,
+        db.book_page.updated_on,
+        orderby=[db.book_page.page_no, db.book_page.id],
+    )
+    data = '|'.join(
+        [str(book.updated_on)] +
+        ['{i}:{t}:{u}'.format(i=x.id, t=x.thumb_w, u=x.updated_on)
+            for x in pages]
+    )
+    return hashlib.md5(data).hexdigest()[:16]
+
+
 def read_link(db, book_entity, **attributes):
     """Return html code suitable for the cover image.
 
@@ -222,5 +455,3 @@ def read_link(db, book_entity, **attributes):
         kwargs['_href'] = url
     return A('Read', **kwargs)
 
-
-
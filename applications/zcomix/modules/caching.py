@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Classes and functions related to caching the output of public pages.
+
+The html of the public book, creator and search pages is the same for every
+anonymous visitor. cached_page() decorates a controller so the page is
+rendered once and served from cache until it expires or is invalidated.
+
+Every cached page has a tag, eg 'book.12', 'creator.3' or 'search'. The
+profile controller callbacks invalidate the tags of the records they change,
+see invalidate_book() and invalidate_creator(). Search pages list many books
+and are invalidated by any change to a book. The tally job, see
+modules/tallies.py, invalidates the search pages and the pages of the books
+it updates. Search pages also expire sooner.
+
+The cache is current.cache.ram by default. Deployments running several
+processes, including the scheduler running the tally job, should set the
+page_cache local setting to disk so all processes share, and invalidate, the
+same cache.
+"""
+import re
+from gluon import *
+
+CACHE_SECONDS = 3600                # Seconds a page is cached
+CACHE_PREFIX = 'page'
+SEARCH_CACHE_SECONDS = 300          # Seconds a search page is cached
+
+
+def cached_page(tag, var_names=None, time_expire=CACHE_SECONDS):
+    """Decorator that caches the rendered output of a controller.
+
+    Only GET requests of anonymous users are served from cache. Requests
+    with vars not in var_names, or with a flash message, are not cached.
+    A controller that returns a dict is rendered with its view before it is
+    cached.
+
+    Args:
+        tag: string, the tag of the page, eg 'book'. If the request has
+            args, the first is appended, eg 'book.12'.
+        var_names: list of strings, names of request vars the page depends
+            on.
+        time_expire: integer, seconds the page is cached.
+
+    Usage:
+        @cached_page('book')
+        def book():
+            ...
+    """
+    def wrapper(func):
+        """Wrap the controller function."""
+
+        def cached_func():
+            """Return the output of the controller, from cache if possible."""
+            key = page_key(tag, var_names=var_names)
+            if not key:
+                return func()
+
+            def render():
+                """Return the rendered output of the controller."""
+                output = func()
+                if isinstance(output, dict):
+                    output = current.response.render(output)
+                return output
+
+            return page_cache()(key, render, time_expire=time_expire)
+
+        cached_func.__doc__ = func.__doc__
+        cached_func.__name__ = func.__name__
+        return cached_func
+    return wrapper
+
+
+def clear_tags(tags):
+    """Remove the cached pages of tags.
+
+    Args:
+        tags: list of strings, eg ['book.12', 'search']
+    """
+    if not tags:
+        return
+    regex = '^{p}:({t}):'.format(
+        p=CACHE_PREFIX,
+        t='|'.join([re.escape(x) for x in tags]),
+    )
+    page_cache().clear(regex=regex)
+
+
+def invalidate_book(book_id):
+    """Remove the cached pages displaying a book.
+
+    Args:
+        book_id: integer, id of book record
+    """
+    clear_tags(['book.{i}'.format(i=book_id), 'search'])
+
+
+def invalidate_creator(creator_id):
+    """Remove the cached pages displaying a creator, including the pages of
+    their books.
+
+    Args:
+        creator_id: integer, id of creator record
+    """
+    db = current.app.db
+    books = db(db.book.creator_id == creator_id).select(db.book.id)
+    tags = ['creator.{i}'.format(i=creator_id), 'search']
+    tags.extend(['book.{i}'.format(i=x.id) for x in books])
+    clear_tags(tags)
+
+
+def invalidate_profile(form):
+    """Remove the cached pages displaying a user.
+
+    Args:
+        form: form with form.vars values, form.vars.id is the auth_user id.
+
+    Usage:
+        auth.settings.profile_onaccept = [lambda f: invalidate_profile(f)]
+    """
+    if not form.vars.id:
+        return
+    db = current.app.db
+    creator = db(db.creator.auth_user_id == form.vars.id).select(
+        db.creator.id).first()
+    if creator:
+        invalidate_creator(creator.id)
+
+
+def page_cache():
+    """Return the cache model pages are cached in.
+
+    Returns:
+        gluon.cache.CacheAbstract subclass instance, current.cache.disk if the
+            page_cache local setting is 'disk', else current.cache.ram
+    """
+    local_settings = current.app.local_settings \
+        if getattr(current, 'app', None) else None
+    if local_settings and local_settings.page_cache == 'disk':
+        return current.cache.disk
+    return current.cache.ram
+
+
+def page_key(tag, var_names=None):
+    """Return the cache key of the page of the current request.
+
+    Args:
+        tag: string, see cached_page()
+        var_names: list of strings, see cached_page()
+
+    Returns:
+        string, the cache key, or None if the page is not to be cached.
+    """
+    request = current.request
+    if request.env.request_method not in [None, 'GET', 'HEAD']:
+        return None
+    auth = current.app.auth if getattr(current, 'app', None) else None
+    if auth and auth.user_id:
+        return None
+    if current.response.flash or \
+            (current.session and current.session.flash):
+        return None
+    var_names = var_names or []
+    if [x for x in request.vars.keys() if x not in var_names]:
+        return None
+    if request.args(0):
+        tag = '{t}.{a}'.format(t=tag, a=request.args(0))
+    page_vars = '&'.join([
+        '{k}={v}'.format(k=x, v=request.vars[x])
+        for x in sorted(request.vars.keys())
+    ])
+    return '{p}:{t}:{c}/{f}.{e}/{a}?{v}#{i}'.format(
+        p=CACHE_PREFIX,
+        t=tag,
+        c=request.controller,
+        f=request.function,
+        e=request.extension,
+        a='/'.join(request.args),
+        v=page_vars,
+        i=request.cid or '',
+    )
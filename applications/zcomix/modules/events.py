@@ -0,0 +1,281 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Classes and functions related to events: book views, book downloads and
+contributions.
+
+Events are not written to the database on the request path. They are
+appended to a log file, one json record per line, and the log is flushed to
+the database in batches by flush_events(), a gluon.scheduler task. Page views
+then cost a file append instead of a write transaction.
+
+A rotated log is claimed by a flusher, renamed, before it is read, and its
+name is recorded in the event_log table in the transaction that loads it, so
+each log is loaded once even with concurrent flushers or a crash.
+"""
+import collections
+import datetime
+import errno
+import glob
+import os
+import time
+from gluon import *
+from gluon.contrib.simplejson import dumps, loads
+
+EVENT_LOG_KEEP_DAYS = 7         # Days names of flushed logs are kept
+EVENT_TYPES = ['contribution', 'download', 'view']
+FLUSH_BATCH_SIZE = 500          # Records per bulk insert
+FLUSH_PERIOD = 60               # Seconds between scheduled flushes
+ROTATE_GRACE = 5                # Seconds a rotated log is left for writers
+                                # that opened it before it was rotated.
+TIME_STAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def claim_log(filename):
+    """Claim a rotated log for flushing.
+
+    The log is renamed with the pid of the process, eg
+        events.1405425600.000000.123.log.456.flushing
+    Only one of concurrent flushers succeeds.
+
+    Args:
+        filename: string, name of rotated log, or of a claimed log whose
+            claimer is gone.
+
+    Returns:
+        string, name of the claimed log, or None if it was claimed by
+            another process.
+    """
+    claimed = '{n}.{p}.flushing'.format(
+        n=os.path.join(
+            os.path.dirname(filename), rotated_log_name(filename)),
+        p=os.getpid(),
+    )
+    try:
+        os.rename(filename, claimed)
+    except OSError:
+        return None
+    return claimed
+
+
+def event_log_dir():
+    """Return the name of the directory event logs are stored in."""
+    return os.path.join(current.request.folder, 'private', 'events')
+
+
+def flush_events(log_dir=None, grace=ROTATE_GRACE):
+    """Flush logged events to the database.
+
+    This function is the gluon.scheduler task queued by queue_flush_events().
+
+    The current log is rotated, ie renamed, and the rotated logs older than
+    grace seconds are claimed, see claim_log(), and loaded into the
+    database, one transaction per log. Logs whose claimer is no longer
+    running are claimed again. Logs recorded in the event_log table were
+    loaded already and are only removed. Views and contributions are bulk
+    inserted, downloads increment book.downloads once per book.
+
+    Args:
+        log_dir: string, name of event log directory. Default event_log_dir()
+        grace: integer, rotated logs modified within this many seconds are
+            left for the next flush.
+
+    Returns:
+        dict, {event type: number of events flushed}
+    """
+    log_dir = log_dir or event_log_dir()
+    db = current.app.db
+    counts = dict([(x, 0) for x in EVENT_TYPES])
+
+    rotate_event_log(log_dir)
+    cutoff = time.time() - grace
+    claimed = set()
+    for filename in glob.glob(os.path.join(log_dir, 'events.*.log')):
+        if os.path.getmtime(filename) > cutoff:
+            continue
+        claimed.add(claim_log(filename))
+    pattern = os.path.join(log_dir, 'events.*.log.*.flushing')
+    for filename in glob.glob(pattern):
+        pid = int(filename.split('.')[-2])
+        if pid != os.getpid() and process_exists(pid):
+            continue
+        claimed.add(claim_log(filename))
+
+    claimed.discard(None)
+    for filename in sorted(claimed, key=rotated_log_name):
+        name = rotated_log_name(filename)
+        if db(db.event_log.name == name).count():
+            # Loaded, the flusher stopped before removing it.
+            os.unlink(filename)
+            continue
+        events = collections.defaultdict(list)
+        with open(filename) as f:
+            for line in f:
+                try:
+                    event = loads(line)
+                except ValueError:
+                    # Partial line, eg the disk filled up.
+                    continue
+                if event.get('type') in EVENT_TYPES:
+                    events[event['type']].append(event)
+
+        for table, event_type in [
+                (db.book_view, 'view'),
+                (db.contribution, 'contribution')]:
+            records = []
+            for event in events[event_type]:
+                record = dict(
+                    auth_user_id=event['auth_user_id'],
+                    book_id=event['book_id'],
+                    time_stamp=datetime.datetime.strptime(
+                        event['time_stamp'], TIME_STAMP_FORMAT),
+                )
+                if 'amount' in event:
+                    record['amount'] = event['amount']
+                records.append(record)
+            for i in range(0, len(records), FLUSH_BATCH_SIZE):
+                table.bulk_insert(records[i:i + FLUSH_BATCH_SIZE])
+
+        downloads = collections.Counter(
+            [x['book_id'] for x in events['download']])
+        for book_id, count in downloads.items():
+            db(db.book.id == book_id).update(
+                downloads=db.book.downloads + count)
+
+        db.event_log.insert(name=name, flushed_on=datetime.datetime.now())
+        db.commit()
+        os.unlink(filename)
+        for event_type in EVENT_TYPES:
+            counts[event_type] += len(events[event_type])
+
+    # The names are only needed until the logs are removed.
+    expired = datetime.datetime.now() - \
+        datetime.timedelta(days=EVENT_LOG_KEEP_DAYS)
+    db(db.event_log.flushed_on < expired).delete()
+    db.commit()
+    return counts
+
+
+def log_event(event_type, book_id, auth_user_id=0, amount=None,
+              time_stamp=None, log_dir=None):
+    """Append an event to the event log.
+
+    Args:
+        event_type: string, one of EVENT_TYPES
+        book_id: integer, id of book record
+        auth_user_id: integer, id of auth_user record, 0 if anonymous.
+        amount: float, contributions only, the amount contributed.
+        time_stamp: datetime.datetime instance, default request.now
+        log_dir: string, name of event log directory. Default event_log_dir()
+    """
+    if event_type not in EVENT_TYPES:
+        raise SyntaxError('Invalid event type: {t}'.format(t=event_type))
+    log_dir = log_dir or event_log_dir()
+    if not os.path.exists(log_dir):
+        try:
+            os.makedirs(log_dir)
+        except OSError:
+            # Created by another request.
+            if not os.path.isdir(log_dir):
+                raise
+    time_stamp = time_stamp or current.request.now or datetime.datetime.now()
+    event = dict(
+        type=event_type,
+        book_id=int(book_id),
+        auth_user_id=int(auth_user_id or 0),
+        time_stamp=time_stamp.strftime(TIME_STAMP_FORMAT),
+    )
+    if amount is not None:
+        event['amount'] = float(amount)
+    # Appends of a single line are not interleaved with other writers.
+    fd = os.open(
+        os.path.join(log_dir, 'events.log'),
+        os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+        0644
+    )
+    try:
+        os.write(fd, dumps(event) + '\n')
+    finally:
+        os.close(fd)
+
+
+def process_exists(pid):
+    """Return whether a process is running.
+
+    Args:
+        pid: integer, process id
+
+    Returns:
+        True if the process exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def queue_flush_events(scheduler):
+    """Queue the periodic flush_events scheduler task.
+
+    The task is queued once, it repeats indefinitely.
+
+    Args:
+        scheduler: gluon.scheduler.Scheduler instance
+
+    Returns:
+        Storage, as returned by Scheduler.queue_task(), or None if the task
+            is already queued.
+    """
+    db = scheduler.db
+    query = (db.scheduler_task.task_name == 'flush_events') & \
+        (db.scheduler_task.status.belongs(
+            ['QUEUED', 'ASSIGNED', 'RUNNING']))
+    if db(query).count():
+        return None
+    ret = scheduler.queue_task(
+        flush_events,
+        task_name='flush_events',
+        period=FLUSH_PERIOD,
+        repeats=0,
+        timeout=FLUSH_PERIOD * 5,
+    )
+    db.commit()
+    return ret
+
+
+def rotate_event_log(log_dir):
+    """Rotate the event log.
+
+    Args:
+        log_dir: string, name of event log directory.
+
+    Returns:
+        string, name of the rotated log, or None if there was nothing to
+            rotate.
+    """
+    log_name = os.path.join(log_dir, 'events.log')
+    if not os.path.exists(log_name) or not os.path.getsize(log_name):
+        return None
+    rotated = os.path.join(
+        log_dir,
+        'events.{t:0.6f}.{p}.log'.format(t=time.time(), p=os.getpid())
+    )
+    os.rename(log_name, rotated)
+    return rotated
+
+
+def rotated_log_name(filename):
+    """Return the name of a rotated log.
+
+    Args:
+        filename: string, name of a rotated or claimed log, eg
+            .../events.1405425600.000000.123.log.456.flushing
+
+    Returns:
+        string, eg events.1405425600.000000.123.log
+    """
+    name = os.path.basename(filename)
+    return name[:name.index('.log') + len('.log')]
@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Full text search classes and functions.
+
+Books are indexed by their name and description and the name and bio of
+their creator. The index is maintained from the book and creator CRUD
+callbacks. The backend is set by the fulltext_backend local setting, see
+BACKENDS. By default sqlite databases use an SQLite FTS4 table and other
+databases fall back to LIKE queries.
+
+The index of existing books is built by private/bin/rebuild_fulltext.py.
+"""
+import re
+import struct
+from abc import ABCMeta, abstractmethod
+from gluon import *
+
+COLUMNS = [
+    # (column, weight)
+    ('name', 10.0),
+    ('creator_name', 5.0),
+    ('description', 1.0),
+    ('bio', 0.5),
+]
+FULLTEXT_MAX_HITS = 1000                # Maximum hits returned by a search
+FULLTEXT_TABLE = 'book_fulltext'
+
+regex_term = re.compile(r'\w+', re.UNICODE)
+
+
+class FullTextIndex(object):
+    """Base class representing a full text index of books.
+
+    Backends implement clear(), delete_book(), search() and update().
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, db):
+        """Constructor
+
+        Args:
+            db: gluon.dal.DAL instance
+        """
+        self.db = db
+
+    def book_documents(self, query=None):
+        """Return the documents of books.
+
+        Args:
+            query: gluon.dal.Query instance, the books to return. Default
+                all books.
+
+        Returns:
+            list of dicts, {'book_id': id, column: text, ...}, one per book.
+        """
+        db = self.db
+        if query is None:
+            query = (db.book.id > 0)
+        rows = db(query).select(
+            db.book.id,
+            db.book.name,
+            db.book.description,
+            db.auth_user.name,
+            db.creator.bio,
+            left=[
+                db.creator.on(db.book.creator_id == db.creator.id),
+                db.auth_user.on(db.creator.auth_user_id == db.auth_user.id),
+            ],
+        )
+        documents = []
+        for r in rows:
+            documents.append(dict(
+                book_id=r.book.id,
+                name=r.book.name or '',
+                creator_name=r.auth_user.name or '',
+                description=r.book.description or '',
+                bio=r.creator.bio or '',
+            ))
+        return documents
+
+    @abstractmethod
+    def clear(self):
+        """Remove all books from the index."""
+
+    @abstractmethod
+    def delete_book(self, book_id):
+        """Remove a book from the index.
+
+        Args:
+            book_id: integer, id of book record
+        """
+
+    def index_book(self, book_id):
+        """Add or update a book in the index.
+
+        Args:
+            book_id: integer, id of book record
+        """
+        documents = self.book_documents(self.db.book.id == book_id)
+        if documents:
+            self.update(documents)
+        else:
+            self.delete_book(book_id)
+
+    def index_creator(self, creator_id):
+        """Update the books of a creator in the index.
+
+        Args:
+            creator_id: integer, id of creator record
+        """
+        self.update(self.book_documents(self.db.book.creator_id == creator_id))
+
+    def rebuild(self):
+        """Rebuild the index from all books."""
+        self.clear()
+        self.update(self.book_documents())
+
+    @abstractmethod
+    def search(self, keywords, limit=FULLTEXT_MAX_HITS):
+        """Search the index.
+
+        Args:
+            keywords: string, the search terms. All terms must match, each
+                as a word prefix.
+            limit: integer, maximum number of hits returned.
+
+        Returns:
+            list of tuples (book_id, score), best hits first.
+        """
+
+    @abstractmethod
+    def update(self, documents):
+        """Add or update documents in the index.
+
+        Args:
+            documents: list of dicts, as returned by book_documents()
+        """
+
+
+class LikeIndex(FullTextIndex):
+    """Class representing a full text index implemented with LIKE queries.
+
+    There is no index to maintain. Searches scan the book and creator
+    tables so this backend is only suitable for small catalogues.
+    """
+
+    def clear(self):
+        pass
+
+    def delete_book(self, book_id):
+        pass
+
+    def search(self, keywords, limit=FULLTEXT_MAX_HITS):
+        db = self.db
+        terms = search_terms(keywords)
+        if not terms:
+            return []
+        fields = {
+            'name': db.book.name,
+            'creator_name': db.auth_user.name,
+            'description': db.book.description,
+            'bio': db.creator.bio,
+        }
+        queries = []
+        for term in terms:
+            queries.append(reduce(
+                lambda x, y: x | y,
+                [fields[x].contains(term) for x, unused_w in COLUMNS]
+            ))
+        query = reduce(lambda x, y: x & y, queries)
+        hits = []
+        for document in self.book_documents(query):
+            score = 0.0
+            for column, weight in COLUMNS:
+                text = document[column].decode('utf-8', 'replace').lower()
+                score += weight * sum([text.count(x) for x in terms])
+            hits.append((document['book_id'], score))
+        hits.sort(key=lambda x: (-x[1], x[0]))
+        return hits[:limit]
+
+    def update(self, documents):
+        pass
+
+
+class SQLiteFTSIndex(FullTextIndex):
+    """Class representing a full text index in an SQLite FTS4 table.
+
+    The table is created on first use, empty, books are added as they are
+    created or updated. Use rebuild() to index existing books, see
+    private/bin/rebuild_fulltext.py. The docid of each row is the book id.
+    """
+
+    _ready = set()                      # uris of databases with the table
+
+    def clear(self):
+        self.create()
+        self.db.executesql('DELETE FROM {t};'.format(t=FULLTEXT_TABLE))
+
+    def create(self):
+        """Create the index table if it doesn't exist."""
+        # W0212: *Access to a protected member %%s of a client class*
+        # pylint: disable=W0212
+        uri = self.db._uri
+        if uri in self._ready:
+            return
+        columns = [x for x, unused_w in COLUMNS]
+        self.db.executesql(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS {t} USING fts4({c});'.format(
+                t=FULLTEXT_TABLE, c=', '.join(columns))
+        )
+        self._ready.add(uri)
+
+    def delete_book(self, book_id):
+        self.create()
+        self.db.executesql(
+            'DELETE FROM {t} WHERE docid = ?;'.format(t=FULLTEXT_TABLE),
+            placeholders=(int(book_id),)
+        )
+
+    def search(self, keywords, limit=FULLTEXT_MAX_HITS):
+        terms = search_terms(keywords)
+        if not terms:
+            return []
+        self.create()
+        match = ' '.join([x + '*' for x in terms]).encode('utf-8')
+        rows = self.db.executesql(
+            "SELECT docid, matchinfo({t}, 'pcx') FROM {t} WHERE {t} MATCH ?;"
+            .format(t=FULLTEXT_TABLE),
+            placeholders=(match,)
+        )
+        weights = [x for unused_c, x in COLUMNS]
+        hits = [(r[0], matchinfo_score(r[1], weights)) for r in rows]
+        hits.sort(key=lambda x: (-x[1], x[0]))
+        return hits[:limit]
+
+    def update(self, documents):
+        self.create()
+        columns = [x for x, unused_w in COLUMNS]
+        sql = 'INSERT INTO {t} (docid, {c}) VALUES (?, {p});'.format(
+            t=FULLTEXT_TABLE,
+            c=', '.join(columns),
+            p=', '.join(['?'] * len(columns)),
+        )
+        for document in documents:
+            self.db.executesql(
+                'DELETE FROM {t} WHERE docid = ?;'.format(t=FULLTEXT_TABLE),
+                placeholders=(document['book_id'],)
+            )
+            self.db.executesql(
+                sql,
+                placeholders=[document['book_id']] + \
+                    [document[x] for x in columns]
+            )
+
+
+BACKENDS = {
+    'like': LikeIndex,
+    'sqlite': SQLiteFTSIndex,
+}
+
+
+def fulltext_index(db, backend=None):
+    """Return the full text index of a database.
+
+    Args:
+        db: gluon.dal.DAL instance
+        backend: string, one of BACKENDS. Default is the fulltext_backend
+            local setting, or, if not set, 'sqlite' for sqlite databases
+            and 'like' otherwise.
+
+    Returns:
+        FullTextIndex subclass instance.
+    """
+    # W0212: *Access to a protected member %%s of a client class*
+    # pylint: disable=W0212
+    if not backend:
+        local_settings = current.app.local_settings \
+            if getattr(current, 'app', None) else None
+        backend = local_settings.fulltext_backend if local_settings else None
+    if not backend:
+        backend = 'sqlite' if db._adapter.dbengine == 'sqlite' else 'like'
+    if backend not in BACKENDS:
+        raise SyntaxError('Invalid full text backend: {b}'.format(b=backend))
+    return BACKENDS[backend](db)
+
+
+def index_profile(form):
+    """Update the books of a user in the full text index.
+
+    Args:
+        form: form with form.vars values, form.vars.id is the auth_user id.
+
+    Usage:
+        auth.settings.profile_onaccept = lambda f: index_profile(f)
+    """
+    if not form.vars.id:
+        return
+    db = current.app.db
+    creator = db(db.creator.auth_user_id == form.vars.id).select(
+        db.creator.id).first()
+    if creator:
+        fulltext_index(db).index_creator(creator.id)
+
+
+def matchinfo_score(matchinfo, weights):
+    """Return the score of an SQLite FTS4 hit.
+
+    Each column scores its weight times the share of all hits of a phrase
+    found in the row.
+
+    Args:
+        matchinfo: buffer, as returned by matchinfo(table, 'pcx')
+        weights: list of floats, one per column.
+
+    Returns:
+        float, score
+    """
+    data = str(matchinfo)
+    values = struct.unpack('={n}I'.format(n=len(data) // 4), data)
+    phrases, columns = values[0], values[1]
+    score = 0.0
+    for i in range(phrases):
+        for j in range(columns):
+            offset = 2 + (i * columns + j) * 3
+            row_hits, all_hits = values[offset], values[offset + 1]
+            if row_hits:
+                score += weights[j] * row_hits / float(all_hits)
+    return score
+
+
+def search_terms(keywords):
+    """Return the search terms of keywords.
+
+    Args:
+        keywords: string, as entered by the user.
+
+    Returns:
+        list of unicode strings, lowercase words.
+    """
+    if not keywords:
+        return []
+    if isinstance(keywords, str):
+        keywords = keywords.decode('utf-8', 'replace')
+    return regex_term.findall(keywords.lower())
@@ -5,14 +5,54 @@
 
 Classes and functions related to images.
 """
+import cgi
+import hashlib
 import os
 import re
+import tempfile
 from PIL import Image
 from gluon import *
+from gluon.dal import REGEX_STORE_PATTERN
 from gluon.globals import Response
 from gluon.streamer import DEFAULT_CHUNK_SIZE
 from gluon.contenttype import contenttype
 
+RESIZE_RETRIES = 2                      # Number of retries of failed jobs
+RESIZE_TIMEOUT = 300                    # Job timeout in seconds
+
+# Upload names are unique per content, a stored image never changes.
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# The original is served in place of a size not resized yet. Clients
+# revalidate so they get the size once it is, its etag differs.
+FALLBACK_CACHE_CONTROL = 'no-cache'
+
+# Delivery modes: the front-end server sends the file.
+DELIVERY_HEADERS = {
+    'x-accel-redirect': 'X-Accel-Redirect',     # nginx
+    'x-sendfile': 'X-Sendfile',                 # apache mod_xsendfile, lighttpd
+}
+
+# Responsive ladder, see set_image_ladder(). The ladder sizes are limited by
+# width, the height is at most LADDER_ASPECT_LIMIT times the width.
+IMAGE_WIDTHS = [320, 640, 960, 1280, 1920]
+IMAGE_ENCODINGS = ['jpeg', 'webp']
+LADDER_ASPECT_LIMIT = 4
+LADDER_SIZE = re.compile(r'^w\d+$')
+# The sizes attribute of an image with a srcset: the image is displayed no
+# wider than the original, {w} is its width.
+SRCSET_SIZES = '(max-width: {w}px) 100vw, {w}px'
+
+# Formats sizes can be saved in: {PIL format: (extension, content type)}
+SAVE_FORMATS = {
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'WEBP': ('.webp', 'image/webp'),
+}
+
+SAVE_OPTIONS = {
+    'JPEG': dict(progressive=True, optimize=True, quality=85),
+    'WEBP': dict(quality=80),
+}
+
 
 class Downloader(Response):
     """Class representing an image downloader"""
@@ -21,9 +61,16 @@ class Downloader(Response):
         """
         Adapted from Response.download.
 
-        request.vars.size: string, one of 'original' (default), 'medium', or
-                'thumb'. If provided the image is streamed from a subdirectory
-                 with that name.
+        request.vars.size: string, one of 'original' (default), or an
+                UploadImage.sizes key, eg 'medium' or 'thumb'. If provided the
+                image is streamed from a subdirectory with that name.
+
+        If the size has a WebP alternate, see set_image_ladder(), and the
+        browser accepts image/webp, the alternate is streamed instead.
+
+        The stored name is a hash of the image, see store_image(). The
+        filename of the attachment is the uploaded filename, kept in the
+        <field>_filename field of the table, eg creator.image_filename.
         """
         current.session.forget(current.response)
 
@@ -45,21 +92,108 @@ class Downloader(Response):
             raise HTTP(404)
 
         # Customization: start
+        size = 'original'
+        headers = self.headers
         if request.vars.size and request.vars.size in UploadImage.sizes:
-            resized = stream.replace('/original/', '/{s}/'.format(s=request.vars.size))
-            if os.path.exists(resized):
-                stream = resized
+            resizer = UploadImage(field, name)
+            sizes = [request.vars.size]
+            alternate = UploadImage.alternates.get(request.vars.size)
+            if alternate:
+                headers['Vary'] = 'Accept'
+                if 'image/webp' in (request.env.http_accept or ''):
+                    sizes.insert(0, alternate)
+            for try_size in sizes:
+                resized = resizer.fullname(size=try_size)
+                if os.path.exists(resized):
+                    stream = resized
+                    size = try_size
+                    break
+
+        requested = request.vars.size or 'original'
+        if size == requested \
+                or size == UploadImage.alternates.get(requested):
+            headers['Cache-Control'] = CACHE_CONTROL
+        else:
+            headers['Cache-Control'] = FALLBACK_CACHE_CONTROL
+        headers['ETag'] = etag(name, size=size)
+        if not_modified(request, headers['ETag']):
+            not_modified_headers = {
+                'Cache-Control': headers['Cache-Control'],
+                'ETag': headers['ETag'],
+            }
+            if 'Vary' in headers:
+                not_modified_headers['Vary'] = headers['Vary']
+            raise HTTP(304, **not_modified_headers)
+
+        image_format = UploadImage.formats.get(size)
+        if image_format:
+            headers['Content-Type'] = SAVE_FORMATS[image_format][1]
+        else:
+            headers['Content-Type'] = contenttype(name)
         # Customization: end
 
-        headers = self.headers
-        headers['Content-Type'] = contenttype(name)
         if download_filename is None:
+            filename_field = '{f}_filename'.format(f=f)
+            if filename_field in db[t].fields:
+                record = db(field == name).select(
+                    db[t][filename_field],
+                    limitby=(0, 1),
+                ).first()
+                if record and record[filename_field]:
+                    filename = record[filename_field]
             download_filename = filename
         if attachment:
             headers['Content-Disposition'] = \
                 'attachment; filename="%s"' % download_filename.replace('"', '\"')
+
+        app = getattr(current, 'app', None)
+        local_settings = app.local_settings if app else None
+        if local_settings and local_settings.image_delivery:
+            self.delegate(
+                stream,
+                field,
+                local_settings.image_delivery,
+                prefix=local_settings.image_delivery_prefix,
+            )
         return self.stream(stream, chunk_size=chunk_size, request=request)
 
+    def delegate(self, stream, field, delivery, prefix=None):
+        """Hand the file off to the front-end server.
+
+        The response has no body. The front-end server, apache with
+        mod_xsendfile, lighttpd or nginx, sends the file indicated in the
+        header.
+
+        Args:
+            stream: string, full path name of the file.
+            field: gluon.dal.Field instance, upload field of the image.
+            delivery: string, one of DELIVERY_HEADERS keys.
+            prefix: string, x-accel-redirect only, the nginx internal location
+                mapped to the uploads folder. Default '/protected'.
+
+        Raises:
+            HTTP(200) with the delivery header.
+            HTTP(404) if the file does not exist.
+        """
+        if delivery not in DELIVERY_HEADERS:
+            raise SyntaxError(
+                'Invalid image_delivery setting: {d}'.format(d=delivery))
+        if not os.path.isfile(stream):
+            raise HTTP(404)
+        if delivery == 'x-accel-redirect':
+            # Uploads are stored in uploads/<size>/...
+            uploads = os.path.dirname(os.path.abspath(field.uploadfolder))
+            relative = os.path.relpath(os.path.abspath(stream), uploads)
+            location = '/'.join([
+                (prefix or '/protected').rstrip('/'),
+                relative.replace(os.sep, '/'),
+            ])
+        else:
+            location = os.path.abspath(stream)
+        headers = self.headers
+        headers[DELIVERY_HEADERS[delivery]] = location
+        raise HTTP(200, '', **headers)
+
 
 class UploadImage(object):
     """Class representing an image resizer"""
@@ -69,6 +203,11 @@ class UploadImage(object):
         'medium': (500, 500),
         'thumb': (170, 170),
     }
+    # Sizes saved in a format other than the original's, see
+    # set_image_ladder(). {size: PIL format}
+    formats = {}
+    # Alternate encodings of sizes. {size: alternate size}
+    alternates = {}
 
     thumb_shrink_threshold = 120
     thumb_shrink_multiplier = 0.80
@@ -85,6 +224,7 @@ class UploadImage(object):
         self.image_name = image_name
         self._images = {}               # {'size': Image instance}
         self._dimensions = {}           # {'size': (w, h)}
+        self._formats = {}              # {'size': 'JPEG'}
 
     def delete(self, size):
         """Delete a version of the image
@@ -96,6 +236,8 @@ class UploadImage(object):
         fullname = self.fullname(size=size)
         if os.path.exists(fullname):
             os.unlink(fullname)
+        set_image_metadata(
+            self.field._db, self.image_name, {size: None}, commit=False)
 
     def delete_all(self):
         """Delete all sizes."""
@@ -111,6 +253,12 @@ class UploadImage(object):
                     dict
         """
         if not self._dimensions or size not in self._dimensions:
+            stored = image_metadata(
+                self.field._db, [self.image_name], size=size)
+            if self.image_name in stored:
+                row = stored[self.image_name][size]
+                self._dimensions[size] = (row.width, row.height)
+                return self._dimensions[size]
             im = self.pil_image(size=size)
             if im:
                 self._dimensions[size] = im.size
@@ -119,15 +267,68 @@ class UploadImage(object):
         return self._dimensions[size]
 
     def fullname(self, size='original'):
-        """Return the fullname of the image."""
+        """Return the fullname of the image.
+
+        If the size is saved in another format than the original, the
+        extension of the format is appended, eg
+            .../w640_webp/creator.image.944cdb07605150ca.6672.jpg.webp
+        """
         unused_file_name, fullname = self.field.retrieve(
             self.image_name,
             nameonly=True,
         )
         if size != 'original':
             fullname = fullname.replace('/original/', '/{s}/'.format(s=size))
+        if size in self.formats:
+            extension = SAVE_FORMATS[self.formats[size]][0]
+            if not fullname.lower().endswith(extension):
+                fullname = fullname + extension
         return fullname
 
+    def metadata(self, size='original'):
+        """Return the metadata of the image file of the indicated size.
+
+        The dimensions and format recorded when the image was resized are
+        used if available, otherwise the image header is read. The database
+        is not accessed.
+
+        Args:
+            size: string, name of size, must one of the keys of the cls.sizes
+                    dict or 'original'
+
+        Returns:
+            dict, {'width': w, 'height': h, 'bytes': b, 'format': f,
+                'checksum': md5 hexdigest} or None if the file does not exist.
+        """
+        filename = self.fullname(size=size)
+        if not os.path.exists(filename):
+            return None
+        if not self._dimensions.get(size) or size not in self._formats:
+            im = Image.open(filename)
+            self._dimensions[size] = im.size
+            self._formats[size] = im.format
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), ''):
+                md5.update(chunk)
+        width, height = self._dimensions[size]
+        return dict(
+            width=width,
+            height=height,
+            bytes=os.stat(filename).st_size,
+            format=self._formats[size],
+            checksum=md5.hexdigest(),
+        )
+
+    def metadata_all(self):
+        """Return the metadata of the original and all sizes.
+
+        Returns:
+            dict, {size: metadata}, see metadata()
+        """
+        sizes = ['original'] + self.sizes.keys()
+        return dict([(x, self.metadata(size=x)) for x in sizes])
+
     def pil_image(self, size='original'):
         """Return a PIL Image instance representing the image.
 
@@ -150,30 +351,171 @@ class UploadImage(object):
             size: string, name of size, must one of the keys of the cls.sizes
                     dict
         """
-        original_filename = self.fullname(size='original')
-        sized_filename = self.fullname(size=size)
-        sized_path = os.path.dirname(sized_filename)
-        if not os.path.exists(sized_path):
-            os.makedirs(sized_path)
-        im = Image.open(original_filename)
-        im.thumbnail(self.sizes[size], Image.ANTIALIAS)
-        im.save(sized_filename)
-        # self.dimensions[size] = im.size
-        return sized_filename
+        return self.resize_sizes([size])[size]
 
     def resize_all(self):
         """Resize all sizes."""
-        for size in self.sizes.keys():
-            self.resize(size)
+        return self.resize_sizes(self.sizes.keys())
+
+    def resize_sizes(self, sizes):
+        """Resize the image to several sizes.
+
+        The original is decoded once. JPEG originals are decoded at a reduced
+        resolution, as large as the largest size requires. Sizes are created
+        from largest to smallest, each derived from the previous one when it
+        is at least as large, eg thumb is derived from medium. The dimensions
+        of the original and each size are recorded so dimensions() does not
+        have to reopen the files. Sizes in cls.formats are saved in that
+        format, see save_image().
+
+        Args:
+            sizes: list of strings, names of sizes, each must be one of the
+                keys of the cls.sizes dict.
+
+        Returns:
+            dict, {size: name of sized file}
+        """
+        sizes = sorted(
+            sizes,
+            key=lambda x: self.sizes[x][0] * self.sizes[x][1],
+            reverse=True
+        )
+        original_filename = self.fullname(size='original')
+        im = Image.open(original_filename)
+        self._dimensions['original'] = im.size
+        self._formats['original'] = im.format
+        if im.format == 'JPEG':
+            im.draft(im.mode, (
+                max([self.sizes[x][0] for x in sizes]),
+                max([self.sizes[x][1] for x in sizes]),
+            ))
+        im.load()
+
+        filenames = {}
+        previous = None                 # (box, Image instance)
+        for size in sizes:
+            box = self.sizes[size]
+            source = im
+            if previous and previous[0][0] >= box[0] \
+                    and previous[0][1] >= box[1]:
+                source = previous[1]
+            sized_im = source.copy()
+            sized_im.thumbnail(box, Image.ANTIALIAS)
+
+            sized_filename = self.fullname(size=size)
+            sized_path = os.path.dirname(sized_filename)
+            if not os.path.exists(sized_path):
+                os.makedirs(sized_path)
+            save_image(
+                sized_im, sized_filename, image_format=self.formats.get(size))
+            self._dimensions[size] = sized_im.size
+            self._formats[size] = self.formats.get(size, im.format)
+            if size in self._images:
+                del self._images[size]
+            filenames[size] = sized_filename
+            previous = (box, sized_im)
+        return filenames
+
+
+def etag(image_name, size='original'):
+    """Return the ETag of an image.
+
+    Args:
+        image_name: string, name of image as stored in db, eg
+            book_page.image.801685b627e099e.300332e6a7067.jpg
+        size: string, size of the image, one of 'original' or an
+            UploadImage.sizes key.
+
+    Returns:
+        string, quoted entity tag
+    """
+    return '"{h}"'.format(
+        h=hashlib.md5('{n}:{s}'.format(n=image_name, s=size)).hexdigest())
+
+
+def image_metadata(db, image_names, size=None):
+    """Return the stored metadata of images.
+
+    Args:
+        db: gluon.dal.DAL instance
+        image_names: list of strings, names of images as stored in their
+            upload fields.
+        size: string, if provided only metadata of this size is returned.
+
+    Returns:
+        dict, {image_name: {size: Row instance of image_size record}}
+            Images with no metadata are not included.
+    """
+    if not image_names:
+        return {}
+    query = (db.image_size.image.belongs(image_names))
+    if size:
+        query = query & (db.image_size.size == size)
+    metadata = {}
+    for row in db(query).select(db.image_size.ALL):
+        if row.image not in metadata:
+            metadata[row.image] = {}
+        metadata[row.image][row.size] = row
+    return metadata
+
+
+def image_srcset(image_name, metadata):
+    """Return the srcset of an image.
+
+    The srcset lists the ladder sizes of the image, see set_image_ladder(),
+    and the original if it is wider. Sizes with the same width as a smaller
+    size, ie the original is narrower than the ladder width, are not listed.
+
+    Args:
+        image_name: string, name of image as stored in db.
+        metadata: dict, {size: Row instance of image_size record}, the
+            stored metadata of the image, see image_metadata().
+
+    Returns:
+        tuple (srcset, width): srcset, string, eg
+                '/images/download/...?size=w320 320w, ...'
+            width, integer, width of the original.
+            (None, None) if the image has no ladder sizes.
+    """
+    if 'original' not in metadata:
+        return (None, None)
+    ladder = sorted(
+        [x for x in metadata
+            if x in UploadImage.sizes and LADDER_SIZE.match(x)],
+        key=lambda x: (UploadImage.sizes[x][0], metadata[x].width),
+    )
+    if not ladder:
+        return (None, None)
+    candidates = []
+    for size in ladder + ['original']:
+        width = metadata[size].width
+        if not width or (candidates and width <= candidates[-1][1]):
+            continue
+        candidates.append((size, width))
+    srcset = ', '.join([
+        '{u} {w}w'.format(
+            u=URL(c='images', f='download', args=image_name, vars={'size': x}),
+            w=w,
+        )
+        for x, w in candidates
+    ])
+    return (srcset, metadata['original'].width)
 
 
-def img_tag(field, size='original', img_attributes=None):
+def img_tag(field, size='original', img_attributes=None, metadata=None):
     """Return an image HTML tag suitable for an resizeable image.
 
+    Images of size 'original' with ladder sizes, see set_image_ladder(),
+    have srcset and sizes attributes so the browser downloads the smallest
+    adequate file.
+
     Args:
         field: gluon.dal.Field instance, eg db.creator.image
         size: string, the image size
         img_attributes: dict, passed on as IMG(**img_attributes)
+        metadata: dict, {image_name: {size: Row}} as returned by
+            image_metadata(). Provide to avoid a query per image when
+            displaying several. If None, the metadata is queried.
     """
     attributes = {}
 
@@ -190,6 +532,18 @@ def img_tag(field, size='original', img_attributes=None):
                 vars={'size': size},
             ),
         ))
+
+        if size == 'original' and isinstance(field, basestring):
+            if metadata is None:
+                app = getattr(current, 'app', None)
+                db = app.db if app else None
+                metadata = image_metadata(db, [field]) if db else {}
+            srcset, width = image_srcset(field, metadata.get(field, {}))
+            if srcset:
+                attributes.update(dict(
+                    _srcset=srcset,
+                    _sizes=SRCSET_SIZES.format(w=width),
+                ))
     else:
         tag = DIV
 
@@ -210,13 +564,307 @@ def img_tag(field, size='original', img_attributes=None):
     return tag(**attributes)
 
 
-def set_thumb_dimensions(db, book_page_id, dimensions):
+def not_modified(request, entity_tag):
+    """Return whether the client's cached copy of an image is current.
+
+    The image file is not accessed. Stored images never change so any
+    If-Modified-Since date is current.
+
+    Args:
+        request: gluon.globals.Request instance
+        entity_tag: string, ETag of the image, see etag()
+
+    Returns:
+        True if the request can be answered with 304 Not Modified.
+    """
+    if request.env.http_if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        tags = [x.strip() for x in request.env.http_if_none_match.split(',')]
+        return '*' in tags or entity_tag in tags \
+            or 'W/' + entity_tag in tags
+    return bool(request.env.http_if_modified_since)
+
+
+def queue_resize(field, image_name, record_id=None):
+    """Queue a background job to create the sizes of an uploaded image.
+
+    The job is run by a gluon.scheduler worker, eg
+        python web2py.py -K zcomix
+    If no scheduler is configured, the image is resized immediately.
+
+    Args:
+        field: gluon.dal.Field instance, eg db.book_page.image
+        image_name: string, the name of the image as stored in field.
+        record_id: integer, id of the record the image is associated with.
+
+    Returns:
+        Storage, as returned by Scheduler.queue_task(), or None if the image
+            was resized immediately or its sizes already exist.
+    """
+    metadata = image_metadata(field._db, [image_name])
+    if image_name in metadata \
+            and set(metadata[image_name]) >= set(UploadImage.sizes):
+        # A shared image, see store_image(). The sizes already exist.
+        if str(field) == 'book_page.image' and record_id:
+            thumb = metadata[image_name]['thumb']
+            set_thumb_dimensions(
+                field._db, record_id, (thumb.width, thumb.height))
+        return
+
+    scheduler = current.app.scheduler
+    if not scheduler:
+        resize_image(field.tablename, field.name, image_name, record_id)
+        return
+
+    ret = scheduler.queue_task(
+        resize_image,
+        pvars=dict(
+            tablename=field.tablename,
+            fieldname=field.name,
+            image_name=image_name,
+            record_id=record_id,
+        ),
+        task_name='resize_image {n}'.format(n=image_name),
+        timeout=RESIZE_TIMEOUT,
+        retry_failed=RESIZE_RETRIES,
+    )
+    field._db.commit()
+    return ret
+
+
+def set_image_metadata(db, image_name, metadata, commit=True):
+    """Store the metadata of an image.
+
+    Args:
+        db: gluon.dal.DAL instance
+        image_name: string, name of the image as stored in its upload field.
+        metadata: dict, {size: metadata} where metadata is a dict as returned
+            by UploadImage.metadata(). If the metadata of a size is None, the
+            stored metadata for that size is deleted.
+        commit: If True, the changes are committed.
+    """
+    for size, data in metadata.items():
+        query = (db.image_size.image == image_name) & \
+            (db.image_size.size == size)
+        if data is None:
+            db(query).delete()
+            continue
+        values = dict(data)
+        values.update(image=image_name, size=size)
+        db.image_size.update_or_insert(query, **values)
+    if commit:
+        db.commit()
+
+
+def set_image_ladder(widths=None, encodings=None):
+    """Set the ladder sizes of UploadImage.
+
+    A ladder size, eg 'w640', is the image scaled to a width, saved as a
+    progressive JPEG if 'jpeg' is among the encodings, else in the format
+    of the original. If 'webp' is among the encodings, and PIL supports it,
+    each ladder size has a WebP alternate, eg 'w640_webp', streamed to
+    browsers accepting it, see Downloader.
+
+    Args:
+        widths: list of integers or string of comma separated integers, the
+            widths of the ladder. Default IMAGE_WIDTHS. An empty list,
+            string or False disables the ladder.
+        encodings: list of strings or string of comma separated strings,
+            one or both of 'jpeg' and 'webp'. Default IMAGE_ENCODINGS.
+
+    Usage:
+        set_image_ladder(
+            widths=local_settings.image_widths,
+            encodings=local_settings.image_encodings,
+        )
+    """
+    if widths is None:
+        widths = IMAGE_WIDTHS
+    if isinstance(widths, basestring):
+        widths = [x for x in widths.split(',') if x.strip()]
+    elif not isinstance(widths, (list, tuple)):
+        widths = [widths] if widths else []
+    if encodings is None:
+        encodings = IMAGE_ENCODINGS
+    if isinstance(encodings, basestring):
+        encodings = encodings.split(',')
+    encodings = [x.strip().lower() for x in encodings]
+
+    Image.init()
+    webp = 'webp' in encodings and 'WEBP' in Image.SAVE
+
+    # The dicts are shared by the threads of the server. New ones are built
+    # and each is replaced with a single assignment, they are never
+    # modified in place.
+    sizes = dict([
+        (k, v) for k, v in UploadImage.sizes.items()
+        if k not in UploadImage.formats and not LADDER_SIZE.match(k)
+    ])
+    formats = {}
+    alternates = {}
+    for width in sorted(set([int(x) for x in widths])):
+        size = 'w{w}'.format(w=width)
+        sizes[size] = (width, width * LADDER_ASPECT_LIMIT)
+        if 'jpeg' in encodings:
+            formats[size] = 'JPEG'
+        if webp:
+            alternate = '{s}_webp'.format(s=size)
+            sizes[alternate] = sizes[size]
+            formats[alternate] = 'WEBP'
+            alternates[size] = alternate
+    if sizes != UploadImage.sizes:
+        UploadImage.sizes = sizes
+    if formats != UploadImage.formats:
+        UploadImage.formats = formats
+    if alternates != UploadImage.alternates:
+        UploadImage.alternates = alternates
+
+
+def resize_image(tablename, fieldname, image_name, record_id=None):
+    """Create the sizes of an uploaded image.
+
+    This function is the gluon.scheduler task queued by queue_resize().
+
+    Args:
+        tablename: string, name of table, eg 'book_page'
+        fieldname: string, name of upload field, eg 'image'
+        image_name: string, the name of the image as stored in field.
+        record_id: integer, id of the record the image is associated with.
+            If the field is book_page.image, the thumb dimensions of the
+            record are updated.
+
+    Returns:
+        dict, {size: (w, h)} dimensions of the sizes created
+    """
+    db = current.app.db
+    field = db[tablename][fieldname]
+    resizer = UploadImage(field, image_name)
+    if not os.path.exists(resizer.fullname()):
+        # The image was deleted before the job was run.
+        return {}
+    resizer.resize_all()
+    set_image_metadata(db, image_name, resizer.metadata_all(), commit=False)
+    if str(field) == 'book_page.image' and record_id:
+        set_thumb_dimensions(
+            db, record_id, resizer.dimensions(size='thumb'), commit=False)
+    db.commit()
+    return dict([(x, resizer.dimensions(size=x)) for x in resizer.sizes])
+
+
+def save_image(im, filename, image_format=None):
+    """Save a PIL image.
+
+    Formats of SAVE_OPTIONS are saved with those options, eg JPEG files are
+    progressive. The image is converted to a mode the format supports if
+    necessary, eg a PNG with transparency is saved as an RGB JPEG.
+
+    Args:
+        im: PIL Image instance
+        filename: string, name of file to save image in.
+        image_format: string, PIL format, eg 'JPEG'. If None, the format is
+            determined by the extension of filename.
+    """
+    if not image_format:
+        im.save(filename)
+        return
+    if image_format == 'JPEG' and im.mode not in ['L', 'RGB', 'CMYK']:
+        im = im.convert('RGB')
+    elif image_format == 'WEBP' and im.mode not in ['RGB', 'RGBA']:
+        has_alpha = 'A' in im.mode or 'transparency' in im.info
+        im = im.convert('RGBA' if has_alpha else 'RGB')
+    options = SAVE_OPTIONS.get(image_format, {})
+    im.save(filename, format=image_format, **options)
+
+
+def size_names():
+    """Return the names of the sizes an image can be requested in.
+
+    Returns:
+        list of strings, 'original' and the UploadImage.sizes keys, except
+            alternates which are negotiated, see Downloader.
+    """
+    alternates = UploadImage.alternates.values()
+    return ['original'] + sorted(
+        [x for x in UploadImage.sizes.keys() if x not in alternates])
+
+
+def store_image(field, file, filename=None):
+    """Store an uploaded image in a content addressed layout.
+
+    This is the custom_store function of the image upload fields. The file
+    is hashed while it is copied to disk. The stored name is the hash in
+    place of the random uuid key of Field.store(), eg
+        book_page.image.<sha1 hexdigest>.jpg
+    so identical uploads to the field share the original and the sizes.
+    Since they are shared, the files are not deleted with the records, they
+    are purged by private/bin/resize_images.py --purge once unreferenced. The
+    name does not include the uploaded filename, records keep their own in
+    the <field>_filename field, eg db.book_page.image_filename.
+
+    Args:
+        field: gluon.dal.Field instance, eg db.book_page.image
+        file: file object or cgi.FieldStorage instance.
+        filename: string, name of the uploaded file. Default file.name
+
+    Returns:
+        string, name of the image as stored in field.
+    """
+    if isinstance(file, cgi.FieldStorage):
+        filename = filename or file.filename
+        file = file.file
+    elif not filename:
+        filename = file.name
+    m = REGEX_STORE_PATTERN.search(filename)
+    extension = m and m.group('e') or 'txt'
+
+    # Write to the upload folder so the file can be moved into place.
+    tmp_path = os.path.join(field.uploadfolder, str(field))
+    if not os.path.exists(tmp_path):
+        os.makedirs(tmp_path)
+    (fd, tmp_name) = tempfile.mkstemp(prefix='.upload_', dir=tmp_path)
+    checksum = hashlib.sha1()
+    with os.fdopen(fd, 'wb') as f:
+        while True:
+            data = file.read(DEFAULT_CHUNK_SIZE)
+            if not data:
+                break
+            checksum.update(data)
+            f.write(data)
+
+    image_name = '.'.join([str(field), checksum.hexdigest(), extension])
+    resizer = UploadImage(field, image_name)
+    fullname = resizer.fullname()
+    try:
+        # Reuse the stored image. Its files are touched, resize_images.py
+        # --purge keeps files modified within its grace period, so they are
+        # not purged before the record referencing them is committed.
+        os.utime(fullname, None)
+    except OSError:
+        # Not stored, or purged meanwhile.
+        if not os.path.exists(os.path.dirname(fullname)):
+            os.makedirs(os.path.dirname(fullname))
+        os.chmod(tmp_name, 0644)
+        # Concurrent identical uploads rename the same content into place.
+        os.rename(tmp_name, fullname)
+    else:
+        os.unlink(tmp_name)
+        for size in resizer.sizes.keys():
+            try:
+                os.utime(resizer.fullname(size=size), None)
+            except OSError:
+                pass                    # Not resized, or purged
+    return image_name
+
+
+def set_thumb_dimensions(db, book_page_id, dimensions, commit=True):
     """Set the db.book_page.thumb_* dimension values for a page.
 
     Args:
         db: gluon.dal.Dal instance.
         book_page_id: integer, id of book_page record
         dimensions: tuple (w, h), dimensions of thumb image.
+        commit: If True, the update is committed. Set to False to batch
+            several updates in one transaction.
     """
     if not dimensions:
         return
@@ -233,4 +881,5 @@ def set_thumb_dimensions(db, book_page_id, dimensions):
         thumb_h=h,
         thumb_shrink=thumb_shrink
     )
-    db.commit()
+    if commit:
+        db.commit()
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Classes and functions related to book rankings.
+
+A ranking is the list of all books in a search order, eg by views this
+month, materialized in the book_ranking table by the tally job. Each record
+holds the rank and the book and creator columns displayed in the cover
+grid, so a page of the front page is read by a range of ranks of a single
+ranking with no sorting and no joins.
+
+Rankings are as current as the last tally. Deleted books are removed from
+rankings immediately, and the books ranked after them move up one rank, new
+books are added by the next tally.
+"""
+from gluon import *
+from gluon.dal import Row
+
+RANKINGS = [
+    # book fields ranked, descending
+    'contributions_month',
+    'contributions_year',
+    'created_on',
+    'rating_month',
+    'rating_year',
+    'views_month',
+    'views_year',
+]
+RANK_BATCH_SIZE = 500               # Records per bulk insert
+
+
+def delete_book(db, book_id):
+    """Remove a book from the rankings.
+
+    The ranks following those of the book are renumbered so the ranks of
+    a ranking have no gaps, pages are read by a range of ranks.
+
+    Args:
+        db: gluon.dal.DAL instance
+        book_id: integer, id of book record
+    """
+    query = (db.book_ranking.book_id == book_id)
+    ranks = db(query).select(
+        db.book_ranking.ranking,
+        db.book_ranking.rank_no,
+    )
+    db(query).delete()
+    for rank in ranks:
+        query = (db.book_ranking.ranking == rank.ranking) & \
+            (db.book_ranking.rank_no > rank.rank_no)
+        db(query).update(rank_no=db.book_ranking.rank_no - 1)
+
+
+def rank_books(db):
+    """Rank all books in every ranking.
+
+    Existing rankings are replaced. The caller commits.
+
+    Args:
+        db: gluon.dal.DAL instance
+
+    Returns:
+        integer, number of books ranked.
+    """
+    fields = [
+        db.book.id,
+        db.book.name,
+        db.book.release_date,
+        db.book.reader,
+        db.book.created_on,
+        db.creator.id,
+        db.auth_user.name,
+    ]
+    left = [
+        db.creator.on(db.book.creator_id == db.creator.id),
+        db.auth_user.on(db.creator.auth_user_id == db.auth_user.id),
+    ]
+    db(db.book_ranking).delete()
+    ranked = 0
+    for ranking in RANKINGS:
+        # The order is that of the search grid, see Search.set().
+        ranked_fields = [db.book[ranking]] if ranking != 'created_on' else []
+        books = db(db.book).select(
+            *(fields + ranked_fields),
+            left=left,
+            orderby=[~db.book[ranking], db.book.id]
+        )
+        records = []
+        for rank_no, r in enumerate(books, 1):
+            records.append(dict(
+                ranking=ranking,
+                rank_no=rank_no,
+                book_id=r.book.id,
+                name=r.book.name,
+                release_date=r.book.release_date,
+                reader=r.book.reader,
+                created_on=r.book.created_on,
+                creator_id=r.creator.id,
+                creator_name=r.auth_user.name,
+                value=r.book[ranking] if ranking != 'created_on' else 0,
+            ))
+        for i in range(0, len(records), RANK_BATCH_SIZE):
+            db.book_ranking.bulk_insert(records[i:i + RANK_BATCH_SIZE])
+        ranked = len(records)
+    return ranked
+
+
+def ranked_rows(db, ranking, start, count):
+    """Return the rows of a range of ranks.
+
+    The rows are shaped like the rows of the search grid, ie with book,
+    creator and auth_user members.
+
+    Args:
+        db: gluon.dal.DAL instance
+        ranking: string, one of RANKINGS
+        start: integer, number of ranks preceding the first row.
+        count: integer, maximum number of rows.
+
+    Returns:
+        list of Row instances
+    """
+    query = (db.book_ranking.ranking == ranking) & \
+        (db.book_ranking.rank_no > start) & \
+        (db.book_ranking.rank_no <= start + count)
+    records = db(query).select(
+        db.book_ranking.ALL,
+        orderby=db.book_ranking.rank_no,
+    )
+    integer = db.book[ranking].type == 'integer'
+    rows = []
+    for r in records:
+        book = Row(
+            id=r.book_id,
+            name=r.name,
+            release_date=r.release_date,
+            reader=r.reader,
+            created_on=r.created_on,
+        )
+        if ranking != 'created_on':
+            book[ranking] = int(r.value) if integer else r.value
+        rows.append(Row(
+            book=book,
+            creator=Row(id=r.creator_id),
+            auth_user=Row(name=r.creator_name),
+        ))
+    return rows
+
+
+def ranking_size(db, ranking):
+    """Return the number of books in a ranking.
+
+    Args:
+        db: gluon.dal.DAL instance
+        ranking: string, one of RANKINGS
+
+    Returns:
+        integer, number of books
+    """
+    max_rank = db.book_ranking.rank_no.max()
+    query = (db.book_ranking.ranking == ranking)
+    return db(query).select(max_rank).first()[max_rank] or 0
+
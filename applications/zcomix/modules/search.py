@@ -4,11 +4,103 @@
 """
 
 Search classes and functions.
+
+Search results are paginated by a keyset cursor rather than an offset. The
+cursor identifies the last row of the previous page by its orderby value and
+book id, so a page is read with an indexed range condition instead of
+scanning and discarding the rows of all preceding pages.
 """
+import datetime
 from gluon import *
-from applications.zcomix.modules.books import read_link
+from applications.zcomix.modules.books import \
+    cover_images, \
+    read_link
+from applications.zcomix.modules.caching import invalidate_book
+from applications.zcomix.modules.fulltext import fulltext_index
+from applications.zcomix.modules.rankings import \
+    delete_book as delete_ranked_book, \
+    ranked_rows, \
+    ranking_size
 from applications.zcomix.modules.stickon.sqlhtml import LocalSQLFORM
 
+COUNT_CACHE_SECONDS = 300           # Seconds result counts are cached.
+
+
+class Paginator(object):
+    """Class representing the paginator of search results."""
+
+    def __init__(self, request, start=0, paginate=0, total=0,
+                 prev_cursor=None, next_cursor=None):
+        """Constructor
+
+        Args:
+            request: gluon.globals.Request instance.
+            start: integer, number of results preceding the page.
+            paginate: integer, number of results per page.
+            total: integer, number of results, 0 if not known.
+            prev_cursor: string, cursor of the previous page, '' for the
+                first page, None if there is no previous page.
+            next_cursor: string, cursor of the next page, None if there is
+                no next page.
+        """
+        self.request = request
+        self.page = start // paginate + 1 if paginate else 1
+        self.page_count = None
+        if paginate and total:
+            self.page_count = max((total + paginate - 1) // paginate,
+                                  self.page)
+        self.prev_url = self.url(prev_cursor) \
+            if prev_cursor is not None else None
+        self.next_url = self.url(next_cursor) \
+            if next_cursor is not None else None
+
+    def __nonzero__(self):
+        return bool(self.prev_url or self.next_url)
+
+    def as_html(self):
+        """Return the paginator as html.
+
+        Returns:
+            DIV instance, or empty string if there are no other pages.
+        """
+        if not self:
+            return ''
+        return DIV(self.links(), _class='web2py_paginator grid_header ')
+
+    def links(self):
+        """Return the links of the paginator.
+
+        Returns:
+            UL instance
+        """
+        links = UL()
+        if self.prev_url:
+            links.append(LI(A('<', _href=self.prev_url, cid=self.request.cid)))
+        if self.page_count:
+            links.append(LI(
+                'page {p} of {c}'.format(p=self.page, c=self.page_count),
+                _class='current'
+                ))
+        if self.next_url:
+            links.append(LI(A('>', _href=self.next_url, cid=self.request.cid)))
+        return links
+
+    def url(self, cursor):
+        """Return the url of the page of a cursor.
+
+        Args:
+            cursor: string, the cursor of the page, '' for the first page.
+
+        Returns:
+            string, url
+        """
+        link_vars = dict(self.request.vars)
+        link_vars.pop('page', None)
+        link_vars.pop('after', None)
+        if cursor:
+            link_vars['after'] = cursor
+        return URL(r=self.request, vars=link_vars)
+
 
 class Search(object):
     """Class representing a search grid"""
@@ -46,21 +138,54 @@ class Search(object):
 
     def __init__(self):
         """Constructor"""
+        self.cover_images = {}
         self.grid = None
+        self.next_cursor = None
         self.orderby_field = None
         self.paginate = 0
+        self.prev_cursor = None
+        self.rows = []
+        self.start = 0
+        self.total = 0
 
-    def set(self, db, request, grid_args=None):
-        """Set the grid.
+    def fields(self, db):
+        """Return the book and creator fields of the search results.
 
         Args:
             db: gluon.dal.DAL instance
-            request: gluon.globals.Request instance.
-            grid_args: dict of SQLFORM.grid arguments.
+
+        Returns:
+            list of gluon.dal.Field instances
         """
-        # C0103: *Invalid name "%%s" (should match %%s)*
-        # pylint: disable=C0103
+        return [
+            db.book.id,
+            db.book.name,
+            db.book.release_date,
+            db.book.contributions_year,
+            db.book.contributions_month,
+            db.book.rating_year,
+            db.book.rating_month,
+            db.book.views_year,
+            db.book.views_month,
+            db.book.created_on,
+            db.book.reader,
+            db.creator.id,
+            ]
+
+    def filters(self, db, request):
+        """Return the query of the search filters.
+
+        Args:
+            db: gluon.dal.DAL instance
+            request: gluon.globals.Request instance.
 
+        Returns:
+            tuple (query, creator, editable)
+                query: gluon.dal.Query instance
+                creator: Row instance, the creator the books are filtered
+                    by, or None
+                editable: True if the books are the user's own, editable.
+        """
         queries = []
 
         editable = False
@@ -85,16 +210,29 @@ class Search(object):
             queries.append((db.book.release_date != None))
 
         if request.vars.kw:
-            queries.append(
-                (db.book.name.contains(request.vars.kw)) | \
-                (db.auth_user.name.contains(request.vars.kw))
-                )
+            # Results are limited to the best full text hits, and shown in
+            # the requested order.
+            hits = fulltext_index(db).search(request.vars.kw)
+            queries.append(db.book.id.belongs([x[0] for x in hits]))
 
         if not queries:
-            queries.append(db.book)
+            queries.append(db.book.id > 0)
 
-        query = reduce(lambda x, y: x & y, queries) if queries else None
+        query = reduce(lambda x, y: x & y, queries)
+        return (query, creator, editable)
+
+    def ordering(self, request):
+        """Return the order of the search results.
+
+        Args:
+            request: gluon.globals.Request instance.
 
+        Returns:
+            tuple (orderby_field, fieldname)
+                orderby_field: dict, one of self.order_fields values
+                fieldname: string, name of the book field results are
+                    ordered by, descending.
+        """
         period = 'month' if request.vars.period == 'month' else 'year'
 
         if request.vars.o and request.vars.o in self.order_fields.keys():
@@ -102,37 +240,76 @@ class Search(object):
         else:
             orderby_field = self.order_fields['views']
 
-        self.orderby_field = orderby_field
-
         if orderby_field['periods']:
             orderby_fieldname = '{f}_{p}'.format(
                     f=orderby_field['field'], p=period)
         else:
             orderby_fieldname = orderby_field['field']
+        return (orderby_field, orderby_fieldname)
+
+    def paginator(self, request):
+        """Return the paginator of the results.
 
-        orderby = [~db[orderby_field['table']][orderby_fieldname]]
+        Args:
+            request: gluon.globals.Request instance.
+
+        Returns:
+            Paginator instance
+        """
+        return Paginator(
+            request,
+            start=self.start,
+            paginate=self.paginate,
+            total=self.total,
+            prev_cursor=self.prev_cursor,
+            next_cursor=self.next_cursor,
+            )
+
+    def set(self, db, request, grid_args=None):
+        """Set the grid.
+
+        The grid shows the page following the cursor request.vars.after, or
+        the first page if there is none. The cursors of the previous and
+        next pages are set in self.prev_cursor and self.next_cursor. These
+        are None if there is no such page. The previous cursor of the second
+        page is an empty string, ie the first page has no cursor.
+
+        Args:
+            db: gluon.dal.DAL instance
+            request: gluon.globals.Request instance.
+            grid_args: dict of SQLFORM.grid arguments.
+        """
+        # C0103: *Invalid name "%%s" (should match %%s)*
+        # pylint: disable=C0103
+
+        query, creator, editable = self.filters(db, request)
+
+        orderby_field, orderby_fieldname = self.ordering(request)
+        self.orderby_field = orderby_field
+
+        sort_field = db[orderby_field['table']][orderby_fieldname]
+        orderby = [~sort_field]
         orderby.append(db.book.id)              # Ensure consistent results
 
+        left = left_joins(db)
+
+        self.total = result_count(db, query, left)
+        base_query = query
+        cursor = decode_cursor(sort_field, request.vars.after)
+        self.start = cursor[0] if cursor else 0
+        if cursor:
+            query = base_query & keyset_query(sort_field, cursor[2], cursor[1])
+
         db.book.id.readable = False
         db.book.id.writable = False
         db.book.name.represent = lambda v, row: A(v, _href=URL(c='books', f='book', args=row.book.id, extension=False))
+        db.book.reader.readable = False
+        db.book.reader.writable = False
         db.creator.id.readable = False
         db.creator.id.writable = False
         db.auth_user.name.represent = lambda v, row: A(v, _href=URL(c='creators', f='creator', args=row.creator.id, extension=False))
 
-        fields = [
-            db.book.id,
-            db.book.name,
-            db.book.release_date,
-            db.book.contributions_year,
-            db.book.contributions_month,
-            db.book.rating_year,
-            db.book.rating_month,
-            db.book.views_year,
-            db.book.views_month,
-            db.book.created_on,
-            db.creator.id,
-            ]
+        fields = self.fields(db)
 
         def link_book_id(row):
             book_id = 0
@@ -158,7 +335,7 @@ class Search(object):
             return A(
                 'Download',
                 _href=URL(c='books', f='download', args=book_id, extension=False),
-                _class='btn btn-default fixme',
+                _class='btn btn-default',
                 _type='button',
                 )
 
@@ -179,7 +356,9 @@ class Search(object):
             book_id = link_book_id(row)
             if not book_id:
                 return ''
-            return read_link(db, book_id, **dict(_class='btn btn-default', _type='button'))
+            # The grid selects book.reader so the book record needn't be read.
+            book_entity = row.book if 'book' in row else book_id
+            return read_link(db, book_entity, **dict(_class='btn btn-default', _type='button'))
 
         def release_link(row):
             book_id = link_book_id(row)
@@ -235,6 +414,7 @@ class Search(object):
             def update_book_creator(form):
                 db(db.book.id == form.vars.id).update(creator_id=creator.id)
                 db.commit()
+                invalidate_book(form.vars.id)
             oncreate = update_book_creator
 
         def ondelete(table, record_id):
@@ -247,7 +427,10 @@ class Search(object):
             for row in db(db.book_to_link.book_id == record_id).select(db.book_to_link.link_id):
                 db(db.link.id == row['link_id']).delete()
             db(db.book_to_link.book_id == record_id).delete()
+            fulltext_index(db).delete_book(record_id)
+            delete_ranked_book(db, record_id)
             db.commit()
+            invalidate_book(record_id)
 
         kwargs = dict(
                 fields=fields,
@@ -256,10 +439,8 @@ class Search(object):
                     'auth_user.name': 'Creator',
                     },
                 orderby=orderby,
-                left=[
-                    db.creator.on(db.book.creator_id == db.creator.id),
-                    db.auth_user.on(db.creator.auth_user_id == db.auth_user.id),
-                    ],
+                left=left,
+                cache_count=self.total,
                 paginate=10,
                 details=False,
                 editable=False,
@@ -281,7 +462,275 @@ class Search(object):
 
         self.grid = LocalSQLFORM.grid(query, **kwargs)
         self.paginate = kwargs['paginate']       # Make paginate accessible.
+
+        self.rows = self.grid.rows or []
+        self.set_cursors(db, base_query, sort_field, cursor)
+
+        # Page links of the grid are replaced by cursor links.
+        paginator = self.paginator(request)
+        for div in self.grid.elements('div.web2py_paginator'):
+            div.components = [paginator.links()]
+
         # Remove 'None' record count if applicable.
         for count, div in enumerate(self.grid[0]):
             if str(div) == '<div class="web2py_counter">None</div>':
                 del self.grid[0][count]
+
+    def set_cursors(self, db, query, sort_field, cursor):
+        """Set the cursors of the previous and next pages of self.rows.
+
+        Args:
+            db: gluon.dal.DAL instance
+            query: gluon.dal.Query instance, the search filters
+            sort_field: gluon.dal.Field instance, the orderby field.
+            cursor: tuple, the cursor of the page, as returned by
+                decode_cursor(), or None for the first page.
+        """
+        left = left_joins(db)
+        self.prev_cursor = None
+        self.next_cursor = None
+        if cursor:
+            # The cursor row is the last row of the previous page. The
+            # cursor of the previous page is the paginate-th row before it,
+            # if any.
+            before = db(query & keyset_query(
+                sort_field, cursor[2], cursor[1], after=False)).select(
+                    db.book.id,
+                    sort_field,
+                    left=left,
+                    orderby=[sort_field, ~db.book.id],
+                    limitby=(0, self.paginate),
+                    )
+            if len(before) >= self.paginate:
+                last = before[self.paginate - 1]
+                self.prev_cursor = encode_cursor(
+                    max(self.start - self.paginate, 0),
+                    last.id,
+                    last[sort_field.name],
+                    )
+            else:
+                self.prev_cursor = ''               # The first page
+        rows = self.rows
+        if rows and self.paginate and len(rows) >= self.paginate:
+            last = rows[self.paginate - 1]
+            more = db(query & keyset_query(
+                sort_field, last.book[sort_field.name], last.book.id)).select(
+                    db.book.id,
+                    left=left,
+                    limitby=(0, 1),
+                    )
+            if more:
+                self.next_cursor = encode_cursor(
+                    self.start + self.paginate,
+                    last.book.id,
+                    last.book[sort_field.name],
+                    )
+
+    def set_ranked(self, db, request, paginate=10):
+        """Set the rows from the book rankings.
+
+        Rankings serve searches with no filters, eg the front page, with a
+        range read of the book_ranking table. See modules/rankings.py. The
+        grid is not set, and self.total is not counted.
+
+        Args:
+            db: gluon.dal.DAL instance
+            request: gluon.globals.Request instance.
+            paginate: integer, number of rows per page.
+
+        Returns:
+            True if the rows are set, False if the search can't be served
+                from the rankings. Use set() instead.
+        """
+        if request.vars.rw or request.vars.creator_id or request.vars.kw \
+                or request.vars.released in ['0', '1']:
+            return False
+
+        self.orderby_field, fieldname = self.ordering(request)
+        cursor = decode_cursor(db.book[fieldname], request.vars.after)
+        start = cursor[0] if cursor else 0
+        rows = ranked_rows(db, fieldname, start, paginate + 1)
+        if not rows and not start:
+            # The books are not ranked yet.
+            return False
+
+        self.grid = None
+        self.paginate = paginate
+        self.start = start
+        self.total = ranking_size(db, fieldname)
+        self.rows = rows[:paginate]
+        self.prev_cursor = None
+        self.next_cursor = None
+        if len(rows) > paginate:
+            last = self.rows[-1]
+            self.next_cursor = encode_cursor(
+                start + paginate, last.book.id, last.book[fieldname])
+        if start > paginate:
+            before = ranked_rows(db, fieldname, start - paginate - 1, 1)
+            if before:
+                self.prev_cursor = encode_cursor(
+                    start - paginate,
+                    before[0].book.id,
+                    before[0].book[fieldname],
+                    )
+        if start and self.prev_cursor is None:
+            self.prev_cursor = ''                   # The first page
+        return True
+
+    def set_rows(self, db, request, paginate=10):
+        """Set the rows of the results without building a grid.
+
+        The rows and paging are the same as those of set() but the grid, and
+        its html, is not built. Use for views that render rows themselves.
+
+        Args:
+            db: gluon.dal.DAL instance
+            request: gluon.globals.Request instance.
+            paginate: integer, number of rows per page.
+        """
+        query, unused_creator, unused_editable = self.filters(db, request)
+        self.orderby_field, fieldname = self.ordering(request)
+        sort_field = db.book[fieldname]
+        left = left_joins(db)
+
+        self.grid = None
+        self.paginate = paginate
+        self.total = result_count(db, query, left)
+        cursor = decode_cursor(sort_field, request.vars.after)
+        self.start = cursor[0] if cursor else 0
+        page_query = query
+        if cursor:
+            page_query = query & keyset_query(sort_field, cursor[2], cursor[1])
+        self.rows = db(page_query).select(
+            db.auth_user.name,
+            *self.fields(db),
+            left=left,
+            orderby=[~sort_field, db.book.id],
+            limitby=(0, paginate)
+            )
+        self.set_cursors(db, query, sort_field, cursor)
+
+    def set_cover_images(self, db, size='thumb'):
+        """Set the cover images for the books in the rows.
+
+        The images for all rows are read in bulk. See books.cover_images().
+
+        Args:
+            db: gluon.dal.DAL instance
+            size: string, the size of the image. One of
+                UploadImage.sizes.keys()
+        """
+        self.cover_images = {}
+        if not self.rows:
+            return
+        book_ids = [x.book.id for x in self.rows]
+        self.cover_images = cover_images(db, book_ids, size=size)
+
+
+def decode_cursor(field, cursor):
+    """Decode a pagination cursor.
+
+    Args:
+        field: gluon.dal.Field instance, the orderby field.
+        cursor: string, cursor as returned by encode_cursor()
+
+    Returns:
+        tuple (start, book_id, value) or None if the cursor is invalid.
+            start: integer, number of results preceding the page.
+            book_id: integer, id of the last book of the previous page.
+            value: the orderby field value of the book.
+    """
+    if not cursor:
+        return None
+    try:
+        start, book_id, value = str(cursor).split('_', 2)
+        start = int(start)
+        book_id = int(book_id)
+        if field.type == 'datetime':
+            fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in value \
+                else '%Y-%m-%d %H:%M:%S'
+            value = datetime.datetime.strptime(value, fmt)
+        elif field.type == 'double':
+            value = float(value)
+        else:
+            value = int(value)
+    except ValueError:
+        return None
+    return (start, book_id, value)
+
+
+def encode_cursor(start, book_id, value):
+    """Encode a pagination cursor.
+
+    Args:
+        start: integer, number of results preceding the page.
+        book_id: integer, id of the last book of the previous page.
+        value: the orderby field value of the book.
+
+    Returns:
+        string, cursor
+    """
+    if isinstance(value, float):
+        value = repr(value)
+    return '{s}_{i}_{v}'.format(s=start, i=book_id, v=value)
+
+
+def keyset_query(field, value, book_id, after=True):
+    """Return the query for the rows on either side of a keyset cursor.
+
+    Search results are ordered by field descending then book id ascending.
+
+    Args:
+        field: gluon.dal.Field instance, the orderby field.
+        value: the orderby field value of the cursor.
+        book_id: integer, the book id of the cursor.
+        after: If True, return the query for the rows after the cursor,
+            otherwise the rows before it.
+
+    Returns:
+        gluon.dal.Query instance
+    """
+    if after:
+        return (field < value) | \
+            ((field == value) & (field.table.id > book_id))
+    return (field > value) | \
+        ((field == value) & (field.table.id < book_id))
+
+
+def left_joins(db):
+    """Return the left joins of the search results.
+
+    Args:
+        db: gluon.dal.DAL instance
+
+    Returns:
+        list of gluon.dal.Expression instances
+    """
+    return [
+        db.creator.on(db.book.creator_id == db.creator.id),
+        db.auth_user.on(db.creator.auth_user_id == db.auth_user.id),
+        ]
+
+
+def result_count(db, query, left=None):
+    """Return the number of results of a search query.
+
+    Counts are cached for COUNT_CACHE_SECONDS, keyed by the query sql, so
+    paging through results does not count them on every page.
+
+    Args:
+        db: gluon.dal.DAL instance
+        query: gluon.dal.Query instance
+        left: list of left joins.
+
+    Returns:
+        integer, number of results
+    """
+    count = db.book.id.count()
+    rows = db(query).select(
+        count,
+        left=left,
+        cache=(current.cache.ram, COUNT_CACHE_SECONDS),
+        cacheable=True,
+        )
+    return rows.first()[count]
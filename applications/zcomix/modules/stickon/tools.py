@@ -13,6 +13,7 @@ from gluon.storage import Settings
 from gluon.tools import Auth, Crud, Mail, Service
 import logging
 import os
+import time
 import ConfigParser
 from applications.zcomix.modules.ConfigParser_improved import  \
         ConfigParserImproved
@@ -23,6 +24,20 @@ from applications.zcomix.modules.ConfigParser_improved import  \
 
 LOG = logging.getLogger('app')
 
+DB_URI = 'sqlite://storage.sqlite'
+# sqlite adapter_args set by the db_<name> local settings, eg db_readers
+DB_ADAPTER_ARGS = [
+    'journal_mode',
+    'busy_timeout',
+    'synchronous',
+    'cache_size',
+    'readers',
+]
+MODEL_MODES = ['development', 'production']
+# Statistics of slow queries, in the databases folder. See
+# private/bin/slow_queries.py
+SLOW_QUERY_FILE = 'slow_queries.json'
+
 
 class ConfigFileError(Exception):
     """Exception class for configuration file errors."""
@@ -30,7 +45,13 @@ class ConfigFileError(Exception):
 
 
 class ModelDb(object):
-    """Class representing the db.py model"""
+    """Class representing the db.py model
+
+    In production mode the model opens one pooled connection, tables are
+    defined lazily, ie when first accessed, and migrations are off: the
+    table metadata is the .table files written by the last run in
+    development mode. See model_mode().
+    """
 
     def __init__(self, environment, config_file=None, init_all=True):
         """Constructor.
@@ -45,16 +66,21 @@ class ModelDb(object):
         self.environment = environment
         self.config_file = config_file
         self._server_mode = None
+        self._timer = time.time()
+        self.timings = []           # [(step, seconds), ...] See mark()
 
         self.local_settings = Settings()
         self.settings_loader = self._settings_loader()
+        self.mark('settings')
 
         if init_all:
             # The order of these is intentional. Some depend on each other.
             self.DAL = self.environment['DAL']
             self.db = self._db()
+            self.mark('db')
             self.mail = self._mail()
             self.auth = self._auth()
+            self.mark('auth')
             self.crud = self._crud()
             self.service = self._service()
 
@@ -151,7 +177,44 @@ class ModelDb(object):
             #   from gluon.contrib.memdb import MEMDB
             #   from google.appengine.api.memcache import Client
             #   session.connect(request, response, db=MEMDB(Client())
-            db = self.DAL('sqlite://storage.sqlite')
+            pool_size = self.local_settings.db_pool_size
+            adapter_args = {}
+            for name in DB_ADAPTER_ARGS:
+                value = self.local_settings['db_' + name]
+                if value not in (None, ''):
+                    adapter_args[name] = value
+            if self.model_mode() == 'production':
+                db = self.DAL(
+                    DB_URI,
+                    pool_size=1 if pool_size in (None, '') else pool_size,
+                    adapter_args=adapter_args,
+                    lazy_tables=True,
+                    migrate_enabled=False,
+                )
+            else:
+                db = self.DAL(
+                    DB_URI,
+                    pool_size=pool_size or 0,
+                    adapter_args=adapter_args,
+                )
+        # The shell, used by scripts and the scheduler, sets http_host but
+        # not request_method.
+        web_request = bool(request.env.request_method)
+        if self.get_server_mode() == 'test' and web_request:
+            # Debug mode, see models/0.py. Not for scripts, they can run
+            # any number of queries.
+            db.record_queries(on_close=self.report_queries)
+        slow_query_ms = self.local_settings.slow_query_ms
+        if slow_query_ms not in (None, ''):
+            db.log_slow_queries(
+                float(slow_query_ms) / 1000,
+                explain=bool(self.local_settings.slow_query_explain),
+                filename=os.path.join(
+                    request.folder, 'databases', SLOW_QUERY_FILE),
+                caller='{c}/{f}'.format(
+                    c=request.controller, f=request.function)
+                if web_request else None,
+            )
         return db
 
     def _mail(self):
@@ -202,6 +265,96 @@ class ModelDb(object):
             self._server_mode = server_production_mode(request)
         return self._server_mode
 
+    def mark(self, step):
+        """Record the time taken by a step of the models.
+
+        The time is from the previous mark, or the creation of the instance.
+
+        Args:
+            step: string, name of the step, eg 'tables'
+        """
+        now = time.time()
+        self.timings.append((step, now - self._timer))
+        self._timer = now
+
+    def model_mode(self):
+        """Return the model mode setting.
+
+        The model_mode local setting, or if not set, 'production' on live
+        servers and 'development' otherwise.
+
+        Returns:
+            string: model mode, one of MODEL_MODES
+        """
+        mode = self.local_settings.model_mode
+        if mode not in MODEL_MODES:
+            mode = 'production' if self.get_server_mode() == 'live' \
+                else 'development'
+        return mode
+
+    def needs_validators(self, controllers):
+        """Return whether validators of forms are needed by the request.
+
+        In development mode validators are always built.
+
+        Args:
+            controllers: list of strings, names of the controllers with forms
+
+        Returns:
+            True if the request controller is one of controllers.
+        """
+        if self.model_mode() != 'production':
+            return True
+        return self.environment['request'].controller in controllers
+
+    def report_queries(self, recorder):
+        """Log the queries of the request and warn of N+1 candidates.
+
+        Args:
+            recorder: gluon.dal.QueryRecorder instance
+        """
+        request = self.environment['request']
+        page = '{c}/{f}'.format(c=request.controller, f=request.function)
+        LOG.debug('queries {p}: {s}'.format(p=page, s=recorder.summary()))
+        for shape, queries in recorder.repeated():
+            LOG.warning('N+1 candidate {p}: {n} times {s} at {f}'.format(
+                p=page,
+                n=len(queries),
+                s=shape,
+                f=queries[0]['frame'],
+            ))
+
+    def report_timing(self):
+        """Report the time taken by the models of the request.
+
+        If the model_timing local setting is True, the times of the steps
+        recorded by mark() are logged and set in the Server-Timing response
+        header, in milliseconds.
+
+        Returns:
+            string, the report, eg 'db 1.2ms, auth 3.4ms, total 4.6ms'
+        """
+        if not self.local_settings.model_timing:
+            return None
+        timings = self.timings + [
+            ('total', sum([x[1] for x in self.timings]))]
+        report = ', '.join([
+            '{s} {t:0.1f}ms'.format(s=s, t=t * 1000) for s, t in timings])
+        request = self.environment['request']
+        LOG.info('models {m} {c}/{f}: {r}'.format(
+            m=self.model_mode(),
+            c=request.controller,
+            f=request.function,
+            r=report,
+        ))
+        if 'response' in self.environment:
+            self.environment['response'].headers['Server-Timing'] = \
+                ', '.join([
+                    '{s};dur={t:0.1f}'.format(s=s, t=t * 1000)
+                    for s, t in timings
+                ])
+        return report
+
     def verify_email_onaccept(self, user):
         """
         This is run after the registration email is verified. The
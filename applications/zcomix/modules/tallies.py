@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Classes and functions related to book tallies, ie the monthly and yearly
+contributions, ratings and views of books.
+
+Events (contribution, rating and book_view records) are pre-aggregated in
+daily buckets per book, the book_tally table. Each run adds only the events
+recorded since the previous run, as marked by the watermarks in the
+tally_watermark table. The book rankings are then rebuilt from the new
+tallies, see modules/rankings.py, and the cached pages displaying them are
+invalidated, see modules/caching.py.
+"""
+import datetime
+from gluon import *
+from applications.zcomix.modules.caching import clear_tags
+from applications.zcomix.modules.rankings import rank_books
+
+PERIODS = {
+    # name: days
+    'month': 30,
+    'year': 365,
+}
+
+SOURCES = [
+    # (event table, [(book_tally field, event field, function), ...])
+    ('contribution', [('contributions', 'amount', 'sum')]),
+    ('rating', [
+        ('rating_total', 'amount', 'sum'),
+        ('rating_count', 'id', 'count'),
+    ]),
+    ('book_view', [('views', 'id', 'count')]),
+]
+
+TALLY_FIELDS = ['contributions', 'rating_total', 'rating_count', 'views']
+
+BOOK_FIELDS = [
+    'contributions_month',
+    'contributions_year',
+    'rating_month',
+    'rating_year',
+    'views_month',
+    'views_year',
+]
+
+
+def add_events(db, tablename, today=None):
+    """Add the events of a table recorded since the last run to the daily
+    buckets.
+
+    Events older than the longest period are ignored.
+
+    Args:
+        db: gluon.dal.DAL instance
+        tablename: string, name of event table, one of SOURCES
+        today: datetime.date instance, default is today.
+
+    Returns:
+        integer, number of events added.
+    """
+    today = today or datetime.date.today()
+    table = db[tablename]
+    fields = dict(SOURCES)[tablename]
+
+    watermark_query = (db.tally_watermark.tablename == tablename)
+    watermark = db(watermark_query).select(
+        db.tally_watermark.ALL).first()
+    last_id = watermark.max_id if watermark else 0
+
+    max_id = table.id.max()
+    top_id = db(table.id > last_id).select(max_id).first()[max_id]
+    if not top_id:
+        return 0
+
+    min_date = today - datetime.timedelta(days=max(PERIODS.values()) - 1)
+    year = table.time_stamp.year()
+    month = table.time_stamp.month()
+    day = table.time_stamp.day()
+    count = table.id.count()
+    aggregates = []
+    for unused_tally_field, field, func in fields:
+        aggregates.append(getattr(table[field], func)())
+
+    query = (table.id > last_id) & \
+        (table.id <= top_id) & \
+        (table.book_id != None) & \
+        (table.time_stamp >= datetime.datetime.combine(
+            min_date, datetime.time()))
+    rows = db(query).select(
+        table.book_id,
+        year,
+        month,
+        day,
+        count,
+        *aggregates,
+        groupby=[table.book_id, year, month, day]
+    )
+
+    buckets = {}
+    for r in rows:
+        key = (
+            r[table.book_id],
+            datetime.date(int(r[year]), int(r[month]), int(r[day])),
+        )
+        buckets[key] = dict([
+            (fields[i][0], r[aggregates[i]] or 0)
+            for i in range(len(fields))
+        ])
+
+    existing = {}
+    if buckets:
+        book_ids = list(set([x[0] for x in buckets.keys()]))
+        query = (db.book_tally.book_id.belongs(book_ids)) & \
+            (db.book_tally.tally_date >= min([x[1] for x in buckets.keys()]))
+        for r in db(query).select(db.book_tally.ALL):
+            existing[(r.book_id, r.tally_date)] = r
+
+    for key, values in buckets.items():
+        if key in existing:
+            row = existing[key]
+            db(db.book_tally.id == row.id).update(**dict([
+                (k, db.book_tally[k] + v) for k, v in values.items()
+            ]))
+        else:
+            data = dict([(x, 0) for x in TALLY_FIELDS])
+            data.update(values)
+            db.book_tally.insert(book_id=key[0], tally_date=key[1], **data)
+
+    if watermark:
+        db(db.tally_watermark.id == watermark.id).update(max_id=top_id)
+    else:
+        db.tally_watermark.insert(tablename=tablename, max_id=top_id)
+    return sum([r[count] for r in rows])
+
+
+def expire_buckets(db, today=None):
+    """Delete the daily buckets older than the longest period.
+
+    Args:
+        db: gluon.dal.DAL instance
+        today: datetime.date instance, default is today.
+
+    Returns:
+        integer, number of buckets deleted.
+    """
+    today = today or datetime.date.today()
+    min_date = today - datetime.timedelta(days=max(PERIODS.values()) - 1)
+    return db(db.book_tally.tally_date < min_date).delete()
+
+
+def rebuild(db):
+    """Delete all buckets and watermarks.
+
+    The next update_tallies() run tallies all events.
+
+    Args:
+        db: gluon.dal.DAL instance
+    """
+    db(db.book_tally).delete()
+    db(db.tally_watermark).delete()
+
+
+def tally_books(db, today=None):
+    """Set the monthly and yearly tallies of books from the daily buckets.
+
+    Books with no events in a period have their tallies for the period set
+    to zero. Only books with changed values are updated.
+
+    Args:
+        db: gluon.dal.DAL instance
+        today: datetime.date instance, default is today.
+
+    Returns:
+        list of integers, ids of the books updated.
+    """
+    today = today or datetime.date.today()
+    sums = [db.book_tally[x].sum() for x in TALLY_FIELDS]
+    tallies = {}
+    for period, days in PERIODS.items():
+        min_date = today - datetime.timedelta(days=days - 1)
+        rows = db(db.book_tally.tally_date >= min_date).select(
+            db.book_tally.book_id,
+            *sums,
+            groupby=db.book_tally.book_id
+        )
+        for r in rows:
+            values = dict(
+                [(TALLY_FIELDS[i], r[sums[i]] or 0) for i in range(len(sums))]
+            )
+            book_tallies = tallies.setdefault(r.book_tally.book_id, {})
+            book_tallies['contributions_' + period] = values['contributions']
+            book_tallies['rating_' + period] = \
+                float(values['rating_total']) / values['rating_count'] \
+                if values['rating_count'] else 0
+            book_tallies['views_' + period] = values['views']
+
+    updated = []
+    book_fields = [db.book[x] for x in BOOK_FIELDS]
+    for book in db(db.book).select(db.book.id, *book_fields):
+        values = dict([(x, 0) for x in BOOK_FIELDS])
+        values.update(tallies.get(book.id, {}))
+        changed = dict(
+            [(k, v) for k, v in values.items() if book[k] != v]
+        )
+        if changed:
+            db(db.book.id == book.id).update(**changed)
+            updated.append(book.id)
+    return updated
+
+
+def update_tallies(db, today=None):
+    """Update the tallies of books.
+
+    All changes, including the rebuilt rankings, are made in one
+    transaction. Then the cached search pages, and the pages of the books
+    updated, are invalidated.
+
+    Args:
+        db: gluon.dal.DAL instance
+        today: datetime.date instance, default is today.
+
+    Returns:
+        dict, {
+            'events': {tablename: number of events added},
+            'expired': number of buckets deleted,
+            'books': number of books updated,
+            'ranked': number of books ranked,
+        }
+    """
+    today = today or datetime.date.today()
+    try:
+        results = dict(events={})
+        for tablename, unused_fields in SOURCES:
+            results['events'][tablename] = add_events(
+                db, tablename, today=today)
+        results['expired'] = expire_buckets(db, today=today)
+        book_ids = tally_books(db, today=today)
+        results['books'] = len(book_ids)
+        results['ranked'] = rank_books(db)
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    clear_tags(['search'] + ['book.{i}'.format(i=x) for x in book_ids])
+    return results
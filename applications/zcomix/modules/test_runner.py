@@ -8,6 +8,7 @@ Classes for local python test_suite scripts.
 """
 from BeautifulSoup import BeautifulSoup
 import StringIO
+import contextlib
 import datetime
 import inspect
 import os
@@ -92,6 +93,45 @@ class LocalTestCase(unittest.TestCase):
                 db(query).delete()
                 db.commit()
 
+    @contextlib.contextmanager
+    def assertMaxQueries(self, maximum, db=None):
+        """Fail if the code in the block runs more than maximum queries.
+
+        Usage:
+            with self.assertMaxQueries(3):
+                book_pages_as_json(db, book_id)
+
+        Args:
+            maximum: integer, maximum number of queries
+            db: gluon.dal.DAL instance, default current.app.db
+
+        Yields:
+            gluon.dal.QueryRecorder instance
+        """
+        # C0103: *Invalid name "%%s" (should match %%s)*
+        # pylint: disable=C0103
+        # W0212: *Access to a protected member %%s of a client class*
+        # pylint: disable=W0212
+        if db is None:
+            db = current.app.db
+        recording = db._recorder is not None
+        recorder = db._recorder if recording else db.record_queries()
+        start = len(recorder)
+        try:
+            yield recorder
+        finally:
+            if not recording:
+                db._recorder = None
+        count = len(recorder) - start
+        if count > maximum:
+            # Queries beyond QueryRecorder.MAX_QUERIES are not listed.
+            queries = recorder.queries[start:]
+            self.fail('{c} queries, maximum {m}:\n{q}'.format(
+                c=count,
+                m=maximum,
+                q='\n'.join([x['sql'] for x in queries]),
+            ))
+
     def run(self, result=None):
         """Run test fixture."""
         self.addCleanup(self._cleanup)
@@ -128,6 +168,8 @@ class LocalTestCase(unittest.TestCase):
             current.app.db = APP_ENV[app]['db']
             if 'local_settings' in APP_ENV[app]:
                 current.app.local_settings = APP_ENV[app]['local_settings']
+            if 'scheduler' in APP_ENV[app]:
+                current.app.scheduler = APP_ENV[app]['scheduler']
             APP_ENV[app]['current'] = current
         env['current'] = APP_ENV[app]['current']
         env['request'] = APP_ENV[app]['current'].request
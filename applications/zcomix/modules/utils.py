@@ -7,6 +7,9 @@ Utilty classes and functions.
 """
 import collections
 from gluon import *
+from gluon.dal import Expression
+
+REORDER_BATCH_SIZE = 500            # Records per UPDATE statement
 
 
 class ItemDescription(object):
@@ -79,6 +82,10 @@ class ItemDescription(object):
 def move_record(sequential_field, record_id, direction='up', query=None, start=1):
     """Move a record in the direction.
 
+    The record swaps sequential field values with its neighbour, ie only
+    the two affected records are updated. If the record and its neighbour
+    have the same value, all records are reordered instead.
+
     Args:
         sequential_field: gluon.dal.Field instance
         record_id: integer, id of record to move.
@@ -87,32 +94,60 @@ def move_record(sequential_field, record_id, direction='up', query=None, start=1
             Only records returned by this query will be reordered.
                 db(query).select()
             If None, all records of the table are reordered.
-        start: integer, the sequential field value of the first record is set
-            to this. Subsequent records have values incremented by 1.
+        start: integer, if the records are reordered, the sequential field
+            value of the first record is set to this. Subsequent records
+            have values incremented by 1.
     """
     db = sequential_field._db
     table = sequential_field.table
 
-    record = db(table.id == record_id).select(table.ALL).first()
+    record = db(table.id == record_id).select(
+        table.id, sequential_field).first()
     if not record:
         # If the record doesn't exist, it can't be moved.
         return
 
-    # Create a list of ids in order except for the one that is moved.
-    filter_query = (table.id != record_id)
+    value = record[sequential_field.name]
+    if direction == 'down':
+        neighbour_query = (sequential_field > value) | \
+            ((sequential_field == value) & (table.id > record.id))
+        orderby = [sequential_field, table.id]
+    else:
+        neighbour_query = (sequential_field < value) | \
+            ((sequential_field == value) & (table.id < record.id))
+        orderby = [~sequential_field, ~table.id]
     if query:
-        filter_query = filter_query & query
-    rows = db(filter_query).select(table.id, orderby=sequential_field)
-    record_ids = [x.id for x in rows]
+        neighbour_query = neighbour_query & query
+    neighbour = db(neighbour_query).select(
+        table.id,
+        sequential_field,
+        orderby=orderby,
+        limitby=(0, 1),
+    ).first()
+    if not neighbour:
+        # The record is first or last, it can't be moved.
+        return
+
+    if neighbour[sequential_field.name] == value:
+        # The values are not sequential, reorder all records.
+        rows = db(query or (table.id > 0)).select(
+            table.id,
+            orderby=[sequential_field, table.id]
+        )
+        record_ids = [x.id for x in rows]
+        if record.id not in record_ids:
+            return
+        i = record_ids.index(record.id)
+        j = record_ids.index(neighbour.id)
+        record_ids[i], record_ids[j] = record_ids[j], record_ids[i]
+        reorder(sequential_field, record_ids=record_ids, start=start)
+        return
 
-    # Insert the moved record in it's new location.
-    old_order_value = record[sequential_field.name]
-    new_order_value = old_order_value + 1 if direction == 'down' \
-        else old_order_value - 1
-    if new_order_value < start:
-        new_order_value = start
-    record_ids.insert(new_order_value - 1, record.id)
-    reorder(sequential_field, record_ids=record_ids, query=query, start=start)
+    reorder(
+        sequential_field,
+        record_ids=[neighbour.id, record.id],
+        values=[value, neighbour[sequential_field.name]],
+    )
 
 
 def profile_wells(request):
@@ -213,9 +248,14 @@ def profile_wells(request):
     return wells
 
 
-def reorder(sequential_field, record_ids=None, query=None, start=1):
+def reorder(sequential_field, record_ids=None, query=None, start=1,
+            values=None):
     """Reset a table's sequential field values.
 
+    The values are set by a single UPDATE statement, per REORDER_BATCH_SIZE
+    records, and committed once. Records whose value doesn't change are not
+    updated.
+
     Args:
         sequential_field: gluon.dal.Field instance
         record_ids: list of integers, ids of records of the table in
@@ -228,6 +268,12 @@ def reorder(sequential_field, record_ids=None, query=None, start=1):
             This is ignored if record_ids is provided.
         start: integer, the sequential field value of the first record is set
             to this. Subsequent records have values incremented by 1.
+        values: list of integers, the sequential field values of the records
+            of record_ids, in the same order. If None, the values are
+            sequential from start.
+
+    Returns:
+        integer, number of records updated.
     """
     db = sequential_field._db
     table = sequential_field.table
@@ -236,11 +282,40 @@ def reorder(sequential_field, record_ids=None, query=None, start=1):
             query = (table.id > 0)
         rows = db(query).select(
             table.id,
+            sequential_field,
             orderby=[sequential_field, table.id]
         )
         record_ids = [x.id for x in rows]
-    for count, record_id in enumerate(record_ids, start):
-        update_query = (table.id == record_id) & \
-            (sequential_field != count)       # Only update if value is changed
-        db(update_query).update(**{sequential_field.name: count})
-        db.commit()
+        old_values = dict([(x.id, x[sequential_field.name]) for x in rows])
+    else:
+        record_ids = [int(x) for x in record_ids]
+        old_values = {}
+        for i in range(0, len(record_ids), REORDER_BATCH_SIZE):
+            rows = db(table.id.belongs(
+                record_ids[i:i + REORDER_BATCH_SIZE])).select(
+                    table.id, sequential_field)
+            old_values.update(
+                [(x.id, x[sequential_field.name]) for x in rows])
+
+    if values is None:
+        values = range(start, start + len(record_ids))
+    # Only update if value is changed
+    changes = [
+        (x, int(v)) for x, v in zip(record_ids, values)
+        if x in old_values and old_values[x] != v
+    ]
+    for i in range(0, len(changes), REORDER_BATCH_SIZE):
+        batch = changes[i:i + REORDER_BATCH_SIZE]
+        case = Expression(
+            db,
+            'CASE {i} {w} END'.format(
+                i=table.id,
+                w=' '.join(['WHEN {r} THEN {v}'.format(r=r, v=v)
+                            for r, v in batch]),
+            ),
+            type=sequential_field.type,
+        )
+        db(table.id.belongs([r for r, unused_v in batch])).update(
+            **{sequential_field.name: case})
+    db.commit()
+    return len(changes)
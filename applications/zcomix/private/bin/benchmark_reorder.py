@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark_reorder.py
+
+Script to benchmark reorder() and move_record() of modules/utils.py.
+"""
+import logging
+import sys
+import time
+import traceback
+from gluon import *
+from gluon.dal import DAL, Field
+from optparse import OptionParser
+from applications.zcomix.modules.utils import \
+    move_record, \
+    reorder
+
+VERSION = 'Version 0.1'
+
+LOG = logging.getLogger('cli')
+
+
+def man_page():
+    """Print manual page-like help"""
+    print """
+USAGE
+    benchmark_reorder.py
+    benchmark_reorder.py --records 300  # Lists of 300 records
+    benchmark_reorder.py --uri sqlite://benchmark.sqlite
+
+    Each test is run on a list of records, 1,000 by default, and the best
+    of several runs is printed in seconds. The baseline test updates and
+    commits one record at a time for comparison.
+
+    Tests:
+        baseline        Reverse the order, one statement per record.
+        reverse         Reverse the order with reorder().
+        delete first    Delete the first record and reorder(), ie all
+                        remaining records are renumbered, as when the first
+                        page of a book is deleted.
+        append          Append a record and reorder(), as when a page is
+                        uploaded.
+        move x 100      Move 100 records one place with move_record().
+
+    The tests are run in a temporary table, benchmark_reorder, which is
+    dropped when done. Use --uri to benchmark a database on disk. By default
+    an in-memory sqlite database is used.
+
+OPTIONS
+    -h, --help
+        Print a brief help.
+
+    --man
+        Print man page-like help.
+
+    -n NUMBER, --records=NUMBER
+        The number of records in the list. Default 1000.
+
+    -r NUMBER, --repeats=NUMBER
+        The number of times each test is run. Default 3.
+
+    -u URI, --uri=URI
+        The uri of the database. Default sqlite:memory
+    """
+
+
+def reorder_by_record(sequential_field, record_ids, start=1):
+    """Reset sequential field values one record, and commit, at a time.
+
+    Args:
+        sequential_field: gluon.dal.Field instance
+        record_ids: list of integers, ids of records in sequential order.
+        start: integer, value of the first record.
+    """
+    db = sequential_field._db
+    table = sequential_field.table
+    for count, record_id in enumerate(record_ids, start):
+        update_query = (table.id == record_id) & \
+            (sequential_field != count)
+        db(update_query).update(**{sequential_field.name: count})
+        db.commit()
+
+
+def run_tests(db, records, repeats):
+    """Run the tests.
+
+    Args:
+        db: gluon.dal.DAL instance
+        records: integer, number of records in the list
+        repeats: integer, number of runs per test
+
+    Returns:
+        list of tuples (test, seconds), the best run of each test.
+    """
+    table = db.benchmark_reorder
+    field = table.order_no
+
+    def setup():
+        """Create the list of records in order."""
+        table.truncate()
+        table.bulk_insert(
+            [dict(name=str(x), order_no=x) for x in range(1, records + 1)])
+        db.commit()
+        return [x.id for x in db(table).select(table.id, orderby=field)]
+
+    def baseline(ids):
+        reorder_by_record(field, list(reversed(ids)))
+
+    def reverse(ids):
+        reorder(field, record_ids=list(reversed(ids)))
+
+    def delete_first(ids):
+        db(table.id == ids[0]).delete()
+        reorder(field)
+
+    def append(unused_ids):
+        table.insert(name='new', order_no=records + 1)
+        reorder(field)
+
+    def move(ids):
+        step = max(len(ids) // 100, 1)
+        for count, record_id in enumerate(ids[::step][:100]):
+            direction = 'up' if count % 2 else 'down'
+            move_record(field, record_id, direction=direction)
+
+    tests = [
+        ('baseline', baseline),
+        ('reverse', reverse),
+        ('delete first', delete_first),
+        ('append', append),
+        ('move x 100', move),
+    ]
+    results = []
+    for name, func in tests:
+        best = None
+        for unused_r in range(repeats):
+            ids = setup()
+            start = time.time()
+            func(ids)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((name, best))
+    return results
+
+
+def main():
+    """Main processing."""
+
+    usage = '%prog [options]'
+    parser = OptionParser(usage=usage, version=VERSION)
+
+    parser.add_option('--man',
+        action='store_true', dest='man', default=False,
+        help='Display manual page-like help and exit.',
+        )
+    parser.add_option('-n', '--records',
+        type='int', dest='records', default=1000,
+        help='Number of records in the list. Default 1000.',
+        )
+    parser.add_option('-r', '--repeats',
+        type='int', dest='repeats', default=3,
+        help='Number of runs per test. Default 3.',
+        )
+    parser.add_option('-u', '--uri',
+        dest='uri', default='sqlite:memory',
+        help='Database uri. Default sqlite:memory',
+        )
+
+    (options, unused_args) = parser.parse_args()
+
+    if options.man:
+        man_page()
+        quit(0)
+
+    db = DAL(options.uri, migrate=True)
+    db.define_table(
+        'benchmark_reorder',
+        Field('name'),
+        Field('order_no', 'integer'),
+    )
+    try:
+        results = run_tests(db, options.records, options.repeats)
+    finally:
+        db.benchmark_reorder.drop()
+        db.commit()
+
+    print 'Records: {n}'.format(n=options.records)
+    for name, seconds in results:
+        print '{n:<15} {s:>10.4f}'.format(n=name, s=seconds)
+
+
+if __name__ == '__main__':
+    # W0703: *Catch "Exception"*
+    # pylint: disable=W0703
+    try:
+        main()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        exit(1)
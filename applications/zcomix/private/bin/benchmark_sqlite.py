@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark_sqlite.py
+
+Script to benchmark concurrent reads and writes with sqlite adapter options.
+"""
+import logging
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from gluon import *
+from gluon.dal import DAL, Field
+from optparse import OptionParser
+
+VERSION = 'Version 0.1'
+
+LOG = logging.getLogger('cli')
+
+# (name, adapter_args)
+CONFIGS = [
+    ('default', {}),
+    ('wal', dict(journal_mode='WAL', busy_timeout=5000)),
+    ('wal readers', dict(journal_mode='WAL', busy_timeout=5000,
+                         synchronous='NORMAL', readers=4)),
+]
+
+
+def man_page():
+    """Print manual page-like help"""
+    print """
+USAGE
+    benchmark_sqlite.py
+    benchmark_sqlite.py --readers 8 --writers 2 --seconds 10
+
+    Reader and writer threads run requests concurrently on a sqlite database
+    for a number of seconds with each configuration of the adapter. A
+    request opens the database, as web2py does per request, and either
+    selects a page of records, or inserts records in a transaction and
+    commits. The requests per second and the number of failed requests, eg
+    'database is locked', are printed.
+
+    Configurations:
+        default         Journal mode delete, the 5 second timeout of the
+                        sqlite3 driver.
+        wal             WAL journal mode, busy timeout 5 seconds.
+        wal readers     WAL, synchronous NORMAL and a pool of 4 read-only
+                        connections for selects.
+
+    The database is created in a temporary directory, removed when done.
+
+OPTIONS
+    -h, --help
+        Print a brief help.
+
+    --man
+        Print man page-like help.
+
+    -r NUMBER, --readers=NUMBER
+        The number of reader threads. Default 4.
+
+    -s NUMBER, --seconds=NUMBER
+        The number of seconds each configuration is run. Default 5.
+
+    -w NUMBER, --writers=NUMBER
+        The number of writer threads. Default 1.
+    """
+
+
+def run_config(folder, adapter_args, readers, writers, seconds):
+    """Run reader and writer threads with a configuration.
+
+    Args:
+        folder: string, path of the directory of the database
+        adapter_args: dict, sqlite adapter_args
+        readers: integer, number of reader threads
+        writers: integer, number of writer threads
+        seconds: integer, number of seconds to run
+
+    Returns:
+        dict, {'reads': n, 'writes': n, 'errors': n}
+    """
+    uri = 'sqlite://benchmark.sqlite'
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    stop = time.time() + seconds
+
+    def connect():
+        db = DAL(uri, folder=folder, pool_size=1, adapter_args=adapter_args,
+                 attempts=1)
+        db.define_table('benchmark', Field('name'), Field('value', 'integer'),
+                        migrate=False)
+        return db
+
+    def request(func, count):
+        while time.time() < stop:
+            db = None
+            try:
+                db = connect()
+                func(db)
+                db.commit()
+                result = count
+            except Exception:
+                if db:
+                    db.rollback()
+                result = 'errors'
+            if db:
+                db.close()
+            with lock:
+                counts[result] += 1
+
+    def read(db):
+        db(db.benchmark.value > 0).select(
+            orderby=~db.benchmark.id, limitby=(0, 20))
+
+    def write(db):
+        for x in range(10):
+            db.benchmark.insert(name='write', value=x + 1)
+
+    threads = [threading.Thread(target=request, args=(read, 'reads'))
+               for unused_i in range(readers)]
+    threads.extend([threading.Thread(target=request, args=(write, 'writes'))
+                    for unused_i in range(writers)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def main():
+    """Main processing."""
+
+    usage = '%prog [options]'
+    parser = OptionParser(usage=usage, version=VERSION)
+
+    parser.add_option('--man',
+        action='store_true', dest='man', default=False,
+        help='Display manual page-like help and exit.',
+        )
+    parser.add_option('-r', '--readers',
+        type='int', dest='readers', default=4,
+        help='Number of reader threads. Default 4.',
+        )
+    parser.add_option('-s', '--seconds',
+        type='int', dest='seconds', default=5,
+        help='Seconds each configuration is run. Default 5.',
+        )
+    parser.add_option('-w', '--writers',
+        type='int', dest='writers', default=1,
+        help='Number of writer threads. Default 1.',
+        )
+
+    (options, unused_args) = parser.parse_args()
+
+    if options.man:
+        man_page()
+        quit(0)
+
+    print 'Readers: {r}, writers: {w}, seconds: {s}'.format(
+        r=options.readers, w=options.writers, s=options.seconds)
+    print '{n:<15} {r:>10} {w:>10} {e:>10}'.format(
+        n='', r='reads/s', w='writes/s', e='errors')
+    for name, adapter_args in CONFIGS:
+        folder = tempfile.mkdtemp()
+        try:
+            db = DAL('sqlite://benchmark.sqlite', folder=folder)
+            db.define_table('benchmark', Field('name'),
+                            Field('value', 'integer'))
+            db.benchmark.bulk_insert(
+                [dict(name='setup', value=x) for x in range(1, 1001)])
+            db.commit()
+            db.close()
+            counts = run_config(folder, adapter_args, options.readers,
+                                options.writers, options.seconds)
+        finally:
+            shutil.rmtree(folder)
+        print '{n:<15} {r:>10.1f} {w:>10.1f} {e:>10}'.format(
+            n=name,
+            r=counts['reads'] * 1.0 / options.seconds,
+            w=counts['writes'] * 1.0 / options.seconds,
+            e=counts['errors'],
+        )
+
+
+if __name__ == '__main__':
+    # W0703: *Catch "Exception"*
+    # pylint: disable=W0703
+    try:
+        main()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        exit(1)
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+check_indexes.py
+
+Script to report frequent queries that are resolved by full table scans.
+"""
+import datetime
+import logging
+import os
+import sys
+import traceback
+from gluon import *
+from gluon.shell import env
+from optparse import OptionParser
+
+VERSION = 'Version 0.1'
+APP_ENV = env(__file__.split(os.sep)[-3], import_models=True)
+# C0103: *Invalid name "%%s" (should match %%s)*
+# pylint: disable=C0103
+db = APP_ENV['db']
+
+LOG = logging.getLogger('cli')
+
+TODAY = datetime.date.today()
+NOW = datetime.datetime.now()
+
+# (description, function(db) returning the sql of the query)
+QUERIES = [
+    ('book by creator',
+        lambda db: db(db.book.creator_id == 1)._select(db.book.id)),
+    ('book pages',
+        lambda db: db(db.book_page.book_id == 1)._select(
+            db.book_page.id, orderby=db.book_page.page_no)),
+    ('book page by number',
+        lambda db: db((db.book_page.book_id == 1) &
+                      (db.book_page.page_no == 1))._select(db.book_page.id)),
+    ('book links',
+        lambda db: db(db.book_to_link.book_id == 1)._select(
+            db.book_to_link.link_id)),
+    ('creator by user',
+        lambda db: db(db.creator.auth_user_id == 1)._select(db.creator.id)),
+    ('creator links',
+        lambda db: db(db.creator_to_link.creator_id == 1)._select(
+            db.creator_to_link.link_id)),
+    ('page comments',
+        lambda db: db(db.page_comment.book_page_id == 1)._select(
+            db.page_comment.id)),
+    ('ranking page',
+        lambda db: db((db.book_ranking.ranking == 'views') &
+                      (db.book_ranking.rank_no > 0) &
+                      (db.book_ranking.rank_no <= 24))._select(
+            db.book_ranking.book_id)),
+    ('ranking by book',
+        lambda db: db(db.book_ranking.book_id == 1)._select(
+            db.book_ranking.id)),
+    ('tally buckets',
+        lambda db: db((db.book_tally.book_id.belongs([1, 2])) &
+                      (db.book_tally.tally_date >= TODAY))._select(
+            db.book_tally.id)),
+    ('tally expiry',
+        lambda db: db(db.book_tally.tally_date < TODAY)._select(
+            db.book_tally.id)),
+    ('contributions since',
+        lambda db: db(db.contribution.time_stamp >= NOW)._select(
+            db.contribution.id)),
+    ('ratings since',
+        lambda db: db(db.rating.time_stamp >= NOW)._select(db.rating.id)),
+    ('views since',
+        lambda db: db(db.book_view.time_stamp >= NOW)._select(
+            db.book_view.id)),
+    ('image sizes',
+        lambda db: db((db.image_size.image == 'a.jpg') &
+                      (db.image_size.size == 'web'))._select(
+            db.image_size.id)),
+    ('pages by image',
+        lambda db: db(db.book_page.image == 'a.jpg')._select(
+            db.book_page.id)),
+    ('creators by image',
+        lambda db: db(db.creator.image == 'a.jpg')._select(db.creator.id)),
+]
+
+
+def man_page():
+    """Print manual page-like help"""
+    print """
+USAGE
+    check_indexes.py
+    check_indexes.py -v       # Print the sql of every query checked
+
+    The frequent queries of the application are explained by the database
+    and those resolved by a full scan of a table are reported. Indexes are
+    declared in models/1_db.py with Field(..., index=True) or the indexes
+    argument of define_table.
+
+    Exit status is 1 if any query uses a full table scan.
+
+    Databases: sqlite, mysql, postgres. With other databases no queries are
+    reported.
+
+OPTIONS
+    -h, --help
+        Print a brief help.
+
+    --man
+        Print man page-like help.
+
+    -v, --verbose
+        Print every query checked.
+    """
+
+
+def main():
+    """Main processing."""
+
+    usage = '%prog [options]'
+    parser = OptionParser(usage=usage, version=VERSION)
+
+    parser.add_option(
+        '--man',
+        action='store_true', dest='man', default=False,
+        help='Display manual page-like help and exit.',
+    )
+    parser.add_option(
+        '-v', '--verbose',
+        action='store_true', dest='verbose', default=False,
+        help='Print every query checked.',
+    )
+
+    (options, unused_args) = parser.parse_args()
+
+    if options.man:
+        man_page()
+        quit(0)
+
+    logging.basicConfig(
+        level=logging.DEBUG if options.verbose else logging.INFO,
+        format='%(levelname)s - %(message)s',
+    )
+
+    count = 0
+    for description, func in QUERIES:
+        sql = func(db)
+        LOG.debug('{d}: {s}'.format(d=description, s=sql))
+        scans = db._adapter.full_scans(sql)
+        if scans:
+            count += 1
+            LOG.info('{d}: full scan of {t}'.format(
+                d=description, t=', '.join(scans)))
+    LOG.info('Queries: {q}, full scans: {c}'.format(q=len(QUERIES), c=count))
+    if count:
+        exit(1)
+
+
+if __name__ == '__main__':
+    # W0703: *Catch "Exception"*
+    # pylint: disable=W0703
+    try:
+        main()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        exit(1)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+flush_events.py
+
+Script to flush the logged book views, downloads and contributions to the
+database.
+"""
+import logging
+import os
+import sys
+import traceback
+from gluon import *
+from gluon.shell import env
+from optparse import OptionParser
+from applications.zcomix.modules.events import \
+    flush_events, \
+    queue_flush_events
+
+VERSION = 'Version 0.1'
+APP_ENV = env(__file__.split(os.sep)[-3], import_models=True)
+# C0103: *Invalid name "%%s" (should match %%s)*
+# pylint: disable=C0103
+db = APP_ENV['db']
+
+LOG = logging.getLogger('cli')
+
+
+def man_page():
+    """Print manual page-like help"""
+    print """
+USAGE
+    flush_events.py
+    flush_events.py --vv                # Verbose output
+    flush_events.py --queue             # Queue the periodic scheduler task
+
+    Book views, downloads and contributions are appended to an event log,
+    applications/zcomix/private/events/events.log, instead of being written
+    to the database on every request. This script rotates the log and loads
+    the rotated logs into the database. It is safe to run while the
+    scheduler task runs; each rotated log is loaded once.
+
+    Normally the logs are flushed by the flush_events scheduler task. Use
+    --queue once to queue the task. The task repeats indefinitely.
+
+OPTIONS
+    -h, --help
+        Print a brief help.
+
+    --man
+        Print man page-like help.
+
+    -q, --queue
+        Queue the periodic flush_events scheduler task and exit. The task is
+        not queued if it is already queued.
+
+    -v, --verbose
+        Print information messages to stdout.
+
+    --vv,
+        More verbose. Print debug messages to stdout.
+    """
+
+
+def main():
+    """Main processing."""
+
+    usage = '%prog [options]'
+    parser = OptionParser(usage=usage, version=VERSION)
+
+    parser.add_option('--man',
+        action='store_true', dest='man', default=False,
+        help='Display manual page-like help and exit.',
+        )
+    parser.add_option('-q', '--queue',
+        action='store_true', dest='queue', default=False,
+        help='Queue the periodic scheduler task.',
+        )
+    parser.add_option('-v', '--verbose',
+        action='store_true', dest='verbose', default=False,
+        help='Print messages to stdout.',
+        )
+    parser.add_option('--vv',
+        action='store_true', dest='vv', default=False,
+        help='More verbose.',
+        )
+
+    (options, unused_args) = parser.parse_args()
+
+    if options.man:
+        man_page()
+        quit(0)
+
+    if options.verbose or options.vv:
+        level = logging.DEBUG if options.vv else logging.INFO
+        unused_h = [h.setLevel(level) for h in LOG.handlers \
+                if h.__class__ == logging.StreamHandler]
+
+    LOG.info('Started.')
+
+    if options.queue:
+        if queue_flush_events(current.app.scheduler):
+            LOG.info('Task queued.')
+        else:
+            LOG.info('Task is already queued.')
+    else:
+        counts = flush_events()
+        for event_type, count in sorted(counts.items()):
+            LOG.info('Events flushed: {t} {c}'.format(t=event_type, c=count))
+
+    LOG.info('Done.')
+
+
+if __name__ == '__main__':
+    # W0703: *Catch "Exception"*
+    # pylint: disable=W0703
+    try:
+        main()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        exit(1)
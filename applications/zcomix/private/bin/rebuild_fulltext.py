@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+rebuild_fulltext.py
+
+Script to rebuild the full text index of books.
+"""
+import logging
+import os
+import sys
+import traceback
+from gluon import *
+from gluon.shell import env
+from optparse import OptionParser
+from applications.zcomix.modules.fulltext import fulltext_index
+
+VERSION = 'Version 0.1'
+APP_ENV = env(__file__.split(os.sep)[-3], import_models=True)
+# C0103: *Invalid name "%%s" (should match %%s)*
+# pylint: disable=C0103
+db = APP_ENV['db']
+
+LOG = logging.getLogger('cli')
+
+
+def man_page():
+    """Print manual page-like help"""
+    print """
+USAGE
+    rebuild_fulltext.py
+    rebuild_fulltext.py --vv            # Verbose output
+
+    Books are indexed for the keyword search as they are created or
+    updated. This script indexes all books, replacing the index. Run it once
+    after the full text index is set up, the index of an sqlite database is
+    created empty on first use, or after changing the fulltext_backend
+    setting.
+
+OPTIONS
+    -h, --help
+        Print a brief help.
+
+    --man
+        Print man page-like help.
+
+    -v, --verbose
+        Print information messages to stdout.
+
+    --vv,
+        More verbose. Print debug messages to stdout.
+    """
+
+
+def main():
+    """Main processing."""
+
+    usage = '%prog [options]'
+    parser = OptionParser(usage=usage, version=VERSION)
+
+    parser.add_option('--man',
+        action='store_true', dest='man', default=False,
+        help='Display manual page-like help and exit.',
+        )
+    parser.add_option('-v', '--verbose',
+        action='store_true', dest='verbose', default=False,
+        help='Print messages to stdout.',
+        )
+    parser.add_option('--vv',
+        action='store_true', dest='vv', default=False,
+        help='More verbose.',
+        )
+
+    (options, unused_args) = parser.parse_args()
+
+    if options.man:
+        man_page()
+        quit(0)
+
+    if options.verbose or options.vv:
+        level = logging.DEBUG if options.vv else logging.INFO
+        unused_h = [h.setLevel(level) for h in LOG.handlers \
+                if h.__class__ == logging.StreamHandler]
+
+    LOG.info('Started.')
+    index = fulltext_index(db)
+    index.rebuild()
+    db.commit()
+    LOG.info('Books indexed: {c}'.format(c=db(db.book).count()))
+    LOG.info('Done.')
+
+
+if __name__ == '__main__':
+    # W0703: *Catch "Exception"*
+    # pylint: disable=W0703
+    try:
+        main()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        exit(1)
@@ -7,16 +7,27 @@ resize_images.py
 Script to create and maintain images and their sizes.
 """
 import datetime
+import errno
+import itertools
 import logging
+import multiprocessing
 import os
+import shutil
 import sys
+import time
 import traceback
 from gluon import *
+from gluon.contrib.simplejson import dumps, loads
 from gluon.shell import env
 from optparse import OptionParser
 from applications.zcomix.modules.images import \
     UploadImage, \
+    set_image_metadata, \
     set_thumb_dimensions
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 VERSION = 'Version 0.1'
 APP_ENV = env(__file__.split(os.sep)[-3], import_models=True)
@@ -31,6 +42,161 @@ FIELDS = [
     'book_page.image',
 ]
 
+CHECKPOINT_FILE = os.path.join(
+    APP_ENV['request'].folder, 'private', 'resize_images.checkpoint')
+CHUNK_SIZE = 100            # Images per db transaction and progress report
+UPLOADS_DIR = os.path.join(APP_ENV['request'].folder, 'uploads')
+PURGE_GRACE_SECONDS = 3600  # Files modified more recently are not purged.
+
+# Names of the images stored in the database fields. This is set by
+# ImageHandler.purge() before the pool is created so the worker processes
+# inherit it.
+LIVE_NAMES = set()
+
+
+def is_up_to_date(resizer, size):
+    """Return whether the sized version of an image is up to date.
+
+    Args:
+        resizer: UploadImage instance
+        size: string, one of UploadImage.sizes
+
+    Returns:
+        True if the sized file exists and is not older than the original.
+    """
+    sized_filename = resizer.fullname(size=size)
+    if not os.path.exists(sized_filename):
+        return False
+    original_filename = resizer.fullname(size='original')
+    if not os.path.exists(original_filename):
+        return True         # Nothing to resize from.
+    return os.path.getmtime(sized_filename) >= \
+        os.path.getmtime(original_filename)
+
+
+def list_files(path):
+    """Return the files in a directory.
+
+    The scandir module is used if it is installed, it avoids a stat call
+    per file on most filesystems.
+
+    Args:
+        path: string, name of directory
+
+    Returns:
+        list of tuples (name, bytes, mtime)
+    """
+    files = []
+    if scandir:
+        for entry in scandir(path):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime))
+        return files
+    for name in os.listdir(path):
+        fullname = os.path.join(path, name)
+        if os.path.isfile(fullname):
+            stat = os.stat(fullname)
+            files.append((name, stat.st_size, stat.st_mtime))
+    return files
+
+
+def metadata_job(job):
+    """Get the metadata of an image and its sizes from their files.
+
+    This is run in the worker processes of the --jobs pool, so it must not
+    access the database.
+
+    Args:
+        job: tuple, see resize_job. The sizes, force and dry_run values are
+            ignored.
+
+    Returns:
+        tuple, see resize_job.
+    """
+    table_field, record_id, image_name = job[:3]
+    table, field = table_field.split('.')
+    resizer = UploadImage(db[table][field], image_name)
+    return (table_field, record_id, image_name, [], resizer.metadata_all())
+
+
+def purge_job(job):
+    """Purge the orphaned images in a directory.
+
+    This is run in the worker processes of the --jobs pool, so it must not
+    access the database. Images are orphaned if their names are not in
+    LIVE_NAMES. Sizes saved in another format than the original have the
+    extension of the format appended to the name, see UploadImage.fullname().
+
+    Args:
+        job: tuple (path, cutoff, quarantine, dry_run)
+            path: string, name of directory
+            cutoff: float, timestamp, files modified after this are kept.
+            quarantine: string, name of directory orphans are moved to. If
+                None, orphans are deleted.
+            dry_run: If True, only report what would be purged
+
+    Returns:
+        tuple (path, orphans)
+            orphans: list of tuples (name, bytes)
+    """
+    path, cutoff, quarantine, dry_run = job
+    orphans = []
+    for name, size, mtime in list_files(path):
+        if name in LIVE_NAMES or mtime > cutoff \
+                or os.path.splitext(name)[0] in LIVE_NAMES:
+            continue
+        orphans.append((name, size))
+        if dry_run:
+            continue
+        fullname = os.path.join(path, name)
+        if quarantine:
+            dest = os.path.join(
+                quarantine, os.path.relpath(path, UPLOADS_DIR))
+            try:
+                os.makedirs(dest)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            shutil.move(fullname, os.path.join(dest, name))
+        else:
+            os.unlink(fullname)
+    return (path, orphans)
+
+
+def resize_job(job):
+    """Resize an image to sizes.
+
+    This is run in the worker processes of the --jobs pool, so it must not
+    access the database. The job tuple is picklable.
+
+    Args:
+        job: tuple (table_field, record_id, image_name, sizes, force, dry_run)
+            table_field: string, one of FIELDS
+            record_id: integer, id of the database record
+            image_name: string, name of the image as stored in the field
+            sizes: list of strings, sizes to resize to
+            force: If True, resize even if the sized file is up to date
+            dry_run: If True, only report what would be resized
+
+    Returns:
+        tuple (table_field, record_id, image_name, resized, metadata)
+            resized: list of sizes resized
+            metadata: dict, {size: metadata} of the original and the sizes
+                resized, see UploadImage.metadata()
+    """
+    table_field, record_id, image_name, sizes, force, dry_run = job
+    table, field = table_field.split('.')
+    resizer = UploadImage(db[table][field], image_name)
+    resized = [x for x in sizes if force or not is_up_to_date(resizer, x)]
+    metadata = {}
+    if resized and not dry_run:
+        # The original is decoded once for all sizes.
+        resizer.resize_sizes(resized)
+        for size in ['original'] + resized:
+            metadata[size] = resizer.metadata(size=size)
+    return (table_field, record_id, image_name, resized, metadata)
+
 
 class ImageHandler(object):
     """Class representing a handler for image resizing."""
@@ -41,7 +207,11 @@ class ImageHandler(object):
             size=None,
             field=None,
             record_id=None,
-            dry_run=False):
+            dry_run=False,
+            jobs=1,
+            force=False,
+            resume=False,
+            quarantine=None):
         """Constructor
 
         Args:
@@ -51,28 +221,68 @@ class ImageHandler(object):
             field: string, one of FIELDS
             record_id: integer, id of database record.
             dry_run: If True, make no changes.
+            jobs: integer, number of processes used to resize images.
+            force: If True, resize images even if the sized files are up to
+                date.
+            resume: If True, skip images resized by a previous interrupted
+                run as recorded in CHECKPOINT_FILE.
+            quarantine: string, name of directory purged images are moved
+                to. If None, purged images are deleted.
         """
         self.filenames = filenames
         self.size = size
         self.field = field
         self.record_id = record_id
         self.dry_run = dry_run
+        self.jobs = jobs
+        self.force = force
+        self.resume = resume
+        self.quarantine = quarantine
+
+    def checkpoint(self):
+        """Return the checkpoint of a previous interrupted run.
 
-    def image_generator(self):
+        Returns:
+            tuple (table_field, record_id) of the last image resized, or
+                None if there is no checkpoint.
+        """
+        if not os.path.exists(CHECKPOINT_FILE):
+            return None
+        with open(CHECKPOINT_FILE) as f:
+            data = loads(f.read())
+        return (data['field'], data['record_id'])
+
+    def image_generator(self, checkpoint=None):
         """Generator of images.
 
+        Args:
+            checkpoint: tuple (table_field, record_id), images up to and
+                including this one are skipped. Images are generated in
+                order by FIELDS then record id.
+
         Returns:
             tuple: (field, image_name, original image name)
         """
         fields = [self.field] if self.field else FIELDS
+        skip_fields = []
+        if checkpoint and checkpoint[0] in FIELDS:
+            skip_fields = FIELDS[:FIELDS.index(checkpoint[0])]
         for table_field in fields:
+            if table_field in skip_fields:
+                continue
             table, field = table_field.split('.')
             db_field = db[table][field]
             db_table = db[table]
-            query = (db_field)
+            query = (db_field != None)
             if self.record_id:
                 query = (db_table.id == self.record_id)
-            rows = db(query).select(db_table.id, db_field)
+            if checkpoint and checkpoint[0] == table_field:
+                query = query & (db_table.id > checkpoint[1])
+            rows = db(query).select(
+                db_table.id,
+                db_field,
+                orderby=db_table.id
+            )
             for r in rows:
                 original_name, unused_fullname = db_field.retrieve(
                     r.image,
@@ -82,28 +292,281 @@ class ImageHandler(object):
                     continue
                 yield (db_field, r.id, r.image, original_name)
 
+    def live_names(self):
+        """Return the names of the images stored in the database fields.
+
+        Returns:
+            set of strings
+        """
+        fields = [self.field] if self.field else FIELDS
+        names = set()
+        for table_field in fields:
+            table, field = table_field.split('.')
+            db_field = db[table][field]
+            rows = db(db_field != None).select(db_field, cacheable=True)
+            names.update([r[field] for r in rows])
+        return names
+
     def purge(self):
-        """Purge orphanned images."""
-        LOG.warn('NOTICE: The purge feature is not implemented yet.')
-        return
+        """Purge orphaned images.
+
+        An image file is orphaned if its name is not stored in any of the
+        database fields. The upload directories are scanned one directory
+        per job so with jobs > 1 they are scanned and purged in parallel.
+        """
+        global LIVE_NAMES
+        LIVE_NAMES = self.live_names()
+        LOG.info('Images in database: {c}'.format(c=len(LIVE_NAMES)))
+
+        fields = [self.field] if self.field else FIELDS
+        sizes = [self.size] if self.size \
+            else ['original'] + UploadImage.sizes.keys()
+        cutoff = time.time() - PURGE_GRACE_SECONDS
+        jobs = []
+        for size in sizes:
+            for table_field in fields:
+                path = os.path.join(UPLOADS_DIR, size, table_field)
+                if not os.path.isdir(path):
+                    continue
+                # Files in the field directory are uploads in progress.
+                jobs.append((path, cutoff, self.quarantine, self.dry_run))
+                for name in sorted(os.listdir(path)):
+                    subdir = os.path.join(path, name)
+                    if os.path.isdir(subdir):
+                        jobs.append(
+                            (subdir, cutoff, self.quarantine, self.dry_run))
+
+        pool = None
+        if self.jobs > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(processes=self.jobs)
+            results = pool.imap_unordered(purge_job, jobs)
+        else:
+            results = itertools.imap(purge_job, jobs)
+
+        action = 'Dry run' if self.dry_run else 'Purging'
+        orphan_names = set()
+        purged = 0
+        reclaimed = 0
+        start_time = time.time()
+        try:
+            for count, result in enumerate(results, 1):
+                path, orphans = result
+                for name, size in orphans:
+                    LOG.debug('{a}: {p}'.format(
+                        a=action, p=os.path.join(path, name)))
+                    orphan_names.add(name)
+                    purged += 1
+                    reclaimed += size
+                if count % CHUNK_SIZE == 0 or count == len(jobs):
+                    LOG.info(
+                        'Progress: {d}/{t} directories, {p} files,'
+                        ' {b} bytes, {s:0.1f}s'.format(
+                            d=count,
+                            t=len(jobs),
+                            p=purged,
+                            b=reclaimed,
+                            s=time.time() - start_time,
+                        )
+                    )
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if not self.dry_run and orphan_names:
+            # Remove the metadata of the purged images.
+            names = sorted(orphan_names)
+            for i in range(0, len(names), CHUNK_SIZE):
+                chunk = names[i:i + CHUNK_SIZE]
+                db(db.image_size.image.belongs(chunk)).delete()
+                db.commit()
+
+        LOG.info('{a}: {p} files, {b} bytes reclaimed'.format(
+            a='Would purge' if self.dry_run else 'Purged',
+            p=purged,
+            b=reclaimed,
+        ))
+
+    def jobs_list(self, sizes, checkpoint=None):
+        """Return the list of jobs for the worker functions.
+
+        Args:
+            sizes: list of strings, sizes to resize to
+            checkpoint: tuple (table_field, record_id), see image_generator
+
+        Returns:
+            tuple (jobs, originals)
+                jobs: list of tuples, see resize_job
+                originals: dict, {(table_field, record_id): original name}
+        """
+        jobs = []
+        originals = {}
+        for field, record_id, image_name, original in \
+                self.image_generator(checkpoint=checkpoint):
+            jobs.append((
+                str(field),
+                record_id,
+                image_name,
+                sizes,
+                self.force,
+                self.dry_run,
+            ))
+            originals[(str(field), record_id)] = original
+        return (jobs, originals)
+
+    def metadata(self):
+        """Store the metadata of images and their sizes from their files."""
+        jobs, originals = self.jobs_list([])
+        LOG.info('Images to process: {t}'.format(t=len(jobs)))
+        self.process(metadata_job, jobs, originals)
+
+    def process(self, func, jobs, originals, checkpoints=False):
+        """Run jobs and store their results in the database.
+
+        With jobs > 1 the jobs are run by a pool of processes. Database
+        updates are made by this process, one transaction per CHUNK_SIZE
+        images.
+
+        Args:
+            func: function run for each job, resize_job or metadata_job
+            jobs: list of job tuples, see resize_job
+            originals: dict, {(table_field, record_id): original name}
+            checkpoints: If True, a checkpoint is saved after each
+                transaction.
+        """
+        total = len(jobs)
+        pool = None
+        if self.jobs > 1 and total > 1:
+            pool = multiprocessing.Pool(processes=self.jobs)
+            results = pool.imap(func, jobs, chunksize=4)
+        else:
+            results = itertools.imap(func, jobs)
+
+        action = 'Dry run' if self.dry_run else 'Resizing'
+        done = 0
+        resized_count = 0
+        start_time = time.time()
+        try:
+            while True:
+                chunk = list(itertools.islice(results, CHUNK_SIZE))
+                if not chunk:
+                    break
+                for table_field, record_id, image_name, resized, metadata \
+                        in chunk:
+                    for size in resized:
+                        LOG.debug('{a}: {t} {i} {f} {s}'.format(
+                            a=action,
+                            t=table_field.split('.')[0],
+                            i=record_id,
+                            f=originals[(table_field, record_id)],
+                            s=size,
+                        ))
+                    if resized:
+                        resized_count += 1
+                    if self.dry_run or not metadata:
+                        continue
+                    set_image_metadata(
+                        db, image_name, metadata, commit=False)
+                    thumb = metadata.get('thumb', None)
+                    if table_field == 'book_page.image' and thumb:
+                        set_thumb_dimensions(
+                            db,
+                            record_id,
+                            (thumb['width'], thumb['height']),
+                            commit=False
+                        )
+                if not self.dry_run:
+                    db.commit()
+                    if checkpoints:
+                        last = chunk[-1]
+                        self.save_checkpoint(last[0], last[1])
+                done += len(chunk)
+                elapsed = time.time() - start_time
+                rate = done / elapsed if elapsed else 0
+                LOG.info(
+                    'Progress: {d}/{t} images, {r} resized, {s:0.1f} images/s'
+                    .format(d=done, t=total, r=resized_count, s=rate)
+                )
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
 
     def resize(self):
-        """Resize images."""
+        """Resize images.
+
+        After each transaction a checkpoint is saved so an interrupted run
+        can be continued with the resume option.
+        """
         LOG.debug('{a}: {t} {i} {f} {s}'.format(
             a='Action', t='table', i='id', f='image', s='size'))
         sizes = [self.size] if self.size else UploadImage.sizes.keys()
-        for field, record_id, image_name, original in self.image_generator():
-            resizer = UploadImage(field, image_name)
-            for size in sizes:
-                action = 'Dry run' if self.dry_run else 'Resizing'
-                LOG.debug('{a}: {t} {i} {f} {s}'.format(
-                    a=action, t=field.table, i=record_id, f=original, s=size))
-                if not self.dry_run:
-                    resizer.resize(size)
-                    if str(field) == 'book_page.image' and size == 'thumb':
-                        set_thumb_dimensions(
-                            db, record_id, resizer.dimensions(size='thumb')
-                        )
+
+        checkpoint = self.checkpoint() if self.resume else None
+        if checkpoint:
+            LOG.info('Resuming after: {f} {i}'.format(
+                f=checkpoint[0], i=checkpoint[1]))
+
+        jobs, originals = self.jobs_list(sizes, checkpoint=checkpoint)
+        LOG.info('Images to process: {t}'.format(t=len(jobs)))
+        self.process(resize_job, jobs, originals, checkpoints=True)
+
+        if not self.dry_run and os.path.exists(CHECKPOINT_FILE):
+            os.unlink(CHECKPOINT_FILE)
+
+    def save_checkpoint(self, table_field, record_id):
+        """Save the checkpoint of the run.
+
+        Args:
+            table_field: string, one of FIELDS
+            record_id: integer, id of the last record processed.
+        """
+        if self.field or self.record_id or self.filenames:
+            # Only complete runs are resumable.
+            return
+        with open(CHECKPOINT_FILE, 'w') as f:
+            f.write(dumps({'field': table_field, 'record_id': record_id}))
+
+    def savings(self):
+        """Return the bytes of the sizes compared to their originals.
+
+        The report is computed from the metadata in the image_size table,
+        see the metadata option, with one query.
+
+        Returns:
+            list of tuples (size, count, bytes, original_bytes)
+                size: string, name of size
+                count: integer, number of images with the size
+                bytes: integer, total bytes of the size
+                original_bytes: integer, total bytes of the originals of
+                    those images.
+            The first tuple is the originals.
+        """
+        sized = db.image_size
+        original = db.image_size.with_alias('original_size')
+        query = (original.size == 'original') & \
+            (sized.image == original.image)
+        if self.field:
+            query = query & original.image.startswith(self.field + '.')
+        if self.size:
+            query = query & sized.size.belongs(['original', self.size])
+        count = sized.id.count()
+        total = sized.bytes.sum()
+        original_total = original.bytes.sum()
+        rows = db(query).select(
+            sized.size,
+            count,
+            total,
+            original_total,
+            groupby=sized.size,
+            orderby=sized.size,
+        )
+        report = [
+            (r[sized.size], r[count], r[total] or 0, r[original_total] or 0)
+            for r in rows
+        ]
+        report.sort(key=lambda x: x[0] != 'original')
+        return report
 
 
 def man_page():
@@ -130,6 +593,21 @@ USAGE
     # Purge orphaned images and exit.
     resize_images.py --purge
 
+    # Move orphaned images to a quarantine directory, using 8 processes.
+    resize_images.py --purge --quarantine /tmp/orphans --jobs 8
+
+    # Resize all images using 8 processes.
+    resize_images.py --jobs 8
+
+    # Continue an interrupted run.
+    resize_images.py --jobs 8 --resume
+
+    # Store the metadata of existing images and their sizes and exit.
+    resize_images.py --metadata
+
+    # Report the bytes saved by each size compared to the originals.
+    resize_images.py --savings
+
 OPTIONS
     -d, --dry-run
         Do not make any changes, only report what would be done.
@@ -142,6 +620,10 @@ OPTIONS
     --fields
         List all database image fields.
 
+    --force
+        Resize images even if the sized images are up to date. By default
+        a sized image is skipped if its file is not older than the original.
+
     -h, --help
         Print a brief help.
 
@@ -150,12 +632,44 @@ OPTIONS
         id ID. This option requires the --field option to indicate which
         database table the record is from.
 
+    -j N, --jobs=N
+        Resize images using N processes. Default 1. Use 0 for one process per
+        cpu core.
+
     --man
         Print man page-like help.
 
+    -m, --metadata
+        Store the metadata (dimensions, bytes, format, checksum) of the
+        existing original and sized images in the image_size table and exit.
+        Images are not resized.
+
     -p, --purge
-        Delete orphaned images and exit. An orphaned image is a resized image
-        where the original image it was based on no longer exists.
+        Delete orphaned images and exit. An orphaned image is an original or
+        sized image file whose name is not stored in any database image
+        field. Files modified within the last hour are kept, they may be
+        uploads in progress. With --field or --size, only the images of that
+        field or size are purged. Use --dry-run to list the orphans.
+
+        Identical uploads share the stored image so deleting a record, or
+        replacing its image, does not delete the image files. Run --purge
+        periodically, eg daily from cron, to reclaim them.
+
+    -q DIR, --quarantine=DIR
+        With --purge, move orphaned images to the directory DIR instead of
+        deleting them.
+
+    -r, --resume
+        Continue a previous run that was interrupted. Images up to the last
+        checkpoint of that run are skipped. Checkpoints are saved only for
+        runs of all images, ie no FILE, --field or --id.
+
+    --savings
+        Print, for each size, the number of images, their total and average
+        bytes, and the bytes saved compared to the originals of the same
+        images, and exit. The report uses the stored metadata, run with
+        --metadata first if images were resized by an earlier version.
+        With --field or --size, only that field or size is reported.
 
     -s SIZE, --size=SIZE
         By default, images are resized to each of the standard sizes. With
@@ -196,21 +710,51 @@ def main():
         action='store_true', dest='fields', default=False,
         help='List all database image fields and exit.',
     )
+    parser.add_option(
+        '--force',
+        action='store_true', dest='force', default=False,
+        help='Resize images even if sized images are up to date.',
+    )
     parser.add_option(
         '-i', '--id',
         dest='id', default=None,
         help='Resize images associated with record with this id.',
     )
+    parser.add_option(
+        '-j', '--jobs',
+        type='int', dest='jobs', default=1,
+        help='Number of processes. 0 for one per cpu core. Default 1',
+    )
     parser.add_option(
         '--man',
         action='store_true', dest='man', default=False,
         help='Display manual page-like help and exit.',
     )
+    parser.add_option(
+        '-m', '--metadata',
+        action='store_true', dest='metadata', default=False,
+        help='Store metadata of existing images.',
+    )
     parser.add_option(
         '-p', '--purge',
         action='store_true', dest='purge', default=False,
         help='Purge orphaned images.',
     )
+    parser.add_option(
+        '-q', '--quarantine',
+        dest='quarantine', default=None,
+        help='Move purged images to this directory.',
+    )
+    parser.add_option(
+        '-r', '--resume',
+        action='store_true', dest='resume', default=False,
+        help='Continue an interrupted run.',
+    )
+    parser.add_option(
+        '--savings',
+        action='store_true', dest='savings', default=False,
+        help='Report bytes saved by sizes and exit.',
+    )
     parser.add_option(
         '-s', '--size',
         choices=UploadImage.sizes.keys(),
@@ -267,16 +811,37 @@ def main():
     LOG.info('Started.')
     filenames = args or []
 
+    jobs = options.jobs if options.jobs > 0 else multiprocessing.cpu_count()
+
     handler = ImageHandler(
         filenames,
         size=options.size,
         field=options.field,
         record_id=options.id,
         dry_run=options.dry_run,
+        jobs=jobs,
+        force=options.force,
+        resume=options.resume,
+        quarantine=options.quarantine,
     )
 
-    if options.purge:
+    if options.savings:
+        print '{n:<12} {c:>8} {b:>15} {a:>10} {s:>8}'.format(
+            n='Size', c='Images', b='Bytes', a='Average', s='Savings')
+        for size, count, size_bytes, original_bytes in handler.savings():
+            saved = 1 - float(size_bytes) / original_bytes \
+                if original_bytes else 0
+            print '{n:<12} {c:>8} {b:>15} {a:>10} {s:>7.1%}'.format(
+                n=size,
+                c=count,
+                b=size_bytes,
+                a=size_bytes // count if count else 0,
+                s=saved,
+            )
+    elif options.purge:
         handler.purge()
+    elif options.metadata:
+        handler.metadata()
     else:
         handler.resize()
 
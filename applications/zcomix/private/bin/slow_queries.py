@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+slow_queries.py
+
+Script to report the statistics of the slow queries of the application.
+"""
+import logging
+import os
+import sys
+import traceback
+from gluon import *
+from gluon.dal import SlowQueryLog
+from optparse import OptionParser
+from applications.zcomix.modules.stickon.tools import SLOW_QUERY_FILE
+
+VERSION = 'Version 0.1'
+# applications/<app>, this is <app>/private/bin/slow_queries.py
+APP_FOLDER = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+
+LOG = logging.getLogger('cli')
+
+# sort option: function(stats) returning the sort key, largest first
+SORTS = {
+    'count': lambda x: x['count'],
+    'max': lambda x: x['max'],
+    'mean': lambda x: x['seconds'] / x['count'],
+    'total': lambda x: x['seconds'],
+}
+
+
+def man_page():
+    """Print manual page-like help"""
+    print """
+USAGE
+    slow_queries.py
+    slow_queries.py --sort max --limit 5 --plans
+    slow_queries.py --clear
+
+    Queries taking slow_query_ms milliseconds or more are logged, see
+    private/settings.example.conf, and their statistics are added to
+    databases/{f} at the end of each request. This prints them by
+    fingerprint, the sql with its values replaced by ?, largest first.
+
+    For each fingerprint: the number of times it was logged, the total,
+    mean and maximum time in milliseconds, the mean number of rows and the
+    callers, the controller/function of the request or the code of a
+    script. With slow_query_explain = True the last query plan captured is
+    printed with --plans.
+
+OPTIONS
+    -c, --clear
+        Delete the statistics, eg after the indexes are fixed.
+
+    -f FILE, --file=FILE
+        The file of statistics. Default databases/{f}
+
+    -h, --help
+        Print a brief help.
+
+    -l NUMBER, --limit=NUMBER
+        Print at most NUMBER fingerprints. Default all.
+
+    --man
+        Print man page-like help.
+
+    -p, --plans
+        Print the query plans.
+
+    -s SORT, --sort=SORT
+        Sort by: count, max, mean or total. Default total.
+    """.format(f=SLOW_QUERY_FILE)
+
+
+def main():
+    """Main processing."""
+
+    usage = '%prog [options]'
+    parser = OptionParser(usage=usage, version=VERSION)
+
+    parser.add_option(
+        '-c', '--clear',
+        action='store_true', dest='clear', default=False,
+        help='Delete the statistics.',
+    )
+    parser.add_option(
+        '-f', '--file',
+        dest='filename',
+        default=os.path.join(APP_FOLDER, 'databases', SLOW_QUERY_FILE),
+        help='File of statistics. Default databases/{f}'.format(
+            f=SLOW_QUERY_FILE),
+    )
+    parser.add_option(
+        '-l', '--limit',
+        type='int', dest='limit', default=None,
+        help='Print at most this number of fingerprints.',
+    )
+    parser.add_option(
+        '--man',
+        action='store_true', dest='man', default=False,
+        help='Display manual page-like help and exit.',
+    )
+    parser.add_option(
+        '-p', '--plans',
+        action='store_true', dest='plans', default=False,
+        help='Print the query plans.',
+    )
+    parser.add_option(
+        '-s', '--sort',
+        type='choice', choices=sorted(SORTS.keys()), dest='sort',
+        default='total',
+        help='Sort by: count, max, mean or total. Default total.',
+    )
+
+    (options, unused_args) = parser.parse_args()
+
+    if options.man:
+        man_page()
+        quit(0)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(levelname)s - %(message)s',
+    )
+
+    if options.clear:
+        if os.path.exists(options.filename):
+            os.unlink(options.filename)
+        LOG.info('Deleted: {f}'.format(f=options.filename))
+        return
+
+    stats = SlowQueryLog.load(options.filename)
+    fingerprints = sorted(
+        stats.keys(), key=lambda x: SORTS[options.sort](stats[x]),
+        reverse=True)
+    print '{c:>7} {t:>10} {m:>10} {x:>10} {r:>8}'.format(
+        c='count', t='total ms', m='mean ms', x='max ms', r='rows')
+    line = '{c:>7} {t:>10.1f} {m:>10.1f} {x:>10.1f} {r:>8.1f}  {s}'
+    for fingerprint in fingerprints[:options.limit]:
+        item = stats[fingerprint]
+        print line.format(
+            c=item['count'],
+            t=item['seconds'] * 1000,
+            m=item['seconds'] * 1000 / item['count'],
+            x=item['max'] * 1000,
+            r=item['rows'] * 1.0 / item['count'],
+            s=fingerprint,
+        )
+        callers = sorted(
+            item['callers'].items(), key=lambda x: x[1], reverse=True)
+        for caller, count in callers:
+            print '{e:>19}{n:>7} {c}'.format(e='', n=count, c=caller)
+        if options.plans and item['plan']:
+            for step in item['plan']:
+                print '{e:>19}plan: {p}'.format(e='', p=step)
+    LOG.info('Fingerprints: {n}'.format(n=len(stats)))
+
+
+if __name__ == '__main__':
+    # W0703: *Catch "Exception"*
+    # pylint: disable=W0703
+    try:
+        main()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        exit(1)
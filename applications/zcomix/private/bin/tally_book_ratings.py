@@ -7,14 +7,17 @@ tally_book_ratings.py
 Script to tally the yearly and monthly contributions, ratings, and views for
 each book.
 """
-import datetime
 import logging
 import os
 import sys
+import time
 import traceback
 from gluon import *
 from gluon.shell import env
 from optparse import OptionParser
+from applications.zcomix.modules.tallies import \
+    rebuild, \
+    update_tallies
 
 VERSION = 'Version 0.1'
 APP_ENV = env(__file__.split(os.sep)[-3], import_models=True)
@@ -24,22 +27,6 @@ db = APP_ENV['db']
 
 LOG = logging.getLogger('cli')
 
-PERIODS = {
-        # name: days
-        'month': 30,
-        'year': 365,
-        }
-
-RATINGS = [
-    # (book field, data field, period, function)
-    (db.book.contributions_year, db.contribution.amount, 'year', 'sum'),
-    (db.book.contributions_month, db.contribution.amount, 'month', 'sum'),
-    (db.book.rating_year, db.rating.amount, 'year', 'avg'),
-    (db.book.rating_month, db.rating.amount, 'month', 'avg'),
-    (db.book.views_year, db.book_view.id, 'year', 'count'),
-    (db.book.views_month, db.book_view.id, 'month', 'count'),
-    ]
-
 
 def man_page():
     """Print manual page-like help"""
@@ -47,6 +34,13 @@ def man_page():
 USAGE
     tally_book_ratings.py
     tally_book_ratings.py --vv          # Verbose output
+    tally_book_ratings.py --rebuild     # Tally all events from scratch
+
+    Events, contributions, ratings and views, are added to daily tallies per
+    book. Each run adds only the events recorded since the previous run and
+    expires the daily tallies older than a year. The monthly and yearly
+    book tallies are then updated from the daily tallies, and the book
+    rankings used by the front page are rebuilt, in one transaction.
 
 OPTIONS
     -h, --help
@@ -55,6 +49,9 @@ OPTIONS
     --man
         Print man page-like help.
 
+    -r, --rebuild
+        Delete the daily tallies and tally all events.
+
     -v, --verbose
         Print information messages to stdout.
 
@@ -73,6 +70,10 @@ def main():
         action='store_true', dest='man', default=False,
         help='Display manual page-like help and exit.',
         )
+    parser.add_option('-r', '--rebuild',
+        action='store_true', dest='rebuild', default=False,
+        help='Delete the daily tallies and tally all events.',
+        )
     parser.add_option('-v', '--verbose',
         action='store_true', dest='verbose', default=False,
         help='Print messages to stdout.',
@@ -95,24 +96,18 @@ def main():
 
     LOG.info('Started.')
 
-    for rating in RATINGS:
-        field, data_field, period, func = rating
-        LOG.debug('Updating: {f}'.format(f=field))
-        data_table = data_field.table
-        days = PERIODS[period]
-        min_date = datetime.datetime.now() - datetime.timedelta(days=days)
-        query = (data_table.time_stamp >= min_date)
-        if func == 'sum':
-            tally = data_field.sum()
-        elif func == 'avg':
-            tally = data_field.avg()
-        elif func == 'count':
-            tally = data_field.count()
-        rows = db(query).select(data_table.book_id, tally, groupby=data_table.book_id)
-        for r in rows:
-            book_id = r[data_table._tablename]['book_id']
-            value = r[tally] or 0
-            db(db.book.id == book_id).update(**{field.name: value})
+    start = time.time()
+    if options.rebuild:
+        LOG.debug('Deleting daily tallies.')
+        rebuild(db)
+
+    results = update_tallies(db)
+    for tablename, count in sorted(results['events'].items()):
+        LOG.debug('Events added: {t} {c}'.format(t=tablename, c=count))
+    LOG.debug('Daily tallies expired: {c}'.format(c=results['expired']))
+    LOG.info('Books updated: {c} in {s:0.2f}s'.format(
+        c=results['books'], s=time.time() - start))
+    LOG.debug('Books ranked: {c}'.format(c=results['ranked']))
 
     LOG.info('Done.')
 
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark_resize.py
+
+Script to benchmark image resizing.
+
+Compares UploadImage.resize_all(), which decodes the original once, with
+the previous method which decoded the original once per size.
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from gluon import *
+from gluon.shell import env
+from optparse import OptionParser
+from PIL import Image, ImageDraw
+from applications.zcomix.modules.images import UploadImage
+
+VERSION = 'Version 0.1'
+APP_ENV = env(__file__.split(os.sep)[-3], import_models=True)
+# C0103: *Invalid name "%%s" (should match %%s)*
+# pylint: disable=C0103
+db = APP_ENV['db']
+
+LOG = logging.getLogger('cli')
+
+# A letter page scanned at 600 dpi.
+DEFAULT_WIDTH = 5100
+DEFAULT_HEIGHT = 6600
+
+
+def create_scan(filename, width, height):
+    """Create an image similar to a scanned comic page.
+
+    Args:
+        filename: string, name of file to save image to.
+        width: integer, width of image in pixels
+        height: integer, height of image in pixels
+    """
+    im = Image.new('RGB', (width, height), '#f4f1e8')
+    draw = ImageDraw.Draw(im)
+    # Panels with borders and some line art.
+    panel_w = width / 2
+    panel_h = height / 3
+    for row in range(3):
+        for col in range(2):
+            x0 = col * panel_w + 50
+            y0 = row * panel_h + 50
+            x1 = x0 + panel_w - 100
+            y1 = y0 + panel_h - 100
+            draw.rectangle([x0, y0, x1, y1], outline='#000000')
+            for i in range(0, panel_w - 100, 37):
+                draw.line(
+                    [x0 + i, y0, x1 - i / 2, y1],
+                    fill='#{c:02x}{c:02x}{c:02x}'.format(c=(i * 7) % 256)
+                )
+    im.save(filename, quality=90)
+
+
+def legacy_resize_all(resizer):
+    """Resize all sizes decoding the original for each size.
+
+    This replicates UploadImage.resize_all() prior to the single-pass
+    engine.
+
+    Args:
+        resizer: UploadImage instance
+    """
+    for size in resizer.sizes.keys():
+        original_filename = resizer.fullname(size='original')
+        sized_filename = resizer.fullname(size=size)
+        sized_path = os.path.dirname(sized_filename)
+        if not os.path.exists(sized_path):
+            os.makedirs(sized_path)
+        im = Image.open(original_filename)
+        im.thumbnail(resizer.sizes[size], Image.ANTIALIAS)
+        im.save(sized_filename)
+    for size in resizer.sizes.keys():
+        Image.open(resizer.fullname(size=size)).size
+
+
+def single_pass_resize_all(resizer):
+    """Resize all sizes with the single-pass engine.
+
+    Args:
+        resizer: UploadImage instance
+    """
+    resizer.resize_all()
+    for size in resizer.sizes.keys():
+        resizer.dimensions(size=size)
+
+
+def time_it(func, image_name, iterations):
+    """Time a resize function.
+
+    Args:
+        func: callable, func(resizer)
+        image_name: string, name of the image as stored in db.book_page.image
+        iterations: integer, number of times to run func
+
+    Returns:
+        float, average seconds per run
+    """
+    elapsed = 0.0
+    for unused_i in range(iterations):
+        resizer = UploadImage(db.book_page.image, image_name)
+        for size in resizer.sizes.keys():
+            resizer.delete(size)
+        start = time.time()
+        func(resizer)
+        elapsed += time.time() - start
+    return elapsed / iterations
+
+
+def man_page():
+    """Print manual page-like help"""
+    print """
+USAGE
+    benchmark_resize.py [OPTIONS]
+
+    # Benchmark with a 600 dpi letter page.
+    benchmark_resize.py
+
+    # Benchmark with a 3000 x 4000 image, 10 iterations.
+    benchmark_resize.py --width 3000 --height 4000 --iterations 10
+
+OPTIONS
+    -h, --help
+        Print a brief help.
+
+    --height=PX
+        Height of the test image in pixels. Default {h}
+
+    -i N, --iterations=N
+        Number of times each method is run. Default 5.
+
+    --man
+        Print man page-like help.
+
+    -v, --verbose
+        Print information messages to stdout.
+
+    --vv,
+        More verbose. Print debug messages to stdout.
+
+    --width=PX
+        Width of the test image in pixels. Default {w}
+    """.format(w=DEFAULT_WIDTH, h=DEFAULT_HEIGHT)
+
+
+def main():
+    """Main processing."""
+
+    usage = '%prog [options]'
+    parser = OptionParser(usage=usage, version=VERSION)
+
+    parser.add_option(
+        '--height',
+        type='int', dest='height', default=DEFAULT_HEIGHT,
+        help='Height of test image in pixels.',
+    )
+    parser.add_option(
+        '-i', '--iterations',
+        type='int', dest='iterations', default=5,
+        help='Number of times each method is run.',
+    )
+    parser.add_option(
+        '--man',
+        action='store_true', dest='man', default=False,
+        help='Display manual page-like help and exit.',
+    )
+    parser.add_option(
+        '-v', '--verbose',
+        action='store_true', dest='verbose', default=False,
+        help='Print messages to stdout.',
+    )
+    parser.add_option(
+        '--vv',
+        action='store_true', dest='vv', default=False,
+        help='More verbose.',
+    )
+    parser.add_option(
+        '--width',
+        type='int', dest='width', default=DEFAULT_WIDTH,
+        help='Width of test image in pixels.',
+    )
+
+    (options, unused_args) = parser.parse_args()
+
+    if options.man:
+        man_page()
+        quit(0)
+
+    if options.verbose or options.vv:
+        level = logging.DEBUG if options.vv else logging.INFO
+        unused_h = [
+            h.setLevel(level) for h in LOG.handlers
+            if h.__class__ == logging.StreamHandler
+        ]
+
+    LOG.info('Started.')
+
+    tmp_dir = tempfile.mkdtemp(prefix='benchmark_resize_')
+    try:
+        original_path = os.path.join(tmp_dir, 'original')
+        os.makedirs(original_path)
+        db.book_page.image.uploadfolder = original_path
+
+        scan_filename = os.path.join(tmp_dir, 'scan.jpg')
+        LOG.debug('Creating {w} x {h} test image'.format(
+            w=options.width, h=options.height))
+        create_scan(scan_filename, options.width, options.height)
+        with open(scan_filename, 'rb') as f:
+            image_name = db.book_page.image.store(f, 'scan.jpg')
+
+        legacy = time_it(legacy_resize_all, image_name, options.iterations)
+        single = time_it(
+            single_pass_resize_all, image_name, options.iterations)
+
+        print 'Image: {w} x {h}, {b} bytes, {i} iterations'.format(
+            w=options.width,
+            h=options.height,
+            b=os.stat(scan_filename).st_size,
+            i=options.iterations,
+        )
+        print '    decode per size: {s:0.3f}s per image'.format(s=legacy)
+        print '    single pass:     {s:0.3f}s per image'.format(s=single)
+        if single:
+            print '    speedup:         {x:0.1f}x'.format(x=legacy / single)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    LOG.info('Done.')
+
+
+if __name__ == '__main__':
+    # W0703: *Catch "Exception"*
+    # pylint: disable=W0703
+    try:
+        main()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        exit(1)
@@ -0,0 +1,110 @@
+(function () {
+    "use strict";
+
+    // Pages are loaded from the book manifest as they are read.
+    //   slider: the current page, PREFETCH pages ahead and one behind.
+    //   scroller: the pages in view and SCROLL_MARGIN screens above and
+    //             below.
+    var PREFETCH = 2;
+    var SCROLL_MARGIN = 1;
+
+    function load_image(slide) {
+        var img = slide.children('img');
+        if (img.length && !img.attr('src')) {
+            if (img.data('srcset')) {
+                // The browser picks the smallest adequate size.
+                img.attr({srcset: img.data('srcset'), sizes: img.data('sizes')});
+            }
+            img.attr('src', img.data('src'));
+        }
+    }
+
+    function add_pages(parent, manifest, css_class) {
+        $.each(manifest.pages, function (num, page) {
+            var img = $('<img>')
+                .data({src: page.urls.original, srcset: page.srcset, sizes: page.sizes})
+                .css({maxWidth: '100%', height: 'auto'});
+            var dimensions = page.dimensions.original;
+            if (dimensions) {
+                // Reserve the space of the page until it is loaded.
+                img.attr({width: dimensions[0], height: dimensions[1]});
+            }
+            $('<div>')
+                .attr('id', 'img-' + num)
+                .addClass(css_class)
+                .data('num', num)
+                .append(img)
+                .appendTo(parent);
+        });
+    }
+
+    function slider(container, manifest, current) {
+        var count = manifest.pages.length;
+        add_pages(container, manifest, 'slide');
+
+        function show_slide(num) {
+            var i;
+            container.children('.slide').hide();
+            container.children('#img-' + num).css('display', 'inline-block');
+            for (i = num - 1; i <= num + PREFETCH; i++) {
+                load_image(container.children('#img-' + ((i + count) % count)));
+            }
+        }
+
+        container.on('click', '.slide', function () {
+            current = (current + 1) % count;
+            show_slide(current);
+        });
+        show_slide(current < count ? current : 0);
+    }
+
+    function scroller(container, manifest, current) {
+        var inner = container.children('#reader_inner_container');
+        var timer = null;
+        add_pages(inner, manifest, 'scroller');
+
+        function load_visible() {
+            var height = $(window).height();
+            var top = $(window).scrollTop() - height * SCROLL_MARGIN;
+            var bottom = $(window).scrollTop() + height * (1 + SCROLL_MARGIN);
+            inner.children('.scroller').each(function () {
+                var offset = $(this).offset().top;
+                if (offset + $(this).outerHeight() >= top && offset <= bottom) {
+                    load_image($(this));
+                }
+            });
+        }
+
+        $(window).on('scroll resize', function () {
+            if (!timer) {
+                timer = setTimeout(function () {
+                    timer = null;
+                    load_visible();
+                }, 100);
+            }
+        });
+        if (current && current < manifest.pages.length) {
+            $(window).scrollTop(inner.children('#img-' + current).offset().top);
+        }
+        load_visible();
+    }
+
+    $(document).ready(function(){
+        var container = $('#reader_container');
+        var readers = {slider: slider, scroller: scroller};
+        var reader = readers[container.data('mode')];
+        if (!reader || !container.data('manifest')) {
+            return;
+        }
+        $.getJSON(container.data('manifest'), function (manifest) {
+            if (manifest.pages.length) {
+                reader(
+                    container,
+                    manifest,
+                    parseInt(container.data('page'), 10) || 0
+                );
+            }
+        });
+    });
+
+}());
@@ -7,6 +7,7 @@ Test suite for zcomix/controllers/books.py
 
 """
 import unittest
+import urllib2
 from applications.zcomix.modules.test_runner import LocalTestCase
 
 
@@ -71,6 +72,14 @@ class TestFunctions(LocalTestCase):
             bid=self._book.id),
             self.titles['carousel']))
 
+    def test__download(self):
+        # Invalid id
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            web.test('{url}/download/{bid}'.format(url=self.url,
+                bid=self._invalid_book_id), None)
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(cm.exception.msg, 'NOT FOUND')
+
     def test__index(self):
         self.assertTrue(web.test('{url}/index'.format(url=self.url),
             self.titles['default']))
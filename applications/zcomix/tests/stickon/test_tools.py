@@ -9,6 +9,7 @@ Test suite for zcomix/modules/stickon/tools.py
 import os
 import unittest
 from ConfigParser import NoSectionError
+from gluon.dal import DAL, Field
 from gluon.shell import env
 from gluon.storage import Storage
 from applications.zcomix.modules.stickon.tools import \
@@ -86,6 +87,68 @@ version = '0.1'
         model_db._server_mode = None       # Reset
         self.assertEqual(model_db.get_server_mode(), 'test')
 
+    def test__mark(self):
+        model_db = ModelDb(APP_ENV, init_all=False)
+        self.assertEqual([x[0] for x in model_db.timings], ['settings'])
+        model_db.mark('tables')
+        self.assertEqual(
+            [x[0] for x in model_db.timings], ['settings', 'tables'])
+        self.assertTrue(model_db.timings[1][1] >= 0)
+
+    def test__model_mode(self):
+        # W0212: *Access to a protected member %%s of a client class*
+        # pylint: disable=W0212
+        model_db = ModelDb(APP_ENV, init_all=False)
+        model_db.local_settings.model_mode = None
+        self.assertEqual(model_db.model_mode(), 'development')
+        model_db._server_mode = 'live'
+        self.assertEqual(model_db.model_mode(), 'production')
+        model_db.local_settings.model_mode = 'development'
+        self.assertEqual(model_db.model_mode(), 'development')
+        model_db._server_mode = 'test'
+        model_db.local_settings.model_mode = 'production'
+        self.assertEqual(model_db.model_mode(), 'production')
+
+    def test__needs_validators(self):
+        model_db = ModelDb(APP_ENV, init_all=False)
+        request = model_db.environment['request']
+        controller = request.controller
+        request.controller = 'books'
+        model_db.local_settings.model_mode = 'development'
+        self.assertTrue(model_db.needs_validators(['profile']))
+        model_db.local_settings.model_mode = 'production'
+        self.assertFalse(model_db.needs_validators(['profile']))
+        self.assertTrue(model_db.needs_validators(['books', 'profile']))
+        request.controller = controller
+
+    def test__report_queries(self):
+        model_db = ModelDb(APP_ENV, init_all=False)
+        db = DAL('sqlite:memory')
+        db.define_table('report_queries', Field('name'))
+        recorder = db.record_queries()
+        for name in ['a', 'b', 'c']:
+            db(db.report_queries.name == name).select()
+        self.assertEqual(len(recorder.repeated()), 1)
+        model_db.report_queries(recorder)       # Logs, no exception
+        db.close()
+
+    def test__report_timing(self):
+        model_db = ModelDb(APP_ENV, init_all=False)
+        model_db.timings = [('db', 0.0012), ('tables', 0.0034)]
+        model_db.local_settings.model_timing = False
+        self.assertEqual(model_db.report_timing(), None)
+
+        model_db.local_settings.model_timing = True
+        self.assertEqual(
+            model_db.report_timing(),
+            'db 1.2ms, tables 3.4ms, total 4.6ms'
+        )
+        self.assertEqual(
+            model_db.environment['response'].headers['Server-Timing'],
+            'db;dur=1.2, tables;dur=3.4, total;dur=4.6'
+        )
+        del model_db.environment['response'].headers['Server-Timing']
+
     def test__verify_email_onaccept(self):
         pass        # Not testable
 
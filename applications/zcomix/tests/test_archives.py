@@ -0,0 +1,335 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Test suite for zcomix/modules/archives.py
+
+"""
+import datetime
+import os
+import shutil
+import unittest
+import zipfile
+import zlib
+from PIL import Image
+from cStringIO import StringIO
+from gluon import *
+from gluon.http import HTTP
+from gluon.storage import List, Storage
+from applications.zcomix.modules.archives import \
+    ARCHIVE_CONTENT_TYPE, \
+    ArchiveDownloader, \
+    BookArchive, \
+    cache_while_streaming, \
+    dos_datetime, \
+    file_crc32, \
+    parse_range, \
+    segment_length
+from applications.zcomix.modules.events import flush_events
+from applications.zcomix.modules.test_runner import LocalTestCase
+
+# C0111: Missing docstring
+# R0904: Too many public methods
+# pylint: disable=C0111,R0904
+
+
+class ArchiveTestCase(LocalTestCase):
+    """ Base class for archive test cases. Sets up test data."""
+
+    _book = None
+    _image_dir = '/tmp/image_for_archives'
+    _image_original = os.path.join(_image_dir, 'original')
+
+    _objects = []
+
+    # C0103: *Invalid name "%s" (should match %s)*
+    # pylint: disable=C0103
+    @classmethod
+    def setUp(cls):
+        if not os.path.exists(cls._image_original):
+            os.makedirs(cls._image_original)
+
+        db.book_page.image.uploadfolder = cls._image_original
+
+        def create_image(image_name, colour):
+            image_filename = os.path.join(cls._image_dir, image_name)
+            im = Image.new('RGB', (300, 400), colour)
+            with open(image_filename, 'wb') as f:
+                im.save(f)
+            with open(image_filename, 'rb') as f:
+                stored_filename = db.book_page.image.store(f)
+            return stored_filename
+
+        book_id = db.book.insert(name='Archive "Test" Book', downloads=0)
+        db.commit()
+        cls._book = db(db.book.id == book_id).select().first()
+        cls._objects.append(cls._book)
+
+        for page_no, colour in enumerate(['#FF0000', '#00FF00'], 1):
+            book_page_id = db.book_page.insert(
+                book_id=book_id,
+                page_no=page_no,
+                image=create_image('page_{p}.jpg'.format(p=page_no), colour),
+            )
+            db.commit()
+            book_page = db(db.book_page.id == book_page_id).select().first()
+            cls._objects.append(book_page)
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.exists(cls._image_dir):
+            shutil.rmtree(cls._image_dir)
+        archive = BookArchive(db, cls._book)
+        if os.path.exists(archive.cache_name()):
+            os.unlink(archive.cache_name())
+
+
+class TestArchiveDownloader(ArchiveTestCase):
+
+    def test__download(self):
+        env = globals()
+        request = env['request']
+        request.args = List([self._book.id])
+        request.env.http_range = None
+
+        def download():
+            try:
+                ArchiveDownloader().download(request, db)
+            except HTTP as http:
+                return http
+            self.fail('HTTP not raised')
+
+        def downloads():
+            # Download events are written behind, flush them.
+            flush_events(grace=0)
+            book = db(db.book.id == self._book.id).select().first()
+            return book.downloads
+
+        archive = BookArchive(db, self._book)
+
+        http = download()
+        self.assertEqual(http.status, 200)
+        self.assertEqual(http.headers['Content-Type'], ARCHIVE_CONTENT_TYPE)
+        self.assertEqual(
+            http.headers['Content-Disposition'],
+            'attachment; filename="Archive Test Book.cbz"'
+        )
+        self.assertEqual(http.headers['Content-Length'], archive.size)
+        self.assertEqual(http.headers['ETag'], archive.etag())
+        self.assertEqual(http.headers['Accept-Ranges'], 'bytes')
+        data = ''.join(http.body)
+        self.assertEqual(len(data), archive.size)
+        zip_file = zipfile.ZipFile(StringIO(data))
+        self.assertEqual(zip_file.testzip(), None)
+        self.assertEqual(zip_file.namelist(), ['001.jpg', '002.jpg'])
+        self.assertEqual(downloads(), 1)
+
+        # Resumed download
+        request.env.http_range = 'bytes=100-'
+        http = download()
+        self.assertEqual(http.status, 206)
+        self.assertEqual(
+            http.headers['Content-Range'],
+            'bytes 100-{l}/{s}'.format(l=archive.size - 1, s=archive.size)
+        )
+        self.assertEqual(''.join(http.body), data[100:])
+        self.assertEqual(downloads(), 1)
+        request.env.http_range = None
+
+        # Not modified
+        request.env.http_if_none_match = archive.etag()
+        http = download()
+        self.assertEqual(http.status, 304)
+        request.env.http_if_none_match = None
+        self.assertEqual(downloads(), 1)
+
+        # Released books are cached.
+        self._book.update_record(release_date=datetime.date.today())
+        db.commit()
+        self.assertFalse(os.path.exists(archive.cache_name()))
+        http = download()
+        self.assertEqual(''.join(http.body), data)
+        self.assertTrue(os.path.exists(archive.cache_name()))
+        # The layout, which reads every page, is not built for a cached
+        # archive.
+        def no_layout(unused_self):
+            self.fail('layout built for a cached archive')
+
+        save_layout = BookArchive.layout
+        BookArchive.layout = no_layout
+        try:
+            http = download()
+        finally:
+            BookArchive.layout = save_layout
+        self.assertEqual(http.status, 200)
+        self.assertEqual(http.headers['Content-Length'], archive.size)
+        self.assertEqual(''.join(http.body), data)
+        self.assertEqual(downloads(), 3)
+
+        # Invalid book
+        request.args = List([-1])
+        http = download()
+        self.assertEqual(http.status, 404)
+
+
+class TestBookArchive(ArchiveTestCase):
+
+    def test____init__(self):
+        archive = BookArchive(db, self._book)
+        self.assertTrue(archive)
+        self.assertEqual(len(archive.entries), 2)
+
+    def test__book_entries(self):
+        archive = BookArchive(db, self._book)
+        entries = archive.book_entries()
+        self.assertEqual([x[0] for x in entries], ['001.jpg', '002.jpg'])
+        for unused_arcname, fullname in entries:
+            self.assertTrue(os.path.exists(fullname))
+
+    def test__cache_name(self):
+        archive = BookArchive(db, self._book)
+        self.assertEqual(
+            os.path.basename(archive.cache_name()),
+            'book.{i}.{e}.cbz'.format(
+                i=self._book.id, e=archive.etag().strip('"'))
+        )
+
+    def test__chunks(self):
+        archive = BookArchive(db, self._book)
+        data = ''.join(archive.chunks())
+        self.assertEqual(len(data), archive.size)
+        for start, stop in [(0, 10), (5, 2000), (1000, archive.size)]:
+            self.assertEqual(
+                ''.join(archive.chunks(start, stop, chunk_size=100)),
+                data[start:stop]
+            )
+
+    def test__etag(self):
+        archive = BookArchive(db, self._book)
+        etag = archive.etag()
+        self.assertEqual(len(etag), 18)
+        self.assertEqual(BookArchive(db, self._book).etag(), etag)
+        archive.entries = archive.entries[:1]
+        self.assertNotEqual(archive.etag(), etag)
+
+    def test__filename(self):
+        archive = BookArchive(db, self._book)
+        self.assertEqual(archive.filename(), 'Archive Test Book.cbz')
+        archive.book = Storage(name='')
+        self.assertEqual(archive.filename(), 'book.cbz')
+
+    def test__layout(self):
+        archive = BookArchive(db, self._book)
+        layout = archive.layout()
+        # header, data, header, data, central directory
+        self.assertEqual(len(layout), 5)
+        self.assertTrue(layout[0].startswith('PK\x03\x04'))
+        self.assertEqual(layout[1][0], archive.entries[0][1])
+        self.assertTrue('PK\x01\x02' in layout[4])
+        self.assertTrue('PK\x05\x06' in layout[4])
+
+    def test__size(self):
+        archive = BookArchive(db, self._book)
+        self.assertEqual(archive.size, len(''.join(archive.chunks())))
+
+    def test__stats(self):
+        archive = BookArchive(db, self._book)
+        stats = archive.stats()
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats[0][2], os.stat(archive.entries[0][1]).st_size)
+
+
+class TestFunctions(ArchiveTestCase):
+
+    def test__cache_while_streaming(self):
+        cache_dir = os.path.join(self._image_dir, 'archives')
+        cache_name = os.path.join(cache_dir, 'book.1.abc.cbz')
+        old_name = os.path.join(cache_dir, 'book.1.old.cbz')
+        other_name = os.path.join(cache_dir, 'book.11.old.cbz')
+
+        chunks = ['aaa', 'bbb', 'ccc']
+        self.assertEqual(list(cache_while_streaming(chunks, cache_name)),
+                         chunks)
+        with open(cache_name) as f:
+            self.assertEqual(f.read(), 'aaabbbccc')
+
+        # Older archives of the book are removed.
+        for name in [old_name, other_name]:
+            with open(name, 'w') as f:
+                f.write('old')
+        os.unlink(cache_name)
+        list(cache_while_streaming(chunks, cache_name))
+        self.assertTrue(os.path.exists(cache_name))
+        self.assertFalse(os.path.exists(old_name))
+        self.assertTrue(os.path.exists(other_name))
+
+        # Incomplete streams are not cached.
+        os.unlink(cache_name)
+        gen = cache_while_streaming(chunks, cache_name)
+        gen.next()
+        gen.close()
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['book.11.old.cbz'])
+
+    def test__dos_datetime(self):
+        tests = [
+            # (datetime, expect)
+            (datetime.datetime(1980, 1, 1, 0, 0, 0), (0, 33)),
+            (datetime.datetime(2014, 7, 15, 13, 45, 31), (28079, 17647)),
+        ]
+        for t in tests:
+            timestamp = int(t[0].strftime('%s'))
+            self.assertEqual(dos_datetime(timestamp), t[1])
+
+    def test__file_crc32(self):
+        filename = os.path.join(self._image_dir, 'crc.txt')
+        with open(filename, 'wb') as f:
+            f.write('abcdef' * 1000)
+        self.assertEqual(
+            file_crc32(filename, chunk_size=7),
+            zlib.crc32('abcdef' * 1000) & 0xFFFFFFFF
+        )
+
+    def test__parse_range(self):
+        request = Storage(env=Storage())
+        tests = [
+            # (range, if_range, expect)
+            (None, None, None),
+            ('bytes=0-9', None, (0, 9)),
+            ('bytes=10-', None, (10, 99)),
+            ('bytes=-10', None, (90, 99)),
+            ('bytes=50-500', None, (50, 99)),
+            ('bytes=0-9', '"abc"', (0, 9)),
+            ('bytes=0-9', '"xyz"', None),
+            ('bytes=0-9,20-29', None, None),
+            ('items=0-9', None, None),
+        ]
+        for t in tests:
+            request.env.http_range = t[0]
+            request.env.http_if_range = t[1]
+            self.assertEqual(parse_range(request, 100, '"abc"'), t[2])
+
+        request.env.http_if_range = None
+        request.env.http_range = 'bytes=200-'
+        try:
+            parse_range(request, 100)
+        except HTTP as http:
+            self.assertEqual(http.status, 416)
+            self.assertEqual(http.headers['Content-Range'], 'bytes */100')
+        else:
+            self.fail('HTTP not raised')
+
+    def test__segment_length(self):
+        self.assertEqual(segment_length('abc'), 3)
+        self.assertEqual(segment_length(('/tmp/file.jpg', 1234)), 1234)
+
+
+def setUpModule():
+    """Set up web2py environment."""
+    # C0103: *Invalid name "%%s" (should match %%s)*
+    # pylint: disable=C0103
+    LocalTestCase.set_env(globals())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,11 +14,23 @@ from PIL import Image
 from gluon import *
 from gluon.contrib.simplejson import loads
 from applications.zcomix.modules.books import \
+    book_manifest, \
     book_pages_as_json, \
     book_page_for_json, \
     cover_image, \
+    cover_image_for_page, \
+    cover_images, \
     default_contribute_amount, \
+    first_pages, \
+    manifest_version, \
     read_link
+from applications.zcomix.modules.images import \
+    SRCSET_SIZES, \
+    image_metadata, \
+    image_srcset, \
+    set_image_ladder, \
+    set_image_metadata, \
+    size_names
 from applications.zcomix.modules.test_runner import LocalTestCase
 
 # C0111: Missing docstring
@@ -71,6 +83,7 @@ class ImageTestCase(LocalTestCase):
             book_id=book_id,
             page_no=1,
             image=create_image('file.jpg'),
+            image_filename='file.jpg',
         )
         db.commit()
         cls._book_page = db(db.book_page.id == book_page_id).select().first()
@@ -81,6 +94,7 @@ class ImageTestCase(LocalTestCase):
             book_id=book_id,
             page_no=2,
             image=create_image('file_2.jpg'),
+            image_filename='file_2.jpg',
         )
         db.commit()
         book_page_2 = db(db.book_page.id == book_page_id_2).select().first()
@@ -94,6 +108,77 @@ class ImageTestCase(LocalTestCase):
 
 class TestFunctions(ImageTestCase):
 
+    def test__book_manifest(self):
+        manifest = book_manifest(db, self._book)
+        self.assertEqual(manifest['book_id'], self._book.id)
+        self.assertEqual(
+            manifest['version'], manifest_version(db, self._book))
+        self.assertEqual(manifest['page_count'], 2)
+        self.assertEqual(manifest['sizes'], size_names())
+        pages = manifest['pages']
+        self.assertEqual([x['page_no'] for x in pages], [1, 2])
+        self.assertEqual(pages[0]['id'], self._book_page.id)
+        self.assertTrue(pages[0]['processing'])
+        # Not resized, only the original.
+        self.assertEqual(pages[0]['dimensions'], {})
+        self.assertEqual(
+            pages[0]['urls'],
+            {
+                'original': '/zcomix/images/download/{i}?size=original'.format(
+                    i=self._book_page.image),
+            }
+        )
+        self.assertEqual(pages[0]['srcset'], None)
+        self.assertEqual(pages[0]['sizes'], None)
+
+        set_image_metadata(
+            db,
+            self._book_page.image,
+            {
+                'original': dict(width=1200, height=1200),
+                'medium': dict(width=500, height=500),
+            },
+        )
+        pages = book_manifest(db, self._book, version='abc')['pages']
+        self.assertEqual(
+            pages[0]['dimensions'],
+            {'original': [1200, 1200], 'medium': [500, 500]}
+        )
+        self.assertEqual(sorted(pages[0]['urls'].keys()), ['medium', 'original'])
+        self.assertEqual(
+            pages[0]['urls']['medium'],
+            '/zcomix/images/download/{i}?size=medium'.format(
+                i=self._book_page.image),
+        )
+
+        # Pages with ladder sizes have a srcset.
+        set_image_ladder(widths=[640], encodings=['jpeg'])
+        try:
+            set_image_metadata(
+                db,
+                self._book_page.image,
+                {'w640': dict(width=640, height=640)},
+            )
+            pages = book_manifest(db, self._book, version='abc')['pages']
+            stored = image_metadata(db, [self._book_page.image])
+            self.assertEqual(
+                pages[0]['srcset'],
+                image_srcset(
+                    self._book_page.image, stored[self._book_page.image])[0]
+            )
+            self.assertEqual(pages[0]['sizes'], SRCSET_SIZES.format(w=1200))
+            self.assertTrue('w640' in pages[0]['urls'])
+        finally:
+            set_image_ladder(
+                widths=current.app.local_settings.image_widths,
+                encodings=current.app.local_settings.image_encodings,
+            )
+        set_image_metadata(
+            db,
+            self._book_page.image,
+            {'original': None, 'medium': None, 'w640': None},
+        )
+
     def test__book_pages_as_json(self):
         as_json = book_pages_as_json(db, self._book.id)
         data = loads(as_json)
@@ -103,6 +188,7 @@ class TestFunctions(ImageTestCase):
             'deleteType',
             'deleteUrl',
             'name',
+            'processing',
             'size',
             'thumbnailUrl',
             'url',
@@ -117,12 +203,11 @@ class TestFunctions(ImageTestCase):
         self.assertEqual(len(data['files']), 1)
         self.assertEqual(data['files'][0]['name'], 'file.jpg')
 
-    def test__book_page_for_json(self):
+        # The pages and their metadata are read once, not per page.
+        with self.assertMaxQueries(2):
+            book_pages_as_json(db, self._book.id)
 
-        filename, original_fullname = db.book_page.image.retrieve(
-            self._book_page.image,
-            nameonly=True,
-        )
+    def test__book_page_for_json(self):
 
         url = '/zcomix/images/download/{img}'.format(img=self._book_page.image)
         thumb = '/zcomix/images/download/{img}?size=thumb'.format(img=self._book_page.image)
@@ -134,12 +219,13 @@ class TestFunctions(ImageTestCase):
         self.assertEqual(
             book_page_for_json(db, self._book_page.id),
             {
-                'name': filename,
+                'name': 'file.jpg',
                 'size': 23127,
                 'url': url,
                 'thumbnailUrl': thumb,
                 'deleteUrl': delete_url,
                 'deleteType': 'DELETE',
+                'processing': True,
             }
         )
 
@@ -176,6 +262,39 @@ class TestFunctions(ImageTestCase):
             '<img src="/zcomix/images/download/page_trees.png?size=original" />'
         )
 
+    def test__cover_image_for_page(self):
+        placeholder = '<div class="portrait_placeholder"></div>'
+        self.assertEqual(str(cover_image_for_page(None)), placeholder)
+
+        self.assertEqual(
+            str(cover_image_for_page(self._book_page)),
+            str(cover_image(db, self._book.id)),
+        )
+        self.assertEqual(
+            str(cover_image_for_page(self._book_page, size='thumb')),
+            str(cover_image(db, self._book.id, size='thumb')),
+        )
+
+    def test__cover_images(self):
+        self.assertEqual(cover_images(db, []), {})
+
+        book_id = db.book.insert(name='test__cover_images')
+        db.commit()
+        book = db(db.book.id == book_id).select().first()
+        self._objects.append(book)
+
+        images = cover_images(db, [self._book.id, book_id], size='thumb')
+        self.assertEqual(sorted(images.keys()), sorted([self._book.id, book_id]))
+        self.assertEqual(
+            str(images[self._book.id]),
+            str(cover_image(db, self._book.id, size='thumb')),
+        )
+        # Book has no pages
+        self.assertEqual(
+            str(images[book_id]),
+            str(cover_image(db, book_id, size='thumb')),
+        )
+
     def test__default_contribute_amount(self):
         book_id = db.book.insert(name='test__default_contribute_amount')
         book = db(db.book.id == book_id).select().first()
@@ -210,6 +329,50 @@ class TestFunctions(ImageTestCase):
                 page_count = db(db.book_page.book_id == book.id).count()
             self.assertEqual(default_contribute_amount(db, book), t[1])
 
+    def test__first_pages(self):
+        self.assertEqual(first_pages(db, []), {})
+
+        book_id = db.book.insert(name='test__first_pages')
+        db.commit()
+        book = db(db.book.id == book_id).select().first()
+        self._objects.append(book)
+
+        # Book has no pages
+        self.assertEqual(first_pages(db, [book_id]), {})
+
+        # Pages are inserted out of order.
+        for page_no in [3, 2, 4]:
+            page_id = db.book_page.insert(
+                book_id=book_id,
+                page_no=page_no,
+            )
+            db.commit()
+            page = db(db.book_page.id == page_id).select().first()
+            self._objects.append(page)
+
+        pages = first_pages(db, [self._book.id, book_id, -1])
+        self.assertEqual(sorted(pages.keys()), sorted([self._book.id, book_id]))
+        self.assertEqual(pages[self._book.id].id, self._book_page.id)
+        self.assertEqual(pages[book_id].book_id, book_id)
+        self.assertEqual(pages[book_id].page_no, 2)
+
+    def test__manifest_version(self):
+        version = manifest_version(db, self._book)
+        self.assertEqual(len(version), 16)
+        self.assertEqual(manifest_version(db, self._book), version)
+
+        # Adding a page changes the version.
+        page_id = db.book_page.insert(
+            book_id=self._book.id,
+            page_no=3,
+        )
+        db.commit()
+        version_2 = manifest_version(db, self._book)
+        self.assertNotEqual(version_2, version)
+        db(db.book_page.id == page_id).delete()
+        db.commit()
+        self.assertEqual(manifest_version(db, self._book), version)
+
     def test__read_link(self):
         empty = '<span></span>'
         book_id = db.book.insert(
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Test suite for zcomix/modules/caching.py
+
+"""
+import unittest
+from gluon import *
+from gluon.cache import CacheInRam, CacheOnDisk
+from gluon.storage import List, Storage
+from applications.zcomix.modules.caching import \
+    CACHE_PREFIX, \
+    cached_page, \
+    clear_tags, \
+    invalidate_book, \
+    invalidate_creator, \
+    invalidate_profile, \
+    page_cache, \
+    page_key
+from applications.zcomix.modules.test_runner import LocalTestCase
+
+# C0111: Missing docstring
+# R0904: Too many public methods
+# pylint: disable=C0111,R0904
+
+
+class CachingTestCase(LocalTestCase):
+    """ Base class for caching test cases. Sets up test data."""
+
+    _auth_user = None
+    _book = None
+    _creator = None
+
+    _objects = []
+
+    # C0103: *Invalid name "%s" (should match %s)*
+    # pylint: disable=C0103
+    @classmethod
+    def setUp(cls):
+        auth_user_id = db.auth_user.insert(
+            name='Caching Test',
+            email='caching_test@example.com',
+        )
+        db.commit()
+        cls._auth_user = db(db.auth_user.id == auth_user_id).select().first()
+        cls._objects.append(cls._auth_user)
+
+        creator_id = db.creator.insert(auth_user_id=auth_user_id)
+        db.commit()
+        cls._creator = db(db.creator.id == creator_id).select().first()
+        cls._objects.append(cls._creator)
+
+        book_id = db.book.insert(
+            name='Caching Test Book',
+            creator_id=creator_id,
+        )
+        db.commit()
+        cls._book = db(db.book.id == book_id).select().first()
+        cls._objects.append(cls._book)
+
+        cls._request_args = request.args
+        cls._request_vars = dict(request.vars)
+        request.args = List()
+        request.vars.clear()
+
+    @classmethod
+    def tearDown(cls):
+        request.args = cls._request_args
+        request.vars.clear()
+        request.vars.update(cls._request_vars)
+        page_cache().clear(regex='^{p}:'.format(p=CACHE_PREFIX))
+
+    def _cached_keys(self):
+        return [x for x in page_cache().storage.keys()
+                if x.startswith(CACHE_PREFIX + ':')]
+
+    def _cache_page(self, tag, args):
+        request.args = List(args)
+        key = page_key(tag)
+        page_cache()(key, lambda: 'html', time_expire=60)
+        return key
+
+
+class TestFunctions(CachingTestCase):
+
+    def test__cached_page(self):
+        calls = []
+
+        @cached_page('book', var_names=['o'])
+        def controller():
+            """Test controller."""
+            calls.append(1)
+            return 'html {c}'.format(c=len(calls))
+
+        self.assertEqual(controller.__name__, 'controller')
+        self.assertEqual(controller.__doc__, 'Test controller.')
+
+        request.args = List([str(self._book.id)])
+        self.assertEqual(controller(), 'html 1')
+        self.assertEqual(controller(), 'html 1')
+        self.assertEqual(len(calls), 1)
+
+        # Different vars, different page
+        request.vars.o = 'newest'
+        self.assertEqual(controller(), 'html 2')
+        self.assertEqual(controller(), 'html 2')
+
+        # Vars not listed, not cached
+        request.vars.xyz = '1'
+        self.assertEqual(controller(), 'html 3')
+        self.assertEqual(controller(), 'html 4')
+        del request.vars['xyz']
+
+        invalidate_book(self._book.id)
+        self.assertEqual(controller(), 'html 5')
+
+    def test__clear_tags(self):
+        key_1 = self._cache_page('book', ['1'])
+        key_11 = self._cache_page('book', ['11'])
+        key_search = self._cache_page('search', [])
+
+        clear_tags([])
+        self.assertEqual(
+            sorted(self._cached_keys()),
+            sorted([key_1, key_11, key_search])
+        )
+        clear_tags(['book.1'])
+        self.assertEqual(
+            sorted(self._cached_keys()),
+            sorted([key_11, key_search])
+        )
+        clear_tags(['book.11', 'search'])
+        self.assertEqual(self._cached_keys(), [])
+
+    def test__invalidate_book(self):
+        self._cache_page('book', [str(self._book.id)])
+        key_other = self._cache_page('book', [str(self._book.id + 1)])
+        key_creator = self._cache_page('creator', [str(self._creator.id)])
+        self._cache_page('search', [])
+
+        invalidate_book(self._book.id)
+        self.assertEqual(
+            sorted(self._cached_keys()),
+            sorted([key_other, key_creator])
+        )
+
+    def test__invalidate_creator(self):
+        self._cache_page('book', [str(self._book.id)])
+        key_other = self._cache_page('book', [str(self._book.id + 1)])
+        self._cache_page('creator', [str(self._creator.id)])
+        self._cache_page('search', [])
+
+        invalidate_creator(self._creator.id)
+        self.assertEqual(self._cached_keys(), [key_other])
+
+    def test__invalidate_profile(self):
+        key_creator = self._cache_page('creator', [str(self._creator.id)])
+        invalidate_profile(Storage(vars=Storage(id=None)))
+        self.assertEqual(self._cached_keys(), [key_creator])
+        invalidate_profile(Storage(vars=Storage(id=self._auth_user.id)))
+        self.assertEqual(self._cached_keys(), [])
+
+    def test__page_cache(self):
+        self.assertTrue(isinstance(page_cache(), CacheInRam))
+        local_settings = current.app.local_settings
+        current.app.local_settings = Storage(page_cache='disk')
+        self.assertTrue(isinstance(page_cache(), CacheOnDisk))
+        current.app.local_settings = local_settings
+
+    def test__page_key(self):
+        self.assertEqual(
+            page_key('search'),
+            'page:search:{c}/{f}.{e}/?#'.format(
+                c=request.controller,
+                f=request.function,
+                e=request.extension,
+            )
+        )
+
+        request.args = List(['12', 'abc'])
+        request.vars.o = 'newest'
+        request.vars.kw = 'Abc'
+        self.assertEqual(
+            page_key('book', var_names=['kw', 'o']),
+            'page:book.12:{c}/{f}.{e}/12/abc?kw=Abc&o=newest#'.format(
+                c=request.controller,
+                f=request.function,
+                e=request.extension,
+            )
+        )
+        # Vars not listed
+        self.assertEqual(page_key('book', var_names=['o']), None)
+
+        # Logged in users are not cached
+        current.app.auth.user = Storage(id=self._auth_user.id)
+        self.assertEqual(page_key('book', var_names=['kw', 'o']), None)
+        current.app.auth.user = None
+
+        # Posts are not cached
+        request.env.request_method = 'POST'
+        self.assertEqual(page_key('book', var_names=['kw', 'o']), None)
+        request.env.request_method = None
+
+
+def setUpModule():
+    """Set up web2py environment."""
+    # C0103: *Invalid name "%%s" (should match %%s)*
+    # pylint: disable=C0103
+    LocalTestCase.set_env(globals())
+
+
+if __name__ == '__main__':
+    unittest.main()
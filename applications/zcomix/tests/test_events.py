@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Test suite for zcomix/modules/events.py
+
+"""
+import datetime
+import os
+import shutil
+import subprocess
+import time
+import unittest
+from gluon import *
+from gluon.contrib.simplejson import loads
+from applications.zcomix.modules.events import \
+    claim_log, \
+    flush_events, \
+    log_event, \
+    process_exists, \
+    rotate_event_log, \
+    rotated_log_name
+from applications.zcomix.modules.test_runner import LocalTestCase
+
+# C0111: Missing docstring
+# R0904: Too many public methods
+# pylint: disable=C0111,R0904
+
+
+class EventsTestCase(LocalTestCase):
+    """ Base class for event test cases. Sets up test data."""
+
+    _book = None
+    _event_log_max_id = 0
+    _log_dir = '/tmp/test_events'
+    _now = datetime.datetime(2014, 7, 15, 12, 0, 0)
+
+    _objects = []
+
+    # C0103: *Invalid name "%s" (should match %s)*
+    # pylint: disable=C0103
+    @classmethod
+    def setUp(cls):
+        if os.path.exists(cls._log_dir):
+            shutil.rmtree(cls._log_dir)
+        book_id = db.book.insert(name='EventsTestCase', downloads=0)
+        db.commit()
+        cls._book = db(db.book.id == book_id).select().first()
+        cls._objects.append(cls._book)
+        cls._event_log_max_id = db.event_log.id.max()
+        cls._event_log_max_id = db().select(
+            cls._event_log_max_id).first()[cls._event_log_max_id] or 0
+
+    @classmethod
+    def tearDown(cls):
+        db(db.book_view.book_id == cls._book.id).delete()
+        db(db.contribution.book_id == cls._book.id).delete()
+        db(db.event_log.id > cls._event_log_max_id).delete()
+        db.commit()
+        if os.path.exists(cls._log_dir):
+            shutil.rmtree(cls._log_dir)
+
+    def _log(self):
+        with open(os.path.join(self._log_dir, 'events.log')) as f:
+            return [loads(x) for x in f]
+
+
+class TestFunctions(EventsTestCase):
+
+    def _rotated(self, event_type='view'):
+        log_event(event_type, self._book.id, time_stamp=self._now,
+                  log_dir=self._log_dir)
+        rotated = rotate_event_log(self._log_dir)
+        past = time.time() - 120
+        os.utime(rotated, (past, past))
+        return rotated
+
+    def test__claim_log(self):
+        rotated = self._rotated()
+        claimed = claim_log(rotated)
+        self.assertEqual(
+            claimed,
+            '{r}.{p}.flushing'.format(r=rotated, p=os.getpid())
+        )
+        self.assertTrue(os.path.exists(claimed))
+        self.assertFalse(os.path.exists(rotated))
+
+        # Claimed by another process
+        self.assertEqual(claim_log(rotated), None)
+
+        # Reclaimed
+        self.assertEqual(claim_log(claimed), claimed)
+        self.assertTrue(os.path.exists(claimed))
+
+    def test__flush_events(self):
+        for event_type in ['view', 'view', 'download', 'download']:
+            log_event(event_type, self._book.id, time_stamp=self._now,
+                      log_dir=self._log_dir)
+        log_event('contribution', self._book.id, amount='5.00',
+                  time_stamp=self._now, log_dir=self._log_dir)
+
+        # Rotated logs within the grace period are not flushed.
+        counts = flush_events(log_dir=self._log_dir, grace=60)
+        self.assertEqual(counts, {'contribution': 0, 'download': 0, 'view': 0})
+        self.assertEqual(len(os.listdir(self._log_dir)), 1)
+
+        log_event('view', self._book.id, time_stamp=self._now,
+                  log_dir=self._log_dir)
+        for name in os.listdir(self._log_dir):
+            past = time.time() - 120
+            os.utime(os.path.join(self._log_dir, name), (past, past))
+
+        counts = flush_events(log_dir=self._log_dir, grace=60)
+        self.assertEqual(counts, {'contribution': 1, 'download': 2, 'view': 3})
+        self.assertEqual(os.listdir(self._log_dir), [])
+
+        book = db(db.book.id == self._book.id).select().first()
+        self.assertEqual(book.downloads, 2)
+        views = db(db.book_view.book_id == self._book.id).select()
+        self.assertEqual(len(views), 3)
+        self.assertEqual(views[0].time_stamp, self._now)
+        contributions = db(db.contribution.book_id == self._book.id).select()
+        self.assertEqual(len(contributions), 1)
+        self.assertEqual(contributions[0].amount, 5.00)
+
+        # Nothing to flush
+        counts = flush_events(log_dir=self._log_dir, grace=0)
+        self.assertEqual(counts, {'contribution': 0, 'download': 0, 'view': 0})
+
+    def test__flush_events_idempotent(self):
+        zero = {'contribution': 0, 'download': 0, 'view': 0}
+
+        # Loaded, the flusher stopped before removing the log.
+        rotated = self._rotated()
+        db.event_log.insert(
+            name=os.path.basename(rotated),
+            flushed_on=datetime.datetime.now()
+        )
+        db.commit()
+        self.assertEqual(flush_events(log_dir=self._log_dir, grace=60), zero)
+        self.assertEqual(os.listdir(self._log_dir), [])
+        self.assertEqual(
+            db(db.book_view.book_id == self._book.id).count(), 0)
+
+        # Claimed by a running process, init.
+        rotated = self._rotated()
+        claimed = '{r}.1.flushing'.format(r=rotated)
+        os.rename(rotated, claimed)
+        self.assertEqual(flush_events(log_dir=self._log_dir, grace=60), zero)
+        self.assertEqual(os.listdir(self._log_dir), [os.path.basename(claimed)])
+        os.unlink(claimed)
+
+        # Claimed by a process no longer running.
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        rotated = self._rotated()
+        claimed = '{r}.{p}.flushing'.format(r=rotated, p=proc.pid)
+        os.rename(rotated, claimed)
+        counts = flush_events(log_dir=self._log_dir, grace=60)
+        self.assertEqual(counts, {'contribution': 0, 'download': 0, 'view': 1})
+        self.assertEqual(os.listdir(self._log_dir), [])
+        self.assertEqual(
+            db(db.event_log.name == os.path.basename(rotated)).count(), 1)
+
+        # Flushed once
+        self.assertEqual(flush_events(log_dir=self._log_dir, grace=60), zero)
+        self.assertEqual(
+            db(db.book_view.book_id == self._book.id).count(), 1)
+
+    def test__log_event(self):
+        log_event('view', self._book.id, auth_user_id=2, time_stamp=self._now,
+                  log_dir=self._log_dir)
+        log_event('contribution', str(self._book.id), amount='1.50',
+                  time_stamp=self._now, log_dir=self._log_dir)
+        self.assertEqual(self._log(), [
+            {
+                'type': 'view',
+                'book_id': self._book.id,
+                'auth_user_id': 2,
+                'time_stamp': '2014-07-15 12:00:00',
+            },
+            {
+                'type': 'contribution',
+                'book_id': self._book.id,
+                'auth_user_id': 0,
+                'time_stamp': '2014-07-15 12:00:00',
+                'amount': 1.50,
+            },
+        ])
+
+        self.assertRaises(SyntaxError, log_event, '_fake_', self._book.id,
+                          log_dir=self._log_dir)
+        self.assertRaises(ValueError, log_event, 'contribution',
+                          self._book.id, amount='abc', log_dir=self._log_dir)
+        self.assertEqual(len(self._log()), 2)
+
+    def test__process_exists(self):
+        self.assertTrue(process_exists(os.getpid()))
+        self.assertTrue(process_exists(1))
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        self.assertFalse(process_exists(proc.pid))
+
+    def test__rotate_event_log(self):
+        self.assertEqual(rotate_event_log(self._log_dir), None)
+        log_event('view', self._book.id, log_dir=self._log_dir)
+        rotated = rotate_event_log(self._log_dir)
+        self.assertTrue(os.path.exists(rotated))
+        self.assertTrue(os.path.basename(rotated).startswith('events.'))
+        self.assertFalse(
+            os.path.exists(os.path.join(self._log_dir, 'events.log')))
+
+    def test__rotated_log_name(self):
+        tests = [
+            # (filename, expect)
+            ('events.1405425600.000000.123.log',
+             'events.1405425600.000000.123.log'),
+            ('/tmp/events.1405425600.000000.123.log',
+             'events.1405425600.000000.123.log'),
+            ('/tmp/events.1405425600.000000.123.log.456.flushing',
+             'events.1405425600.000000.123.log'),
+        ]
+        for t in tests:
+            self.assertEqual(rotated_log_name(t[0]), t[1])
+
+
+def setUpModule():
+    """Set up web2py environment."""
+    # C0103: *Invalid name "%%s" (should match %%s)*
+    # pylint: disable=C0103
+    LocalTestCase.set_env(globals())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Test suite for zcomix/modules/fulltext.py
+
+"""
+import struct
+import unittest
+from gluon import *
+from gluon.storage import Storage
+from applications.zcomix.modules.fulltext import \
+    FULLTEXT_TABLE, \
+    FullTextIndex, \
+    LikeIndex, \
+    SQLiteFTSIndex, \
+    fulltext_index, \
+    index_profile, \
+    matchinfo_score, \
+    search_terms
+from applications.zcomix.modules.test_runner import LocalTestCase
+
+# C0111: Missing docstring
+# R0904: Too many public methods
+# pylint: disable=C0111,R0904
+
+
+class FullTextTestCase(LocalTestCase):
+    """ Base class for full text test cases. Sets up test data."""
+
+    _auth_user = None
+    _book = None
+    _book_2 = None
+    _creator = None
+
+    _objects = []
+
+    # C0103: *Invalid name "%s" (should match %s)*
+    # pylint: disable=C0103
+    @classmethod
+    def setUp(cls):
+        auth_user_id = db.auth_user.insert(
+            name='Zyxwvu Fulltext',
+            email='fulltext_test@example.com',
+        )
+        db.commit()
+        cls._auth_user = db(db.auth_user.id == auth_user_id).select().first()
+        cls._objects.append(cls._auth_user)
+
+        creator_id = db.creator.insert(
+            auth_user_id=auth_user_id,
+            bio='Draws qwertyuiop comics.',
+        )
+        db.commit()
+        cls._creator = db(db.creator.id == creator_id).select().first()
+        cls._objects.append(cls._creator)
+
+        book_id = db.book.insert(
+            name='Zzqqjj Adventures',
+            creator_id=creator_id,
+            description='The first book',
+        )
+        db.commit()
+        cls._book = db(db.book.id == book_id).select().first()
+        cls._objects.append(cls._book)
+
+        book_id = db.book.insert(
+            name='Second Book',
+            creator_id=creator_id,
+            description='More zzqqjj stories',
+        )
+        db.commit()
+        cls._book_2 = db(db.book.id == book_id).select().first()
+        cls._objects.append(cls._book_2)
+
+        index = fulltext_index(db)
+        index.index_creator(creator_id)
+        db.commit()
+
+    @classmethod
+    def tearDown(cls):
+        index = fulltext_index(db)
+        for book in [cls._book, cls._book_2]:
+            index.delete_book(book.id)
+        db.commit()
+
+
+class TestFullTextIndex(FullTextTestCase):
+
+    def test____init__(self):
+        # The backends implement the index.
+        self.assertRaises(TypeError, FullTextIndex, db)
+
+
+class TestLikeIndex(FullTextTestCase):
+
+    def test__search(self):
+        index = LikeIndex(db)
+        self.assertEqual(
+            [x[0] for x in index.search('zzqqjj')],
+            [self._book.id, self._book_2.id]
+        )
+        self.assertEqual(
+            [x[0] for x in index.search('zyxwvu second')],
+            [self._book_2.id]
+        )
+        self.assertEqual(index.search(''), [])
+        self.assertEqual(index.search('zzqqjj', limit=1)[0][0], self._book.id)
+
+
+class TestSQLiteFTSIndex(FullTextTestCase):
+
+    def test__book_documents(self):
+        index = SQLiteFTSIndex(db)
+        documents = index.book_documents(db.book.id == self._book.id)
+        self.assertEqual(documents, [{
+            'book_id': self._book.id,
+            'name': 'Zzqqjj Adventures',
+            'creator_name': 'Zyxwvu Fulltext',
+            'description': 'The first book',
+            'bio': 'Draws qwertyuiop comics.',
+        }])
+
+    def test__create(self):
+        index = SQLiteFTSIndex(db)
+        index.create()
+        rows = db.executesql(
+            "SELECT name FROM sqlite_master WHERE name = '{t}';".format(
+                t=FULLTEXT_TABLE))
+        self.assertEqual(len(rows), 1)
+
+        # The table exists, eg created by another process.
+        # W0212: *Access to a protected member %%s of a client class*
+        # pylint: disable=W0212
+        SQLiteFTSIndex._ready.discard(db._uri)
+        index.create()
+        self.assertTrue(db._uri in SQLiteFTSIndex._ready)
+
+    def test__delete_book(self):
+        index = SQLiteFTSIndex(db)
+        index.delete_book(self._book_2.id)
+        self.assertEqual(
+            [x[0] for x in index.search('zzqqjj')], [self._book.id])
+
+    def test__index_book(self):
+        index = SQLiteFTSIndex(db)
+        self._book.update_record(name='Xxkkvv Adventures')
+        db.commit()
+        index.index_book(self._book.id)
+        self.assertEqual(
+            [x[0] for x in index.search('xxkkvv')], [self._book.id])
+        self.assertEqual(
+            [x[0] for x in index.search('zzqqjj')], [self._book_2.id])
+        self._book.update_record(name='Zzqqjj Adventures')
+        db.commit()
+        index.index_book(self._book.id)
+
+    def test__index_creator(self):
+        index = SQLiteFTSIndex(db)
+        self._creator.update_record(bio='Draws asdfghjkl comics.')
+        db.commit()
+        index.index_creator(self._creator.id)
+        self.assertEqual(len(index.search('asdfghjkl')), 2)
+        self.assertEqual(index.search('qwertyuiop'), [])
+
+    def test__rebuild(self):
+        index = SQLiteFTSIndex(db)
+        index.clear()
+        self.assertEqual(index.search('zzqqjj'), [])
+        index.rebuild()
+        self.assertEqual(
+            [x[0] for x in index.search('zzqqjj')],
+            [self._book.id, self._book_2.id]
+        )
+
+    def test__search(self):
+        index = SQLiteFTSIndex(db)
+        # Matches in the name rank higher than in the description.
+        self.assertEqual(
+            [x[0] for x in index.search('zzqqjj')],
+            [self._book.id, self._book_2.id]
+        )
+        # Prefixes of words match, all terms must match.
+        self.assertEqual(
+            [x[0] for x in index.search('zzq fulltext adv')],
+            [self._book.id]
+        )
+        self.assertEqual(len(index.search('qwertyuiop')), 2)
+        self.assertEqual(index.search('zzqqjj nomatchxx'), [])
+        self.assertEqual(index.search(''), [])
+        self.assertEqual(index.search('" OR zzyyxxqq*'), [])
+
+
+class TestFunctions(FullTextTestCase):
+
+    def test__fulltext_index(self):
+        self.assertTrue(isinstance(fulltext_index(db), SQLiteFTSIndex))
+        self.assertTrue(isinstance(fulltext_index(db, 'like'), LikeIndex))
+        self.assertRaises(SyntaxError, fulltext_index, db, '_fake_')
+
+    def test__index_profile(self):
+        self._auth_user.update_record(name='Mnbvcx Fulltext')
+        db.commit()
+        index_profile(Storage(vars=Storage(id=self._auth_user.id)))
+        self.assertEqual(len(fulltext_index(db).search('mnbvcx')), 2)
+        self._auth_user.update_record(name='Zyxwvu Fulltext')
+        db.commit()
+        index_profile(Storage(vars=Storage(id=self._auth_user.id)))
+
+    def test__matchinfo_score(self):
+        # 1 phrase, 2 columns, (row hits, all hits, docs) per column
+        matchinfo = buffer(struct.pack('=8I', 1, 2, 1, 2, 2, 3, 6, 1))
+        self.assertEqual(matchinfo_score(matchinfo, [10.0, 1.0]), 5.5)
+
+    def test__search_terms(self):
+        tests = [
+            # (keywords, expect)
+            (None, []),
+            ('', []),
+            ('Abc', [u'abc']),
+            ('  abc, DEF-ghi ', [u'abc', u'def', u'ghi']),
+            ('"; DROP TABLE book; --', [u'drop', u'table', u'book']),
+            ('Ésprit', [u'ésprit']),
+        ]
+        for t in tests:
+            self.assertEqual(search_terms(t[0]), t[1])
+
+
+def setUpModule():
+    """Set up web2py environment."""
+    # C0103: *Invalid name "%%s" (should match %%s)*
+    # pylint: disable=C0103
+    LocalTestCase.set_env(globals())
+
+
+if __name__ == '__main__':
+    unittest.main()
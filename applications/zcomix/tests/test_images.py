@@ -6,6 +6,7 @@
 Test suite for zcomix/modules/utils.py
 
 """
+import hashlib
 import os
 import shutil
 import sys
@@ -14,12 +15,29 @@ from BeautifulSoup import BeautifulSoup
 from PIL import Image
 from cStringIO import StringIO
 from gluon import *
+from gluon.contrib.simplejson import loads
 from gluon.http import HTTP
+from gluon.storage import Storage
 from applications.zcomix.modules.images import \
+    CACHE_CONTROL, \
+    FALLBACK_CACHE_CONTROL, \
     Downloader, \
+    IMAGE_WIDTHS, \
+    SRCSET_SIZES, \
     UploadImage, \
+    etag, \
+    image_metadata, \
+    image_srcset, \
     img_tag, \
-    set_thumb_dimensions
+    not_modified, \
+    queue_resize, \
+    resize_image, \
+    save_image, \
+    set_image_ladder, \
+    set_image_metadata, \
+    set_thumb_dimensions, \
+    size_names, \
+    store_image
 from applications.zcomix.modules.test_runner import LocalTestCase
 
 # C0111: Missing docstring
@@ -73,6 +91,7 @@ class ImageTestCase(LocalTestCase):
             auth_user_id=auth_user_id,
             email=email,
             image=stored_filename,
+            image_filename=cls._image_name,
         )
         db.commit()
 
@@ -85,6 +104,18 @@ class ImageTestCase(LocalTestCase):
     def tearDown(cls):
         if os.path.exists(cls._image_dir):
             shutil.rmtree(cls._image_dir)
+        # The metadata of images is removed when they are purged.
+        db(db.image_size.image == cls._creator.image).delete()
+        db.commit()
+        # Restore the ladder of the settings, tests may change it.
+        set_image_ladder(
+            widths=current.app.local_settings.image_widths,
+            encodings=current.app.local_settings.image_encodings,
+        )
+
+    def _webp_supported(self):
+        Image.init()
+        return 'WEBP' in Image.SAVE
 
 
 class TestDownloader(ImageTestCase):
@@ -111,6 +142,8 @@ class TestDownloader(ImageTestCase):
                 self.assertEqual(http.headers['Content-Type'], 'image/jpeg')
                 self.assertEqual(http.headers['Content-Disposition'], 'attachment; filename="file.jpg"')
                 self.assertEqual(http.headers['Content-Length'], lengths[expect_size])
+            else:
+                self.fail('HTTP not raised')
 
         test_http('original')
 
@@ -120,6 +153,20 @@ class TestDownloader(ImageTestCase):
         request.vars.size = 'thumb'
         test_http('original')
 
+        # The original in place of a size is not cached for long.
+        downloader = Downloader()
+        try:
+            downloader.download(request, db)
+        except HTTP as http:
+            self.assertEqual(
+                http.headers['Cache-Control'], FALLBACK_CACHE_CONTROL)
+            self.assertEqual(
+                http.headers['ETag'],
+                etag(self._creator.image, size='original')
+            )
+        else:
+            self.fail('HTTP not raised')
+
         resizer = UploadImage(db.creator.image, self._creator.image)
         resizer.resize_all()
 
@@ -130,6 +177,137 @@ class TestDownloader(ImageTestCase):
         request.vars.size = 'thumb'
         test_http('thumb')
 
+        # Caching headers
+        request.vars.size = 'medium'
+        downloader = Downloader()
+        try:
+            downloader.download(request, db)
+        except HTTP as http:
+            self.assertEqual(http.status, 200)
+            self.assertEqual(http.headers['Cache-Control'], CACHE_CONTROL)
+            self.assertEqual(
+                http.headers['ETag'],
+                etag(self._creator.image, size='medium')
+            )
+
+        def test_304(if_none_match=None, if_modified_since=None):
+            request.env.http_if_none_match = if_none_match
+            request.env.http_if_modified_since = if_modified_since
+            downloader = Downloader()
+            try:
+                downloader.download(request, db)
+            except HTTP as http:
+                request.env.http_if_none_match = None
+                request.env.http_if_modified_since = None
+                return http
+            self.fail('HTTP not raised')
+
+        medium_etag = etag(self._creator.image, size='medium')
+        http = test_304(if_none_match=medium_etag)
+        self.assertEqual(http.status, 304)
+        self.assertEqual(http.headers['ETag'], medium_etag)
+        self.assertEqual(http.headers['Cache-Control'], CACHE_CONTROL)
+        self.assertTrue('Content-Length' not in http.headers)
+
+        http = test_304(if_modified_since='Tue, 01 Jul 2014 12:00:00 GMT')
+        self.assertEqual(http.status, 304)
+
+        # The original has a different etag.
+        http = test_304(
+            if_none_match=etag(self._creator.image, size='original'),
+            if_modified_since='Tue, 01 Jul 2014 12:00:00 GMT',
+        )
+        self.assertEqual(http.status, 200)
+        self.assertEqual(http.headers['Content-Length'], lengths['medium'])
+
+        # Delivery by the front-end server.
+        local_settings = current.app.local_settings
+        save_delivery = local_settings.image_delivery
+        request.vars.size = None
+        local_settings.image_delivery = 'x-sendfile'
+        try:
+            downloader = Downloader()
+            try:
+                downloader.download(request, db)
+            except HTTP as http:
+                self.assertEqual(http.status, 200)
+                self.assertEqual(http.body, '')
+                self.assertEqual(
+                    http.headers['X-Sendfile'], resizer.fullname())
+                self.assertTrue('Content-Length' not in http.headers)
+            else:
+                self.fail('HTTP not raised')
+        finally:
+            local_settings.image_delivery = save_delivery
+
+        # WebP alternates are negotiated.
+        set_image_ladder(widths=[640], encodings=['jpeg', 'webp'])
+        resizer.resize_all()
+
+        def ladder_http(accept):
+            request.env.http_accept = accept
+            downloader = Downloader()
+            try:
+                downloader.download(request, db)
+            except HTTP as http:
+                request.env.http_accept = None
+                return http
+            self.fail('HTTP not raised')
+
+        request.vars.size = 'w640'
+        http = ladder_http('image/png,image/*;q=0.8')
+        self.assertEqual(http.headers['Content-Type'], 'image/jpeg')
+        self.assertEqual(
+            http.headers['ETag'], etag(self._creator.image, size='w640'))
+        if self._webp_supported():
+            self.assertEqual(http.headers['Vary'], 'Accept')
+            http = ladder_http('image/webp,image/*;q=0.8')
+            self.assertEqual(http.headers['Content-Type'], 'image/webp')
+            self.assertEqual(http.headers['Vary'], 'Accept')
+            self.assertEqual(
+                http.headers['ETag'],
+                etag(self._creator.image, size='w640_webp')
+            )
+            self.assertEqual(
+                http.headers['Content-Length'],
+                os.stat(resizer.fullname(size='w640_webp')).st_size
+            )
+        request.vars.size = None
+
+    def test__delegate(self):
+        resizer = UploadImage(db.creator.image, self._creator.image)
+        fullname = resizer.fullname()
+
+        def delegated(delivery, prefix=None):
+            downloader = Downloader()
+            try:
+                downloader.delegate(
+                    fullname, db.creator.image, delivery, prefix=prefix)
+            except HTTP as http:
+                self.assertEqual(http.status, 200)
+                self.assertEqual(http.body, '')
+                return http.headers
+            self.fail('HTTP not raised')
+
+        headers = delegated('x-sendfile')
+        self.assertEqual(headers['X-Sendfile'], os.path.abspath(fullname))
+
+        relative = fullname[fullname.index('/original/'):]
+        headers = delegated('x-accel-redirect')
+        self.assertEqual(
+            headers['X-Accel-Redirect'], '/protected' + relative)
+        headers = delegated('x-accel-redirect', prefix='/_images/')
+        self.assertEqual(headers['X-Accel-Redirect'], '/_images' + relative)
+
+        self.assertRaises(SyntaxError, delegated, '_fake_')
+
+        downloader = Downloader()
+        try:
+            downloader.delegate(
+                '/tmp/_fake_.jpg', db.creator.image, 'x-sendfile')
+        except HTTP as http:
+            self.assertEqual(http.status, 404)
+
 
 class TestUploadImage(ImageTestCase):
 
@@ -153,11 +331,14 @@ class TestUploadImage(ImageTestCase):
     def test____init__(self):
         resizer = UploadImage(db.creator.image, self._image_name)
         self.assertTrue(resizer)
+        # The stored name is content addressed, the uploaded filename is
+        # kept by the record.
         file_name, fullname = db.creator.image.retrieve(
             self._creator.image,
             nameonly=True,
         )
-        self.assertEqual(self._image_name, file_name)
+        self.assertEqual(file_name, self._creator.image)
+        self.assertEqual(self._creator.image_filename, self._image_name)
         self.assertEqual(resizer._images, {})
         self.assertEqual(resizer._dimensions, {})
 
@@ -206,6 +387,15 @@ class TestUploadImage(ImageTestCase):
         dims_4 = resizer.dimensions(size='medium')
         self.assertEqual(dims_4, (500, 500))
 
+    def test__dimensions_stored(self):
+        set_image_metadata(db, self._creator.image, {
+            'medium': dict(
+                width=11, height=22, bytes=33, format='JPEG', checksum='x'),
+        })
+        resizer = UploadImage(db.creator.image, self._creator.image)
+        self.assertEqual(resizer.dimensions(size='medium'), (11, 22))
+        set_image_metadata(db, self._creator.image, {'medium': None})
+
     def test__fullname(self):
         resizer = UploadImage(db.creator.image, self._creator.image)
         self.assertEqual(
@@ -230,6 +420,61 @@ class TestUploadImage(ImageTestCase):
             ),
         )
 
+        # Sizes saved in another format have its extension appended.
+        formats = dict(UploadImage.formats)
+        UploadImage.formats.clear()
+        UploadImage.formats.update({'w640': 'JPEG', 'w640_webp': 'WEBP'})
+        try:
+            self.assertEqual(
+                resizer.fullname(size='w640'),
+                '/tmp/image_resizer/w640/creator.image/{u}/{i}'.format(
+                    u=self._uuid_key,
+                    i=self._creator.image,
+                ),
+            )
+            self.assertEqual(
+                resizer.fullname(size='w640_webp'),
+                '/tmp/image_resizer/w640_webp/creator.image/{u}/{i}.webp'
+                .format(u=self._uuid_key, i=self._creator.image),
+            )
+        finally:
+            UploadImage.formats.clear()
+            UploadImage.formats.update(formats)
+
+    def test__metadata(self):
+        resizer = UploadImage(db.creator.image, self._creator.image)
+        self.assertEqual(resizer.metadata(size='medium'), None)
+
+        data = resizer.metadata()
+        self.assertEqual(data['width'], 1200)
+        self.assertEqual(data['height'], 1200)
+        self.assertEqual(data['bytes'], 23127)
+        self.assertEqual(data['format'], 'JPEG')
+        with open(resizer.fullname(), 'rb') as f:
+            self.assertEqual(data['checksum'], hashlib.md5(f.read()).hexdigest())
+
+        resizer.resize('medium')
+        data = resizer.metadata(size='medium')
+        self.assertEqual(data['width'], 500)
+        self.assertEqual(data['height'], 500)
+        self.assertEqual(data['format'], 'JPEG')
+        self.assertEqual(
+            data['bytes'],
+            os.stat(resizer.fullname(size='medium')).st_size
+        )
+
+    def test__metadata_all(self):
+        resizer = UploadImage(db.creator.image, self._creator.image)
+        resizer.resize('thumb')
+        data = resizer.metadata_all()
+        self.assertEqual(
+            sorted(data.keys()),
+            sorted(['original'] + UploadImage.sizes.keys())
+        )
+        self.assertEqual(data['medium'], None)
+        self.assertEqual(data['original']['width'], 1200)
+        self.assertEqual(data['thumb']['width'], 170)
+
     def test__pil_image(self):
         resizer = UploadImage(db.creator.image, self._creator.image)
         self.assertEqual(resizer._images, {})
@@ -260,6 +505,54 @@ class TestUploadImage(ImageTestCase):
         im = Image.open(thumb)
         self.assertEqual(im.size, UploadImage.sizes['thumb'])
 
+    def test__resize_sizes(self):
+        resizer = UploadImage(db.creator.image, self._creator.image)
+        filenames = resizer.resize_sizes(['thumb', 'medium'])
+        self.assertEqual(sorted(filenames.keys()), ['medium', 'thumb'])
+        for size in ['medium', 'thumb']:
+            self.assertEqual(filenames[size], resizer.fullname(size=size))
+            im = Image.open(filenames[size])
+            self.assertEqual(im.size, UploadImage.sizes[size])
+
+        # Dimensions are recorded, files are not reopened.
+        self.assertEqual(resizer._images, {})
+        self.assertEqual(resizer._dimensions, {
+            'original': (1200, 1200),
+            'medium': UploadImage.sizes['medium'],
+            'thumb': UploadImage.sizes['thumb'],
+        })
+        self.assertEqual(resizer.dimensions(size='thumb'), (170, 170))
+        self.assertEqual(resizer._images, {})
+
+        # Non-square original
+        image_filename = os.path.join(self._image_dir, 'wide.jpg')
+        im = Image.new('RGB', (2400, 1200))
+        with open(image_filename, 'wb') as f:
+            im.save(f)
+        with open(image_filename, 'rb') as f:
+            stored_filename = db.creator.image.store(f)
+        resizer = UploadImage(db.creator.image, stored_filename)
+        resizer.resize_sizes(['medium', 'thumb'])
+        self.assertEqual(resizer.dimensions(size='original'), (2400, 1200))
+        self.assertEqual(resizer.dimensions(size='medium'), (500, 250))
+        self.assertEqual(resizer.dimensions(size='thumb'), (170, 85))
+
+        # Ladder sizes are saved in their format.
+        set_image_ladder(widths=[640, 3000], encodings=['jpeg', 'webp'])
+        sizes = ['w640', 'w3000']
+        if self._webp_supported():
+            sizes.append('w640_webp')
+        filenames = resizer.resize_sizes(sizes)
+        self.assertEqual(resizer.dimensions(size='w640'), (640, 320))
+        # Sizes are not enlarged.
+        self.assertEqual(resizer.dimensions(size='w3000'), (2400, 1200))
+        self.assertEqual(Image.open(filenames['w640']).format, 'JPEG')
+        self.assertEqual(resizer.metadata(size='w640')['format'], 'JPEG')
+        if self._webp_supported():
+            im = Image.open(filenames['w640_webp'])
+            self.assertEqual(im.format, 'WEBP')
+            self.assertEqual(im.size, (640, 320))
+
     def test__resize_all(self):
         resizer = UploadImage(db.creator.image, self._creator.image)
         resizer.resize_all()
@@ -272,7 +565,20 @@ class TestUploadImage(ImageTestCase):
             self.assertTrue(os.path.exists(file_name))
 
 
-class TestFunctions(LocalTestCase):
+class TestFunctions(ImageTestCase):
+
+    def test__etag(self):
+        name = 'book_page.image.801685b627e099e.300332e6a7067.jpg'
+        tag = etag(name)
+        self.assertEqual(tag, etag(name, size='original'))
+        self.assertTrue(tag.startswith('"'))
+        self.assertTrue(tag.endswith('"'))
+        self.assertEqual(len(tag), 34)
+        self.assertNotEqual(tag, etag(name, size='thumb'))
+        self.assertNotEqual(
+            tag,
+            etag('book_page.image.801685b627e099e.300332e6a7068.jpg')
+        )
 
     def test__img_tag(self):
         def has_attr(tag, attr, value):
@@ -306,6 +612,266 @@ class TestFunctions(LocalTestCase):
         has_attr(tag, 'src', 'http://www.src.com')
         has_attr(tag, 'id', 'img_id')
 
+        # Images with ladder sizes have a srcset.
+        image_name = self._creator.image
+        tag = img_tag(image_name)
+        self.assertFalse(BeautifulSoup(str(tag)).find('img').get('srcset'))
+
+        set_image_ladder(widths=[640], encodings=['jpeg'])
+        metadata = {image_name: {
+            'original': Storage(width=1200, height=1200),
+            'w640': Storage(width=640, height=640),
+        }}
+        srcset, unused_width = image_srcset(image_name, metadata[image_name])
+        tag = img_tag(image_name, metadata=metadata)
+        has_attr(tag, 'srcset', srcset)
+        has_attr(tag, 'sizes', SRCSET_SIZES.format(w=1200))
+
+        # Queried if not provided.
+        resizer = UploadImage(db.creator.image, image_name)
+        resizer.resize_all()
+        set_image_metadata(db, image_name, resizer.metadata_all())
+        tag = img_tag(image_name)
+        has_attr(tag, 'srcset', srcset)
+
+        # Only the original has a srcset.
+        tag = img_tag(image_name, size='thumb')
+        self.assertFalse(BeautifulSoup(str(tag)).find('img').get('srcset'))
+        resizer.delete_all()
+        db.commit()
+
+    def test__image_metadata(self):
+        self.assertEqual(image_metadata(db, []), {})
+        self.assertEqual(image_metadata(db, [self._creator.image]), {})
+
+        resizer = UploadImage(db.creator.image, self._creator.image)
+        resizer.resize_all()
+        set_image_metadata(db, self._creator.image, resizer.metadata_all())
+
+        data = image_metadata(db, [self._creator.image, '_fake_'])
+        self.assertEqual(data.keys(), [self._creator.image])
+        self.assertEqual(
+            sorted(data[self._creator.image].keys()),
+            sorted(['original'] + UploadImage.sizes.keys())
+        )
+        thumb = data[self._creator.image]['thumb']
+        self.assertEqual((thumb.width, thumb.height), (170, 170))
+
+        data = image_metadata(db, [self._creator.image], size='medium')
+        self.assertEqual(data[self._creator.image].keys(), ['medium'])
+
+        resizer.delete_all()
+        db.commit()
+        self.assertEqual(image_metadata(db, [self._creator.image]), {})
+
+    def test__image_srcset(self):
+        set_image_ladder(widths=[320, 640, 1920], encodings=['jpeg'])
+        image_name = self._creator.image
+
+        def url(size):
+            return URL(
+                c='images', f='download', args=image_name, vars={'size': size})
+
+        self.assertEqual(image_srcset(image_name, {}), (None, None))
+        metadata = {'original': Storage(width=1200)}
+        self.assertEqual(image_srcset(image_name, metadata), (None, None))
+
+        metadata.update({
+            'medium': Storage(width=500),
+            'w320': Storage(width=320),
+            'w640': Storage(width=640),
+        })
+        self.assertEqual(
+            image_srcset(image_name, metadata),
+            (
+                '{a} 320w, {b} 640w, {o} 1200w'.format(
+                    a=url('w320'), b=url('w640'), o=url('original')),
+                1200,
+            )
+        )
+
+        # Sizes no wider than a smaller size are not listed.
+        metadata['w1920'] = Storage(width=1200)
+        self.assertEqual(
+            image_srcset(image_name, metadata),
+            (
+                '{a} 320w, {b} 640w, {c} 1200w'.format(
+                    a=url('w320'), b=url('w640'), c=url('w1920')),
+                1200,
+            )
+        )
+
+    def test__not_modified(self):
+        request = Storage(env=Storage())
+        tag = etag('book_page.image.801685b627e099e.300332e6a7067.jpg')
+        other = etag('book_page.image.801685b627e099e.300332e6a7068.jpg')
+        date = 'Tue, 01 Jul 2014 12:00:00 GMT'
+
+        tests = [
+            # (if_none_match, if_modified_since, expect)
+            (None, None, False),
+            (tag, None, True),
+            ('W/' + tag, None, True),
+            ('*', None, True),
+            ('{o}, {t}'.format(o=other, t=tag), None, True),
+            (other, None, False),
+            (other, date, False),
+            (None, date, True),
+        ]
+        for t in tests:
+            request.env.http_if_none_match = t[0]
+            request.env.http_if_modified_since = t[1]
+            self.assertEqual(not_modified(request, tag), t[2])
+
+    def test__queue_resize(self):
+        scheduler = current.app.scheduler
+
+        # No scheduler, image is resized immediately.
+        current.app.scheduler = None
+        try:
+            ret = queue_resize(db.creator.image, self._creator.image)
+        finally:
+            current.app.scheduler = scheduler
+        self.assertEqual(ret, None)
+        resizer = UploadImage(db.creator.image, self._creator.image)
+        for size in ['medium', 'thumb']:
+            self.assertTrue(os.path.exists(resizer.fullname(size=size)))
+
+        if not scheduler:
+            return
+
+        # Sizes exist, no job is queued.
+        count = db(db.scheduler_task).count()
+        ret = queue_resize(db.creator.image, self._creator.image)
+        self.assertEqual(ret, None)
+        self.assertEqual(db(db.scheduler_task).count(), count)
+
+        resizer.delete('medium')
+        ret = queue_resize(
+            db.creator.image,
+            self._creator.image,
+            record_id=self._creator.id
+        )
+        self.assertTrue(ret.id)
+        self.assertTrue(ret.uuid)
+        task = db(db.scheduler_task.id == ret.id).select().first()
+        self.assertEqual(task.function_name, 'resize_image')
+        self.assertEqual(
+            loads(task.vars),
+            {
+                'tablename': 'creator',
+                'fieldname': 'image',
+                'image_name': self._creator.image,
+                'record_id': self._creator.id,
+            }
+        )
+        db(db.scheduler_task.id == ret.id).delete()
+        db.commit()
+
+    def test__resize_image(self):
+        set_image_ladder(widths=[])
+        dims = resize_image('creator', 'image', self._creator.image)
+        self.assertEqual(dims, {
+            'medium': UploadImage.sizes['medium'],
+            'thumb': UploadImage.sizes['thumb'],
+        })
+        resizer = UploadImage(db.creator.image, self._creator.image)
+        for size in ['medium', 'thumb']:
+            self.assertTrue(os.path.exists(resizer.fullname(size=size)))
+
+        # Image no longer exists
+        resizer.delete_all()
+        self.assertEqual(
+            resize_image('creator', 'image', self._creator.image),
+            {}
+        )
+
+    def test__save_image(self):
+        filename = os.path.join(self._image_dir, 'saved')
+
+        # Format by extension
+        im = Image.new('RGB', (100, 100))
+        save_image(im, filename + '.png')
+        self.assertEqual(Image.open(filename + '.png').format, 'PNG')
+
+        # Modes not supported by the format are converted.
+        im = Image.new('RGBA', (100, 100))
+        save_image(im, filename, image_format='JPEG')
+        saved = Image.open(filename)
+        self.assertEqual(saved.format, 'JPEG')
+        self.assertEqual(saved.mode, 'RGB')
+        self.assertEqual(im.mode, 'RGBA')
+
+        if self._webp_supported():
+            im = Image.new('P', (100, 100))
+            save_image(im, filename, image_format='WEBP')
+            saved = Image.open(filename)
+            self.assertEqual(saved.format, 'WEBP')
+            self.assertEqual(saved.mode, 'RGB')
+
+    def test__set_image_ladder(self):
+        set_image_ladder(widths=[])
+        self.assertEqual(sorted(UploadImage.sizes.keys()), ['medium', 'thumb'])
+        self.assertEqual(UploadImage.formats, {})
+        self.assertEqual(UploadImage.alternates, {})
+
+        set_image_ladder()
+        for width in IMAGE_WIDTHS:
+            size = 'w{w}'.format(w=width)
+            self.assertEqual(UploadImage.sizes[size], (width, width * 4))
+            self.assertEqual(UploadImage.formats[size], 'JPEG')
+
+        set_image_ladder(widths='640, 320', encodings='jpeg,webp')
+        expect = ['medium', 'thumb', 'w320', 'w640']
+        if self._webp_supported():
+            expect.extend(['w320_webp', 'w640_webp'])
+            self.assertEqual(
+                UploadImage.alternates,
+                {'w320': 'w320_webp', 'w640': 'w640_webp'}
+            )
+            self.assertEqual(UploadImage.formats['w640_webp'], 'WEBP')
+        self.assertEqual(sorted(UploadImage.sizes.keys()), sorted(expect))
+
+        # Without jpeg, the ladder has the format of the original.
+        set_image_ladder(widths=640, encodings='webp')
+        self.assertTrue('w640' in UploadImage.sizes)
+        self.assertTrue('w320' not in UploadImage.sizes)
+        self.assertTrue('w640' not in UploadImage.formats)
+
+        set_image_ladder(widths=False)
+        self.assertEqual(sorted(UploadImage.sizes.keys()), ['medium', 'thumb'])
+
+    def test__set_image_metadata(self):
+        def get_rows():
+            query = (db.image_size.image == self._creator.image)
+            return db(query).select(
+                db.image_size.ALL, orderby=db.image_size.size)
+
+        data = dict(width=1, height=2, bytes=3, format='PNG', checksum='abc')
+        set_image_metadata(db, self._creator.image, {'thumb': data})
+        rows = get_rows()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].size, 'thumb')
+        self.assertEqual(rows[0].width, 1)
+        self.assertEqual(rows[0].checksum, 'abc')
+
+        # Update
+        data['width'] = 10
+        set_image_metadata(db, self._creator.image, {
+            'thumb': data,
+            'original': data,
+        })
+        rows = get_rows()
+        self.assertEqual([x.size for x in rows], ['original', 'thumb'])
+        self.assertEqual([x.width for x in rows], [10, 10])
+
+        # Delete
+        set_image_metadata(db, self._creator.image, {
+            'thumb': None,
+            'original': None,
+        })
+        self.assertEqual(len(get_rows()), 0)
+
     def test__set_thumb_dimensions(self):
         book_page_id = db.book_page.insert(
             page_no=1,
@@ -335,6 +901,73 @@ class TestFunctions(LocalTestCase):
             self.assertEqual(book_page.thumb_h, t[0][1])
             self.assertEqual(book_page.thumb_shrink, t[1])
 
+    def test__size_names(self):
+        set_image_ladder(widths=[640], encodings=['jpeg', 'webp'])
+        self.assertEqual(
+            size_names(), ['original', 'medium', 'thumb', 'w640'])
+
+    def test__store_image(self):
+        image_filename = os.path.join(self._image_dir, self._image_name)
+        with open(image_filename, 'rb') as f:
+            checksum = hashlib.sha1(f.read()).hexdigest()
+        self.assertEqual(
+            self._creator.image, 'creator.image.{c}.jpg'.format(c=checksum))
+
+        # Identical image shares the stored file, whatever its filename.
+        with open(image_filename, 'rb') as f:
+            image_name = store_image(db.creator.image, f, 'copy.jpg')
+        self.assertEqual(image_name, self._creator.image)
+        fullname = UploadImage(db.creator.image, image_name).fullname()
+        self.assertEqual(
+            os.listdir(os.path.dirname(fullname)), [image_name])
+
+        # Storing it again for the same record keeps the file.
+        self._creator.update_record(image=image_name)
+        db.commit()
+        self.assertTrue(os.path.exists(fullname))
+
+        # A different image is stored separately.
+        other_filename = os.path.join(self._image_dir, 'other.jpg')
+        im = Image.new('RGB', (100, 100))
+        with open(other_filename, 'wb') as f:
+            im.save(f)
+        with open(other_filename, 'rb') as f:
+            other_name = store_image(db.creator.image, f)
+        self.assertNotEqual(other_name, image_name)
+        self.assertTrue(other_name.startswith('creator.image.'))
+        self.assertTrue(other_name.endswith('.jpg'))
+        other_fullname = UploadImage(db.creator.image, other_name).fullname()
+        self.assertTrue(os.path.exists(other_fullname))
+
+        # The stored file was lost, it is restored.
+        os.unlink(other_fullname)
+        with open(other_filename, 'rb') as f:
+            self.assertEqual(
+                store_image(db.creator.image, f, 'other.jpg'), other_name)
+        self.assertTrue(os.path.exists(other_fullname))
+
+        # Reusing a stored image touches its files so they are not purged.
+        resizer = UploadImage(db.creator.image, image_name)
+        resizer.resize_all()
+        for size in ['original', 'medium', 'thumb']:
+            os.utime(resizer.fullname(size=size), (0, 0))
+        with open(image_filename, 'rb') as f:
+            store_image(db.creator.image, f)
+        for size in ['original', 'medium', 'thumb']:
+            self.assertTrue(
+                os.stat(resizer.fullname(size=size)).st_mtime > 0)
+
+        # Deleting a record does not delete the files, other records may
+        # share them.
+        creator_id = db.creator.insert(
+            auth_user_id=self._auth_user.id,
+            email='store_image@example.com',
+            image=other_name,
+        )
+        db.commit()
+        db(db.creator.id == creator_id).delete()
+        db.commit()
+        self.assertTrue(os.path.exists(other_fullname))
 
 def setUpModule():
     """Set up web2py environment."""
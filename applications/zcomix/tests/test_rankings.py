@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Test suite for zcomix/modules/rankings.py
+
+"""
+import datetime
+import unittest
+from gluon import *
+from applications.zcomix.modules.rankings import \
+    RANKINGS, \
+    delete_book, \
+    rank_books, \
+    ranked_rows, \
+    ranking_size
+from applications.zcomix.modules.test_runner import LocalTestCase
+
+# C0111: Missing docstring
+# R0904: Too many public methods
+# pylint: disable=C0111,R0904
+
+
+class RankingsTestCase(LocalTestCase):
+    """ Base class for ranking test cases. Sets up test data."""
+
+    _book = None
+    _book_2 = None
+
+    _objects = []
+
+    # C0103: *Invalid name "%s" (should match %s)*
+    # pylint: disable=C0103
+    @classmethod
+    def setUp(cls):
+        # The book is first in every ranking.
+        top = dict()
+        for field in RANKINGS:
+            max_value = db.book[field].max()
+            value = db().select(max_value).first()[max_value]
+            if field == 'created_on':
+                top[field] = (value or datetime.datetime.now()) + \
+                    datetime.timedelta(days=1)
+            else:
+                top[field] = (value or 0) + 1
+        book_id = db.book.insert(
+            name='RankingsTestCase',
+            reader='scroller',
+            **top
+        )
+        # The second book follows it in the views_year ranking.
+        book_2_id = db.book.insert(
+            name='RankingsTestCase 2',
+            reader='slider',
+            views_year=top['views_year'] - 1,
+        )
+        db.commit()
+        cls._book = db(db.book.id == book_id).select().first()
+        cls._objects.append(cls._book)
+        cls._book_2 = db(db.book.id == book_2_id).select().first()
+        cls._objects.append(cls._book_2)
+
+    @classmethod
+    def tearDown(cls):
+        delete_book(db, cls._book.id)
+        delete_book(db, cls._book_2.id)
+        db.commit()
+
+
+class TestFunctions(RankingsTestCase):
+
+    def test__delete_book(self):
+        ranked = rank_books(db)
+        delete_book(db, self._book.id)
+        query = (db.book_ranking.book_id == self._book.id)
+        self.assertEqual(db(query).count(), 0)
+
+        # The following books move up one rank.
+        for ranking in RANKINGS:
+            query = (db.book_ranking.ranking == ranking)
+            ranks = [x.rank_no for x in db(query).select(
+                db.book_ranking.rank_no, orderby=db.book_ranking.rank_no)]
+            self.assertEqual(ranks, range(1, ranked))
+            self.assertEqual(ranking_size(db, ranking), ranked - 1)
+
+    def test__rank_books(self):
+        ranked = rank_books(db)
+        db.commit()
+        self.assertEqual(ranked, db(db.book).count())
+        for ranking in RANKINGS:
+            query = (db.book_ranking.ranking == ranking)
+            self.assertEqual(db(query).count(), ranked)
+            ranks = db(query).select(
+                db.book_ranking.ALL,
+                orderby=db.book_ranking.rank_no,
+                limitby=(0, 1),
+            )
+            self.assertEqual(ranks[0].rank_no, 1)
+            self.assertEqual(ranks[0].book_id, self._book.id)
+            self.assertEqual(ranks[0].name, 'RankingsTestCase')
+
+        # The rankings match the search grid order.
+        query = (db.book_ranking.ranking == 'views_year')
+        ranked_ids = [x.book_id for x in db(query).select(
+            db.book_ranking.book_id, orderby=db.book_ranking.rank_no)]
+        book_ids = [x.id for x in db(db.book).select(
+            db.book.id, orderby=[~db.book.views_year, db.book.id])]
+        self.assertEqual(ranked_ids, book_ids)
+
+    def test__ranked_rows(self):
+        rank_books(db)
+        rows = ranked_rows(db, 'views_year', 0, 2)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0].book.id, self._book.id)
+        self.assertEqual(rows[0].book.name, 'RankingsTestCase')
+        self.assertEqual(rows[0].book.reader, 'scroller')
+        self.assertEqual(rows[0].book.views_year, self._book.views_year)
+        self.assertTrue(isinstance(rows[0].book.views_year, int))
+        self.assertEqual(rows[0].creator.id, None)
+        self.assertEqual(rows[0].auth_user.name, None)
+
+        rows = ranked_rows(db, 'created_on', 0, 1)
+        self.assertEqual(rows[0].book.created_on, self._book.created_on)
+
+        rows = ranked_rows(db, 'views_year', 1, 1)
+        self.assertNotEqual(rows[0].book.id, self._book.id)
+
+
+def setUpModule():
+    """Set up web2py environment."""
+    # C0103: *Invalid name "%%s" (should match %%s)*
+    # pylint: disable=C0103
+    LocalTestCase.set_env(globals())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,9 +7,20 @@ Test suite for zcomix/modules/search.py
 
 """
 
+import datetime
 import unittest
 from gluon import *
-from applications.zcomix.modules.search import Search
+from applications.zcomix.modules.rankings import \
+    delete_book, \
+    rank_books
+from applications.zcomix.modules.search import \
+    Paginator, \
+    Search, \
+    decode_cursor, \
+    encode_cursor, \
+    keyset_query, \
+    left_joins, \
+    result_count
 from applications.zcomix.modules.test_runner import LocalTestCase
 
 # C0111: Missing docstring
@@ -17,19 +28,287 @@ from applications.zcomix.modules.test_runner import LocalTestCase
 # pylint: disable=C0111,R0904
 
 
+class TestPaginator(LocalTestCase):
+
+    def test____init__(self):
+        paginator = Paginator(request)
+        self.assertEqual(paginator.page, 1)
+        self.assertEqual(paginator.page_count, None)
+        self.assertEqual(paginator.prev_url, None)
+        self.assertEqual(paginator.next_url, None)
+        self.assertFalse(paginator)
+
+        paginator = Paginator(request, start=20, paginate=10, total=45,
+                              prev_cursor='10_1_2', next_cursor='30_3_4')
+        self.assertEqual(paginator.page, 3)
+        self.assertEqual(paginator.page_count, 5)
+        self.assertTrue('after=10_1_2' in paginator.prev_url)
+        self.assertTrue('after=30_3_4' in paginator.next_url)
+        self.assertTrue(paginator)
+
+    def test__as_html(self):
+        self.assertEqual(Paginator(request).as_html(), '')
+        paginator = Paginator(request, start=10, paginate=10, total=20,
+                              prev_cursor='')
+        html = str(paginator.as_html())
+        self.assertTrue('web2py_paginator' in html)
+        self.assertTrue('page 2 of 2' in html)
+
+    def test__links(self):
+        paginator = Paginator(request, paginate=10, total=20,
+                              next_cursor='10_1_2')
+        links = paginator.links()
+        self.assertEqual(len(links.components), 2)
+        self.assertTrue('after=10_1_2' in str(links))
+
+    def test__url(self):
+        paginator = Paginator(request)
+        self.assertFalse('after' in paginator.url(''))
+        self.assertTrue('after=10_1_2' in paginator.url('10_1_2'))
+
+
 class TestSearch(LocalTestCase):
 
+    _books = []
+
+    _objects = []
+
+    # C0103: *Invalid name "%s" (should match %s)*
+    # pylint: disable=C0103
+    @classmethod
+    def setUp(cls):
+        # Enough released books for three pages of results.
+        cls._books = []
+        for i in range(25):
+            book_id = db.book.insert(
+                name='SearchTestCase {i:02d}'.format(i=i),
+                release_date=datetime.date.today(),
+                views_year=i,
+            )
+            db.commit()
+            book = db(db.book.id == book_id).select().first()
+            cls._books.append(book)
+            cls._objects.append(book)
+
+    @classmethod
+    def tearDown(cls):
+        for book in cls._books:
+            delete_book(db, book.id)
+        db.commit()
+
     def test____init__(self):
         search = Search()
         self.assertTrue(search)
         self.assertTrue('contributions' in search.order_fields)
 
+    def test__fields(self):
+        fields = [str(x) for x in Search().fields(db)]
+        self.assertTrue('book.id' in fields)
+        self.assertTrue('creator.id' in fields)
+
+    def test__filters(self):
+        search = Search()
+        query, creator, editable = search.filters(db, request)
+        self.assertEqual(str(query), str(db.book.id > 0))
+        self.assertEqual(creator, None)
+        self.assertFalse(editable)
+
+        request.vars.released = '1'
+        query, creator, editable = search.filters(db, request)
+        self.assertEqual(str(query), str(db.book.release_date != None))
+        request.vars.released = None
+
+    def test__ordering(self):
+        search = Search()
+        tests = [
+            # (o, period, expect fieldname)
+            (None, None, 'views_year'),
+            ('views', 'month', 'views_month'),
+            ('contributions', None, 'contributions_year'),
+            ('rating', 'month', 'rating_month'),
+            ('newest', 'month', 'created_on'),
+            ('_fake_', None, 'views_year'),
+        ]
+        for t in tests:
+            request.vars.o = t[0]
+            request.vars.period = t[1]
+            orderby_field, fieldname = search.ordering(request)
+            self.assertEqual(fieldname, t[2])
+            self.assertTrue(orderby_field in search.order_fields.values())
+        request.vars.o = None
+        request.vars.period = None
+
+    def test__paginator(self):
+        rank_books(db)
+        db.commit()
+        search = Search()
+        search.set_rows(db, request)
+        paginator = search.paginator(request)
+        self.assertEqual(paginator.page, 1)
+        self.assertEqual(paginator.prev_url, None)
+        self.assertTrue(paginator.next_url)
+
     def test__set(self):
         search = Search()
         self.assertFalse(search.grid)
         search.set(db, request)
         self.assertTrue(search.grid)
         self.assertEqual(len(search.grid.rows), 10)
+        self.assertEqual(search.start, 0)
+        self.assertEqual(search.prev_cursor, None)
+        self.assertTrue(search.next_cursor)
+        self.assertTrue(search.total > 10)
+
+        # Keyset pagination matches offset pagination.
+        first_ids = [x.book.id for x in search.grid.rows]
+        request.vars.after = search.next_cursor
+        search = Search()
+        search.set(db, request)
+        self.assertEqual(search.start, 10)
+        self.assertEqual(search.prev_cursor, '')
+        books = db(db.book).select(
+            db.book.id,
+            orderby=[~db.book.views_year, db.book.id],
+            limitby=(0, 20),
+        )
+        second_ids = [x.book.id for x in search.grid.rows]
+        self.assertEqual(first_ids + second_ids, [x.id for x in books])
+
+        # The previous page cursor of the third page leads to the second.
+        request.vars.after = search.next_cursor
+        search = Search()
+        search.set(db, request)
+        self.assertEqual(search.start, 20)
+        self.assertTrue(search.prev_cursor)
+        request.vars.after = search.prev_cursor
+        search = Search()
+        search.set(db, request)
+        self.assertEqual(search.start, 10)
+        self.assertEqual(search.grid.rows[0].book.id, second_ids[0])
+        self.assertEqual([x.book.id for x in search.grid.rows], second_ids)
+        request.vars.after = None
+
+    def test__set_ranked(self):
+        rank_books(db)
+        db.commit()
+        search = Search()
+        self.assertTrue(search.set_ranked(db, request))
+        self.assertEqual(search.grid, None)
+        self.assertEqual(len(search.rows), 10)
+        self.assertEqual(search.prev_cursor, None)
+        self.assertTrue(search.next_cursor)
+
+        # The ranked rows match the grid rows.
+        grid_search = Search()
+        grid_search.set(db, request)
+        self.assertEqual(
+            [x.book.id for x in search.rows],
+            [x.book.id for x in grid_search.rows]
+        )
+
+        request.vars.after = search.next_cursor
+        search = Search()
+        self.assertTrue(search.set_ranked(db, request))
+        self.assertEqual(search.start, 10)
+        self.assertEqual(search.prev_cursor, '')
+        grid_search = Search()
+        grid_search.set(db, request)
+        self.assertEqual(
+            [x.book.id for x in search.rows],
+            [x.book.id for x in grid_search.rows]
+        )
+        request.vars.after = None
+
+        # Filtered searches are not ranked.
+        request.vars.kw = 'abc'
+        self.assertFalse(Search().set_ranked(db, request))
+        request.vars.kw = None
+
+    def test__set_rows(self):
+        rank_books(db)
+        db.commit()
+        search = Search()
+        search.set_rows(db, request)
+        self.assertEqual(search.grid, None)
+        self.assertEqual(len(search.rows), 10)
+
+        # The rows and cursors match those of the grid.
+        grid_search = Search()
+        grid_search.set(db, request)
+        self.assertEqual(
+            [x.book.id for x in search.rows],
+            [x.book.id for x in grid_search.rows]
+        )
+        self.assertEqual(search.next_cursor, grid_search.next_cursor)
+        self.assertEqual(search.total, grid_search.total)
+
+        request.vars.after = search.next_cursor
+        search = Search()
+        search.set_rows(db, request)
+        self.assertEqual(search.start, 10)
+        self.assertEqual(search.prev_cursor, '')
+        request.vars.after = None
+
+    def test__set_cover_images(self):
+        search = Search()
+        search.set_cover_images(db)
+        self.assertEqual(search.cover_images, {})
+
+        search.set(db, request)
+        search.set_cover_images(db)
+        self.assertEqual(
+            sorted(search.cover_images.keys()),
+            sorted([x.book.id for x in search.grid.rows])
+        )
+
+
+class TestFunctions(LocalTestCase):
+
+    def test__decode_cursor(self):
+        tests = [
+            # (field, cursor, expect)
+            (db.book.views_year, '10_123_45', (10, 123, 45)),
+            (db.book.rating_year, '0_1_4.5', (0, 1, 4.5)),
+            (
+                db.book.created_on,
+                '20_2_2014-07-15 12:01:02',
+                (20, 2, datetime.datetime(2014, 7, 15, 12, 1, 2))
+            ),
+            (db.book.views_year, None, None),
+            (db.book.views_year, '', None),
+            (db.book.views_year, '10_123', None),
+            (db.book.views_year, 'a_b_c', None),
+        ]
+        for t in tests:
+            self.assertEqual(decode_cursor(t[0], t[1]), t[2])
+
+    def test__encode_cursor(self):
+        self.assertEqual(encode_cursor(10, 123, 45), '10_123_45')
+        self.assertEqual(encode_cursor(0, 1, 4.5), '0_1_4.5')
+        value = datetime.datetime(2014, 7, 15, 12, 1, 2)
+        cursor = encode_cursor(20, 2, value)
+        self.assertEqual(cursor, '20_2_2014-07-15 12:01:02')
+        self.assertEqual(
+            decode_cursor(db.book.created_on, cursor), (20, 2, value))
+
+    def test__keyset_query(self):
+        query = keyset_query(db.book.views_year, 5, 100)
+        self.assertEqual(
+            str(query),
+            '((book.views_year < 5) OR ((book.views_year = 5) AND (book.id > 100)))'
+        )
+        query = keyset_query(db.book.views_year, 5, 100, after=False)
+        self.assertEqual(
+            str(query),
+            '((book.views_year > 5) OR ((book.views_year = 5) AND (book.id < 100)))'
+        )
+
+    def test__left_joins(self):
+        self.assertEqual(len(left_joins(db)), 2)
+
+    def test__result_count(self):
+        self.assertEqual(result_count(db, db.book.id > 0), db(db.book).count())
+        self.assertEqual(result_count(db, db.book.id < 0), 0)
 
 
 def setUpModule():
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+Test suite for zcomix/modules/tallies.py
+
+"""
+import datetime
+import unittest
+from gluon import *
+from applications.zcomix.modules.caching import \
+    CACHE_PREFIX, \
+    page_cache
+from applications.zcomix.modules.tallies import \
+    add_events, \
+    expire_buckets, \
+    tally_books, \
+    update_tallies
+from applications.zcomix.modules.test_runner import LocalTestCase
+
+# C0111: Missing docstring
+# R0904: Too many public methods
+# pylint: disable=C0111,R0904
+
+
+class TalliesTestCase(LocalTestCase):
+    """ Base class for tally test cases. Sets up test data."""
+
+    _book = None
+    _now = datetime.datetime(2014, 7, 15, 12, 0, 0)
+    _today = _now.date()
+    _watermarks = None
+
+    _objects = []
+
+    # C0103: *Invalid name "%s" (should match %s)*
+    # pylint: disable=C0103
+    @classmethod
+    def setUp(cls):
+        # Events of other books are not part of the tests, start the
+        # watermarks after them.
+        cls._watermarks = db(db.tally_watermark).select(
+            db.tally_watermark.ALL).as_list()
+        for tablename in ['contribution', 'rating', 'book_view']:
+            max_id = db[tablename].id.max()
+            top_id = db().select(max_id).first()[max_id] or 0
+            db.tally_watermark.update_or_insert(
+                db.tally_watermark.tablename == tablename,
+                tablename=tablename,
+                max_id=top_id,
+            )
+        db.commit()
+
+        book_id = db.book.insert(name='TalliesTestCase')
+        db.commit()
+        cls._book = db(db.book.id == book_id).select().first()
+        cls._objects.append(cls._book)
+
+    @classmethod
+    def tearDown(cls):
+        db(db.book_tally.book_id == cls._book.id).delete()
+        db(db.tally_watermark).delete()
+        for watermark in cls._watermarks:
+            db.tally_watermark.insert(**watermark)
+        db.commit()
+
+    def _add(self, tablename, days_ago, amount=None):
+        data = dict(
+            book_id=self._book.id,
+            time_stamp=self._now - datetime.timedelta(days=days_ago),
+        )
+        if amount is not None:
+            data['amount'] = amount
+        record_id = db[tablename].insert(**data)
+        db.commit()
+        record = db(db[tablename].id == record_id).select().first()
+        self._objects.append(record)
+
+    def _buckets(self):
+        query = (db.book_tally.book_id == self._book.id)
+        return db(query).select(
+            db.book_tally.ALL, orderby=db.book_tally.tally_date)
+
+
+class TestFunctions(TalliesTestCase):
+
+    def test__add_events(self):
+        self._add('contribution', 0, amount=5.00)
+        self._add('contribution', 0, amount=2.50)
+        self._add('contribution', 40, amount=10.00)
+        self._add('contribution', 400, amount=100.00)
+
+        self.assertEqual(add_events(db, 'contribution', today=self._today), 3)
+        buckets = self._buckets()
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(
+            buckets[0].tally_date,
+            self._today - datetime.timedelta(days=40)
+        )
+        self.assertEqual(buckets[0].contributions, 10.00)
+        self.assertEqual(buckets[1].tally_date, self._today)
+        self.assertEqual(buckets[1].contributions, 7.50)
+        self.assertEqual(buckets[1].views, 0)
+
+        # Only new events are added.
+        self.assertEqual(add_events(db, 'contribution', today=self._today), 0)
+        self._add('contribution', 0, amount=1.00)
+        self.assertEqual(add_events(db, 'contribution', today=self._today), 1)
+        buckets = self._buckets()
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(buckets[1].contributions, 8.50)
+
+        self._add('rating', 0, amount=4)
+        self._add('rating', 0, amount=2)
+        self._add('book_view', 0)
+        self.assertEqual(add_events(db, 'rating', today=self._today), 2)
+        self.assertEqual(add_events(db, 'book_view', today=self._today), 1)
+        buckets = self._buckets()
+        self.assertEqual(buckets[1].rating_total, 6)
+        self.assertEqual(buckets[1].rating_count, 2)
+        self.assertEqual(buckets[1].views, 1)
+
+    def test__expire_buckets(self):
+        for days_ago in [0, 364, 365, 400]:
+            db.book_tally.insert(
+                book_id=self._book.id,
+                tally_date=self._today - datetime.timedelta(days=days_ago),
+                views=1,
+            )
+        db.commit()
+        self.assertEqual(expire_buckets(db, today=self._today), 2)
+        self.assertEqual(
+            [x.tally_date for x in self._buckets()],
+            [
+                self._today - datetime.timedelta(days=364),
+                self._today,
+            ]
+        )
+
+    def test__tally_books(self):
+        buckets = [
+            # (days ago, contributions, rating_total, rating_count, views)
+            (0, 5.00, 9, 2, 3),
+            (29, 1.00, 0, 0, 1),
+            (30, 10.00, 3, 1, 2),
+        ]
+        for b in buckets:
+            db.book_tally.insert(
+                book_id=self._book.id,
+                tally_date=self._today - datetime.timedelta(days=b[0]),
+                contributions=b[1],
+                rating_total=b[2],
+                rating_count=b[3],
+                views=b[4],
+            )
+        db.commit()
+
+        self.assertTrue(self._book.id in tally_books(db, today=self._today))
+        book = db(db.book.id == self._book.id).select().first()
+        self.assertEqual(book.contributions_month, 6.00)
+        self.assertEqual(book.contributions_year, 16.00)
+        self.assertEqual(book.rating_month, 4.5)
+        self.assertEqual(book.rating_year, 4.0)
+        self.assertEqual(book.views_month, 4)
+        self.assertEqual(book.views_year, 6)
+
+        # Values that are unchanged are not updated.
+        self.assertEqual(tally_books(db, today=self._today), [])
+
+        # Month values expire.
+        tally_books(db, today=self._today + datetime.timedelta(days=60))
+        book = db(db.book.id == self._book.id).select().first()
+        self.assertEqual(book.contributions_month, 0)
+        self.assertEqual(book.rating_month, 0)
+        self.assertEqual(book.views_month, 0)
+        self.assertEqual(book.views_year, 6)
+
+    def test__update_tallies(self):
+        self._add('contribution', 0, amount=5.00)
+        self._add('rating', 0, amount=3)
+        self._add('book_view', 0)
+        self._add('book_view', 100)
+
+        # The cached pages of the books updated, and search pages, are
+        # invalidated.
+        keys = [
+            '{p}:{t}:default/index.html/?#'.format(p=CACHE_PREFIX, t=x)
+            for x in ['book.{i}'.format(i=self._book.id), 'search']
+        ]
+        for key in keys:
+            page_cache()(key, lambda: 'html', time_expire=60)
+
+        results = update_tallies(db, today=self._today)
+        for key in keys:
+            self.assertFalse(key in page_cache().storage)
+        self.assertEqual(results['events'], {
+            'contribution': 1,
+            'rating': 1,
+            'book_view': 2,
+        })
+        book = db(db.book.id == self._book.id).select().first()
+        self.assertEqual(book.contributions_month, 5.00)
+        self.assertEqual(book.rating_year, 3)
+        self.assertEqual(book.views_month, 1)
+        self.assertEqual(book.views_year, 2)
+
+
+def setUpModule():
+    """Set up web2py environment."""
+    # C0103: *Invalid name "%%s" (should match %%s)*
+    # pylint: disable=C0103
+    LocalTestCase.set_env(globals())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -158,6 +158,16 @@ class TestFunctions(LocalTestCase):
         # 'c' is not included in query so it doesn't move.
         test_move('a', 'down', ['b', 'a', 'c'], query=query)
 
+        # Test repeated values
+        db(db.test__reorder).update(order_no=0)
+        db.commit()
+        test_move('b', 'up', ['b', 'a', 'c'])
+        self.assertEqual(self._ordered_values(field='order_no'), [1, 2, 3])
+        db(db.test__reorder).update(order_no=0)
+        db.commit()
+        test_move('b', 'down', ['a', 'c', 'b'])
+        self.assertEqual(self._ordered_values(field='order_no'), [1, 2, 3])
+
     def test__profile_wells(self):
         request = Storage()
         request.function = 'books'
@@ -300,6 +310,22 @@ class TestFunctions(LocalTestCase):
         self.assertEqual(self._ordered_values(), ['a', 'c', 'd'])
         self.assertEqual(self._ordered_values(field='order_no'), [1, 2, 3])
 
+        # Test values param
+        d_id = db(db.test__reorder.name == 'd').select().first().id
+        self.assertEqual(
+            reorder(
+                db.test__reorder.order_no,
+                record_ids=[self._by_name['a'], d_id],
+                values=[3, 1],
+            ),
+            2
+        )
+        self.assertEqual(self._ordered_values(), ['d', 'c', 'a'])
+        self.assertEqual(self._ordered_values(field='order_no'), [1, 2, 3])
+
+        # Unchanged records are not updated
+        self.assertEqual(reorder(db.test__reorder.order_no), 0)
+
 
 def setUpModule():
     """Set up web2py environment."""
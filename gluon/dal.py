@@ -201,7 +201,8 @@ CALLABLETYPES = (types.LambdaType, types.FunctionType,
 TABLE_ARGS = set(
     ('migrate','primarykey','fake_migrate','format','redefine',
      'singular','plural','trigger_name','sequence_name','fields',
-     'common_filter','polymodel','table_class','on_define','rname'))
+     'common_filter','polymodel','table_class','on_define','rname',
+     'indexes'))
 
 SELECT_ARGS = set(
     ('orderby', 'groupby', 'limitby','required', 'cache', 'left',
@@ -262,6 +263,14 @@ REGEX_CONST_STRING = re.compile('(\"[^\"]*?\")|(\'[^\']*?\')')
 REGEX_SEARCH_PATTERN = re.compile('^{[^\.]+\.[^\.]+(\.(lt|gt|le|ge|eq|ne|contains|startswith|year|month|day|hour|minute|second))?(\.not)?}$')
 REGEX_SQUARE_BRACKETS = re.compile('^.+\[.+\]$')
 REGEX_STORE_PATTERN = re.compile('\.(?P<e>\w{1,5})$')
+REGEX_SQLITE_SCAN = re.compile('^SCAN (TABLE )?(?P<table>\w+)')
+REGEX_SQLITE_WRITE = re.compile('^\s*(INSERT|UPDATE|DELETE|REPLACE|BEGIN)\s',
+                                re.I)
+REGEX_POSTGRES_SCAN = re.compile('Seq Scan on (?P<table>\w+)')
+REGEX_SQL_STRING = re.compile("'(?:[^']|'')*'")
+REGEX_SQL_NUMBER = re.compile('(?<![\w.])-?\d+(\.\d+)?(?![\w.])')
+REGEX_SQL_LIST = re.compile('\((\?,\s*)+\?\)')
+REGEX_SQL_SELECT = re.compile('^\s*SELECT\s', re.I)
 REGEX_QUOTES = re.compile("'[^']*'")
 REGEX_ALPHANUMERIC = re.compile('^[0-9a-zA-Z]\w*$')
 REGEX_PASSWORD = re.compile('\://([^:@]*)\:')
@@ -572,6 +581,11 @@ class ConnectionPool(object):
     # ## this allows gluon to commit/rollback all dbs in this thread
 
     def close(self,action='commit',really=True):
+        db = getattr(self, 'db', None)
+        for log in (getattr(db, '_recorder', None),
+                    getattr(db, '_slow_log', None)):
+            if log is not None:
+                log.close()
         if action:
             if callable(action):
                 action(self)
@@ -580,7 +594,7 @@ class ConnectionPool(object):
         # ## if you want pools, recycle this connection
         if self.pool_size:
             GLOBAL_LOCKER.acquire()
-            pool = ConnectionPool.POOLS[self.uri]
+            pool = ConnectionPool.POOLS[self.pool_key()]
             if len(pool) < self.pool_size:
                 pool.append(self.connection)
                 really = False
@@ -616,6 +630,10 @@ class ConnectionPool(object):
         if False and self.folder and not exists(self.folder):
             os.mkdir(self.folder)
 
+    def pool_key(self):
+        """ connections of the same pool key are interchangeable """
+        return self.uri
+
     def after_connection_hook(self):
         """hook for the after_connection parameter"""
         if callable(self._after_connection):
@@ -647,7 +665,7 @@ class ConnectionPool(object):
             self.connection = f()
             self.cursor = cursor and self.connection.cursor()
         else:
-            uri = self.uri
+            uri = self.pool_key()
             POOLS = ConnectionPool.POOLS
             while True:
                 GLOBAL_LOCKER.acquire()
@@ -671,6 +689,246 @@ class ConnectionPool(object):
         self.after_connection_hook()
 
 
+def sql_shape(sql):
+    """
+    Returns the sql with its values replaced by ?, the same for the
+    queries that differ only by their values, eg
+
+        >>> sql_shape("SELECT * FROM t WHERE a = 'x' AND b IN (1,2,3);")
+        'SELECT * FROM t WHERE a = ? AND b IN (?);'
+    """
+    shape = REGEX_SQL_STRING.sub('?', sql)
+    shape = REGEX_SQL_NUMBER.sub('?', shape)
+    return REGEX_SQL_LIST.sub('(?)', shape)
+
+
+def calling_frame():
+    """
+    Returns the first frame outside of the DAL, the code which ran the
+    query, as 'file:line function'
+    """
+    frame = sys._getframe(1)
+    while frame and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    return frame and '%s:%s %s' % (frame.f_code.co_filename,
+                                   frame.f_lineno,
+                                   frame.f_code.co_name)
+
+
+class QueryRecorder(object):
+    """
+    Records the statements executed by a DAL, see DAL.record_queries().
+    Each query is a dict: sql, seconds, rows and frame, the file, line
+    and function which called the DAL.
+
+    Statements of the same shape repeated at least N_PLUS_ONE times are
+    reported as N+1 candidates, ie one query per row of a previous one.
+
+    At most MAX_QUERIES are kept, the later ones are only counted.
+    """
+
+    N_PLUS_ONE = 3
+    MAX_QUERIES = 1000
+
+    def __init__(self, on_close=None):
+        self.queries = []
+        self.dropped = 0
+        self.dropped_seconds = 0.0
+        self.on_close = on_close
+
+    def __len__(self):
+        return len(self.queries) + self.dropped
+
+    def record(self, sql, seconds, rows=-1):
+        if len(self.queries) >= self.MAX_QUERIES:
+            self.dropped += 1
+            self.dropped_seconds += seconds
+            return
+        self.queries.append(dict(
+                sql=sql, seconds=seconds, rows=rows, frame=calling_frame()))
+
+    def set_rows(self, rows):
+        """ sets the rows of the last query, for selects """
+        if self.queries and not self.dropped:
+            self.queries[-1]['rows'] = rows
+
+    def seconds(self):
+        return sum(q['seconds'] for q in self.queries) + self.dropped_seconds
+
+    def repeated(self, minimum=None):
+        """
+        Returns [(shape, [query, ...]), ...] for the shapes executed at
+        least minimum times, most repeated first
+        """
+        minimum = minimum or self.N_PLUS_ONE
+        shapes = {}
+        for query in self.queries:
+            shapes.setdefault(sql_shape(query['sql']), []).append(query)
+        repeated = [(k, v) for (k, v) in shapes.items() if len(v) >= minimum]
+        return sorted(repeated, key=lambda x: -len(x[1]))
+
+    def summary(self):
+        lines = ['%i queries, %.1fms' % (len(self), self.seconds() * 1000)]
+        for query in self.queries:
+            lines.append('%7.1fms %5s rows  %s\n%20s%s' % (
+                    query['seconds'] * 1000, query['rows'], query['sql'],
+                    'at ', query['frame']))
+        for shape, queries in self.repeated():
+            frames = sorted(set(q['frame'] for q in queries))
+            lines.append('N+1 candidate, %i times: %s\n%20s%s' % (
+                    len(queries), shape, 'at ', ', '.join(frames)))
+        if self.dropped:
+            lines.append('%i queries not recorded, maximum %i' % (
+                    self.dropped, self.MAX_QUERIES))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.on_close:
+            self.on_close(self)
+
+
+class SlowQueryLog(object):
+    """
+    Logs the statements executed by a DAL which take threshold seconds or
+    more, see DAL.log_slow_queries(). Each query is a dict: fingerprint,
+    seconds, rows, caller, eg the controller, frame and plan.
+
+    The sql is logged by its fingerprint, see sql_shape(), so the values
+    of a statement, eg emails or passwords, are never written. With
+    explain=True the query plan of slow SELECTs is captured, if the
+    adapter supports it, see BaseAdapter.explain(). The strings of the
+    plan, eg the conditions of a postgres Filter, are replaced by ?.
+
+    If filename is set, the statistics of each fingerprint are added to
+    the file, json, when the connection is closed, see load().
+
+    At most MAX_QUERIES are kept, the later ones are only counted.
+    """
+
+    MAX_QUERIES = 1000
+
+    def __init__(self, threshold=0.5, explain=False, filename=None,
+                 caller=None):
+        self.threshold = threshold
+        self.explain = explain
+        self.filename = filename
+        self.caller = caller
+        self.queries = []
+        self.dropped = 0
+        self.dropped_seconds = 0.0
+        self.last = None
+
+    def __len__(self):
+        return len(self.queries) + self.dropped
+
+    def record(self, adapter, sql, seconds, rows=-1):
+        self.last = None
+        if seconds < self.threshold:
+            return
+        if len(self.queries) >= self.MAX_QUERIES:
+            self.dropped += 1
+            self.dropped_seconds += seconds
+            return
+        query = dict(fingerprint=sql_shape(sql), seconds=seconds, rows=rows,
+                     caller=self.caller, frame=calling_frame(), plan=None)
+        if self.explain and REGEX_SQL_SELECT.match(sql):
+            try:
+                plan = adapter.explain(sql)
+                query['plan'] = plan and [
+                    REGEX_SQL_STRING.sub('?', line) for line in plan]
+            except Exception, e:
+                query['plan'] = ['EXPLAIN failed: %s' % e]
+        self.queries.append(query)
+        self.last = query
+
+    def set_rows(self, rows):
+        """ sets the rows of the last query, if slow, for selects """
+        if self.last is not None:
+            self.last['rows'] = rows
+
+    @staticmethod
+    def load(filename):
+        """
+        Returns the statistics saved in filename, a dict by fingerprint
+        of dicts: count, seconds (total), max, rows (total), callers
+        ({caller: count}) and plan (the last captured)
+        """
+        if not exists(filename):
+            return {}
+        fileobj = open(filename, 'r')
+        try:
+            data = fileobj.read()
+        finally:
+            fileobj.close()
+        return SlowQueryLog.loads(data)
+
+    @staticmethod
+    def loads(data):
+        if not data:
+            return {}
+        if have_serializers:
+            return serializers.loads_json(data)
+        return simplejson.loads(data)
+
+    def aggregate(self, stats=None):
+        """ adds the queries to stats, see load(), and returns them """
+        stats = stats if stats is not None else {}
+        for query in self.queries:
+            item = stats.setdefault(query['fingerprint'], dict(
+                    count=0, seconds=0.0, max=0.0, rows=0, callers={},
+                    plan=None))
+            item['count'] += 1
+            item['seconds'] += query['seconds']
+            item['max'] = max(item['max'], query['seconds'])
+            item['rows'] += max(query['rows'], 0)
+            caller = query['caller'] or query['frame']
+            item['callers'][caller] = item['callers'].get(caller, 0) + 1
+            if query['plan']:
+                item['plan'] = query['plan']
+        return stats
+
+    def save(self):
+        """ adds the queries to the statistics of filename """
+        if have_portalocker:
+            fileobj = portalocker.LockedFile(self.filename, 'a+')
+            raw = fileobj.file
+        else:
+            fileobj = raw = open(self.filename, 'a+')
+        try:
+            raw.seek(0)
+            stats = self.aggregate(self.loads(raw.read()))
+            raw.seek(0)
+            raw.truncate()
+            if have_serializers:
+                raw.write(serializers.json(stats))
+            else:
+                raw.write(simplejson.dumps(stats))
+        finally:
+            fileobj.close()
+
+    def close(self):
+        for query in self.queries:
+            LOGGER.warning('slow query %.1fms, %s rows, %s at %s: %s%s' % (
+                    query['seconds'] * 1000, query['rows'],
+                    query['caller'] or '-', query['frame'],
+                    query['fingerprint'],
+                    ''.join('\n    %s' % x for x in query['plan'] or [])))
+        if self.dropped:
+            LOGGER.warning('%i slow queries, %.1fms, not logged, '
+                           'maximum %i' % (self.dropped,
+                                           self.dropped_seconds * 1000,
+                                           self.MAX_QUERIES))
+        if self.queries and self.filename:
+            try:
+                self.save()
+            except (IOError, OSError), e:
+                LOGGER.error('slow query log %s: %s' % (self.filename, e))
+        self.queries = []
+        self.dropped = 0
+        self.dropped_seconds = 0.0
+        self.last = None
+
+
 ###################################################################################
 # this is a generic adapter that does nothing; all others are derived from this one
 ###################################################################################
@@ -1049,11 +1307,19 @@ class BaseAdapter(ConnectionPool):
             table._dbt = pjoin(
                 dbpath, '%s_%s.table' % (table._db._uri_hash, tablename))
 
+        if table._dbt:
+            table._dbi = re.sub('\.table$', '', table._dbt) + '.index'
+        else:
+            table._dbi = None
+
         if not table._dbt or not self.file_exists(table._dbt):
+            index_queries = [self._create_index(table, name, fieldnames)
+                             for name, fieldnames
+                             in sorted(table._indexes.items())]
             if table._dbt:
                 self.log('timestamp: %s\n%s\n'
                          % (datetime.datetime.today().isoformat(),
-                            query), table)
+                            '\n'.join([query] + index_queries)), table)
             if not fake_migrate:
                 self.create_sequence_and_triggers(query,table)
                 table._db.commit()
@@ -1062,10 +1328,14 @@ class BaseAdapter(ConnectionPool):
                 for query in postcreation_fields:
                     self.execute(query)
                     table._db.commit()
+                for index_query in index_queries:
+                    self.execute(index_query)
+                table._db.commit()
             if table._dbt:
                 tfile = self.file_open(table._dbt, 'w')
                 pickle.dump(sql_fields, tfile)
                 self.file_close(tfile)
+                self.save_dbi(table, table._indexes)
                 if fake_migrate:
                     self.log('faked!\n', table)
                 else:
@@ -1078,6 +1348,16 @@ class BaseAdapter(ConnectionPool):
                 self.file_close(tfile)
                 raise RuntimeError('File %s appears corrupted' % table._dbt)
             self.file_close(tfile)
+            indexes_old = self.load_dbi(table)
+            indexes = table._indexes
+            # indexes are dropped before and created after the fields
+            # are migrated since they may use fields added or dropped.
+            self.migrate_indexes(
+                table,
+                [self._drop_index(table, name)
+                 for name in sorted(indexes_old)
+                 if indexes.get(name) != indexes_old[name]],
+                fake_migrate=fake_migrate)
             if sql_fields != sql_fields_old:
                 self.migrate_table(
                     table,
@@ -1085,6 +1365,14 @@ class BaseAdapter(ConnectionPool):
                     sql_fields_aux, None,
                     fake_migrate=fake_migrate
                     )
+            self.migrate_indexes(
+                table,
+                [self._create_index(table, name, indexes[name])
+                 for name in sorted(indexes)
+                 if indexes_old.get(name) != indexes[name]],
+                fake_migrate=fake_migrate)
+            if indexes != indexes_old:
+                self.save_dbi(table, indexes)
         return query
 
     def migrate_table(
@@ -1215,6 +1503,83 @@ class BaseAdapter(ConnectionPool):
         pickle.dump(sql_fields_current, tfile)
         self.file_close(tfile)
 
+    def load_dbi(self, table):
+        """
+        Returns the indexes of the table as last migrated,
+        {index name: [field names]}. Tables migrated before indexes
+        were declared have none.
+        """
+        if not table._dbi or not self.file_exists(table._dbi):
+            return {}
+        tfile = self.file_open(table._dbi, 'r')
+        try:
+            return pickle.load(tfile)
+        except EOFError:
+            raise RuntimeError('File %s appears corrupted' % table._dbi)
+        finally:
+            self.file_close(tfile)
+
+    def save_dbi(self, table, indexes):
+        tfile = self.file_open(table._dbi, 'w')
+        pickle.dump(indexes, tfile)
+        self.file_close(tfile)
+
+    def migrate_indexes(self, table, queries, fake_migrate=False):
+        """
+        Executes the CREATE INDEX and DROP INDEX queries of a migration
+        """
+        if not queries:
+            return
+        db = table._db
+        self.log('timestamp: %s\n'
+                 % datetime.datetime.today().isoformat(), table)
+        db['_lastsql'] = '\n'.join(queries)
+        for query in queries:
+            self.log(query + '\n', table)
+            if not fake_migrate:
+                self.execute(query)
+        if fake_migrate:
+            self.log('faked!\n', table)
+        else:
+            db.commit()
+            self.log('success!\n', table)
+
+    def _create_index(self, table, name, fieldnames):
+        table_rname = table._rname or table._tablename
+        fields = ', '.join(table[f]._rname or f for f in fieldnames)
+        return 'CREATE INDEX %s ON %s (%s);' % (name, table_rname, fields)
+
+    def _drop_index(self, table, name):
+        return 'DROP INDEX %s;' % name
+
+    def full_scans(self, sql):
+        """
+        Returns the names of the tables the query plan of a SELECT
+        reads with a full table scan, or None if the adapter cannot tell.
+
+        Example::
+
+            db._adapter.full_scans(db(db.person.name=='Max')._select())
+        """
+        return None
+
+    def explain(self, sql):
+        """
+        Returns the query plan of a statement as a list of strings, or
+        None if the adapter cannot tell. The plan is read with a cursor
+        of its own so the results of the current one are kept.
+        """
+        return None
+
+    def _explain(self, command):
+        """ returns the column names and rows of an EXPLAIN command """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(command)
+            return [x[0] for x in cursor.description], cursor.fetchall()
+        finally:
+            cursor.close()
+
     def LOWER(self, first):
         return 'LOWER(%s)' % self.expand(first)
 
@@ -1285,6 +1650,8 @@ class BaseAdapter(ConnectionPool):
         db._remove_references_to(table)
         if table._dbt:
             self.file_delete(table._dbt)
+            if table._dbi and self.file_exists(table._dbi):
+                self.file_delete(table._dbi)
             self.log('success!\n', table)
 
     def _insert(self, table, fields):
@@ -1795,6 +2162,10 @@ class BaseAdapter(ConnectionPool):
         if not cache:
             self.execute(sql)
             rows = self._fetchall()
+            if self.db._recorder is not None:
+                self.db._recorder.set_rows(len(rows))
+            if self.db._slow_log is not None:
+                self.db._slow_log.set_rows(len(rows))
         else:
             (cache_model, time_expire) = cache
             key = self.uri + '/' + sql + '/rows'
@@ -1908,8 +2279,13 @@ class BaseAdapter(ConnectionPool):
         self.db._lastsql = command
         t0 = time.time()
         ret = self.cursor.execute(command, *a[1:], **b)
-        self.db._timings.append((command,time.time()-t0))
+        t1 = time.time()-t0
+        self.db._timings.append((command,t1))
         del self.db._timings[:-TIMINGSSIZE]
+        if self.db._recorder is not None:
+            self.db._recorder.record(command, t1, self.cursor.rowcount)
+        if self.db._slow_log is not None:
+            self.db._slow_log.record(self, command, t1, self.cursor.rowcount)
         return ret
 
     def execute(self, *a, **b):
@@ -2292,10 +2668,35 @@ class BaseAdapter(ConnectionPool):
 ###################################################################################
 
 class SQLiteAdapter(BaseAdapter):
+    """
+    adapter_args, all optional:
+
+        journal_mode: eg 'WAL', readers are not blocked by the writer
+        busy_timeout: milliseconds a statement waits for a locked database
+        synchronous: eg 'NORMAL', enough with WAL
+        cache_size: pages, or kibibytes if negative
+        readers: number of read-only connections kept in a pool. If set,
+            select() and count() run on a read-only connection unless the
+            connection of the DAL, the writer, has a transaction open.
+
+    Example::
+
+        db = DAL('sqlite://storage.sqlite', pool_size=1,
+                 adapter_args=dict(journal_mode='WAL', busy_timeout=5000,
+                                   synchronous='NORMAL', readers=4))
+
+    pool_size is at most 1 with sqlite, ie one writer connection.
+    """
     drivers = ('sqlite2','sqlite3')
 
     can_select_for_update = None    # support ourselves with BEGIN TRANSACTION
 
+    check_active_connection = False     # not closed by a server
+    READERS = {}        # {dbpath: [read-only connection, ...]}
+    readers = 0
+    reading = False     # True while a select runs on a read-only connection
+    writing = False     # True while the writer has a transaction open
+
     def EXTRACT(self,field,what):
         return "web2py_extract('%s',%s)" % (what, self.expand(field))
 
@@ -2330,7 +2731,6 @@ class SQLiteAdapter(BaseAdapter):
         self.uri = uri
         self.adapter_args = adapter_args
         if do_connect: self.find_driver(adapter_args)
-        self.pool_size = 0
         self.folder = folder
         self.db_codec = db_codec
         self._after_connection = after_connection
@@ -2339,6 +2739,7 @@ class SQLiteAdapter(BaseAdapter):
             or locale.getdefaultlocale()[1] or 'utf8'
         if uri.startswith('sqlite:memory'):
             self.dbpath = ':memory:'
+            self.pool_size = 0
         else:
             self.dbpath = uri.split('://',1)[1]
             if self.dbpath[0] != '/':
@@ -2347,6 +2748,9 @@ class SQLiteAdapter(BaseAdapter):
                         self.folder.decode(path_encoding).encode('utf8'), self.dbpath)
                 else:
                     self.dbpath = pjoin(self.folder, self.dbpath)
+            # connections are returned to the pool committed
+            self.pool_size = min(pool_size, 1)
+            self.readers = adapter_args.get('readers', 0)
         if not 'check_same_thread' in driver_args:
             driver_args['check_same_thread'] = False
         if not 'detect_types' in driver_args and do_connect:
@@ -2357,19 +2761,120 @@ class SQLiteAdapter(BaseAdapter):
         if do_connect: self.reconnect()
 
     def after_connection(self):
-        self.connection.create_function('web2py_extract', 2,
-                                        SQLiteAdapter.web2py_extract)
-        self.connection.create_function("REGEXP", 2,
-                                        SQLiteAdapter.web2py_regexp)
-
+        self.set_pragmas(self.connection)
         if self.adapter_args.get('foreign_keys',True):
             self.execute('PRAGMA foreign_keys=ON;')
+        journal_mode = self.adapter_args.get('journal_mode')
+        if journal_mode:
+            # the pending result would keep the statement active
+            self.execute('PRAGMA journal_mode=%s;' % journal_mode)
+            self.cursor.fetchall()
+
+    def set_pragmas(self, connection):
+        """
+        Sets the functions and the per connection pragmas of adapter_args
+        """
+        connection.create_function('web2py_extract', 2,
+                                   SQLiteAdapter.web2py_extract)
+        connection.create_function("REGEXP", 2,
+                                   SQLiteAdapter.web2py_regexp)
+        for pragma in ('busy_timeout', 'synchronous', 'cache_size'):
+            value = self.adapter_args.get(pragma)
+            if value is not None:
+                connection.execute(
+                    'PRAGMA %s=%s;' % (pragma, value)).fetchall()
+
+    def pool_key(self):
+        # relative paths of different folders have the same uri
+        return self.dbpath
+
+    def reader(self):
+        """
+        Returns a read-only connection from the pool, or a new one
+        """
+        GLOBAL_LOCKER.acquire()
+        try:
+            pool = SQLiteAdapter.READERS.setdefault(self.dbpath, [])
+            if pool:
+                return pool.pop()
+        finally:
+            GLOBAL_LOCKER.release()
+        connection = self.connector()
+        self.set_pragmas(connection)
+        connection.execute('PRAGMA query_only=ON;')
+        return connection
+
+    def release_reader(self, connection):
+        GLOBAL_LOCKER.acquire()
+        try:
+            pool = SQLiteAdapter.READERS.setdefault(self.dbpath, [])
+            if len(pool) < self.readers:
+                pool.append(connection)
+                connection = None
+        finally:
+            GLOBAL_LOCKER.release()
+        if connection:
+            connection.close()
+
+    def read(self, f, *a):
+        """
+        Calls f(*a) with a read-only connection in place of the writer
+        """
+        if not self.readers or self.writing or self.reading:
+            return f(*a)
+        writer = (self.connection, self.cursor)
+        connection = self.reader()
+        self.connection, self.cursor = connection, connection.cursor()
+        self.reading = True
+        try:
+            return f(*a)
+        finally:
+            self.reading = False
+            self.connection, self.cursor = writer
+            self.release_reader(connection)
+
+    def execute(self, *a, **b):
+        if not self.reading and REGEX_SQLITE_WRITE.match(a[0]):
+            self.writing = True
+        return self.log_execute(*a, **b)
+
+    def commit(self):
+        self.writing = False
+        return BaseAdapter.commit(self)
+
+    def rollback(self):
+        self.writing = False
+        return BaseAdapter.rollback(self)
+
+    def count(self, query, distinct=None):
+        return self.read(BaseAdapter.count, self, query, distinct)
 
     def _truncate(self, table, mode=''):
         tablename = table._tablename
         return ['DELETE FROM %s;' % tablename,
                 "DELETE FROM sqlite_sequence WHERE name='%s';" % tablename]
 
+    def _create_index(self, table, name, fieldnames):
+        # indexes created by hand before they were declared are adopted
+        query = BaseAdapter._create_index(self, table, name, fieldnames)
+        return query.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1)
+
+    def _drop_index(self, table, name):
+        return 'DROP INDEX IF EXISTS %s;' % name
+
+    def full_scans(self, sql):
+        tables = []
+        for line in self.explain(sql):
+            # eg SCAN TABLE person, or SCAN person in sqlite >= 3.36
+            match = REGEX_SQLITE_SCAN.match(line)
+            if match and not 'USING' in line:
+                tables.append(match.group('table'))
+        return tables
+
+    def explain(self, sql):
+        names, rows = self._explain('EXPLAIN QUERY PLAN %s' % sql.rstrip(';'))
+        return [row[-1] for row in rows]
+
     def lastrowid(self, table):
         return self.cursor.lastrowid
 
@@ -2385,7 +2890,8 @@ class SQLiteAdapter(BaseAdapter):
         """
         if attributes.get('for_update', False) and not 'cache' in attributes:
             self.execute('BEGIN IMMEDIATE TRANSACTION;')
-        return super(SQLiteAdapter, self).select(query, fields, attributes)
+        return self.read(super(SQLiteAdapter, self).select,
+                         query, fields, attributes)
 
 class SpatiaLiteAdapter(SQLiteAdapter):
     drivers = ('sqlite3','sqlite2')
@@ -2571,6 +3077,19 @@ class MySQLAdapter(BaseAdapter):
     def varquote(self,name):
         return varquote_aux(name,'`%s`')
 
+    def _drop_index(self, table, name):
+        return 'DROP INDEX %s ON %s;' % (name, table._rname or table._tablename)
+
+    def full_scans(self, sql):
+        names, rows = self._explain('EXPLAIN %s' % sql.rstrip(';'))
+        return [row[names.index('table')] for row in rows
+                if row[names.index('type')] == 'ALL']
+
+    def explain(self, sql):
+        names, rows = self._explain('EXPLAIN %s' % sql.rstrip(';'))
+        return [', '.join('%s=%s' % x for x in zip(names, row))
+                for row in rows]
+
     def RANDOM(self):
         return 'RAND()'
 
@@ -2715,6 +3234,15 @@ class PostgreSQLAdapter(BaseAdapter):
     def sequence_name(self,table):
         return '%s_id_seq' % table
 
+    def full_scans(self, sql):
+        return [match.group('table') for match in
+                [REGEX_POSTGRES_SCAN.search(line)
+                 for line in self.explain(sql)] if match]
+
+    def explain(self, sql):
+        names, rows = self._explain('EXPLAIN %s' % sql.rstrip(';'))
+        return [row[0] for row in rows]
+
     def RANDOM(self):
         return 'RANDOM()'
 
@@ -3259,6 +3787,9 @@ class MSSQLAdapter(BaseAdapter):
     def varquote(self,name):
         return varquote_aux(name,'[%s]')
 
+    def _drop_index(self, table, name):
+        return 'DROP INDEX %s ON %s;' % (name, table._rname or table._tablename)
+
     def EXTRACT(self,field,what):
         return "DATEPART(%s,%s)" % (what, self.expand(field))
 
@@ -7721,6 +8252,8 @@ class DAL(object):
         self._db_codec = db_codec
         self._lastsql = ''
         self._timings = []
+        self._recorder = None
+        self._slow_log = None
         self._pending_references = {}
         self._request_tenant = 'request_tenant'
         self._common_fields = []
@@ -7834,6 +8367,45 @@ class DAL(object):
                 finally:
                     self._adapter.file_close(tfile)
 
+    def record_queries(self, on_close=None):
+        """
+        Records the statements executed from now on: sql, timing, rows
+        and calling frame. on_close(recorder) is called when the
+        connection is closed, eg at the end of a request.
+
+        Example::
+
+            recorder = db.record_queries()
+            rows = db(db.person).select()
+            print recorder.summary()
+
+        Returns the QueryRecorder.
+        """
+        self._recorder = QueryRecorder(on_close=on_close)
+        return self._recorder
+
+    def log_slow_queries(self, threshold=0.5, explain=False, filename=None,
+                         caller=None):
+        """
+        Logs the statements which take threshold seconds or more from now
+        on, with their values replaced by ?. The plan of slow SELECTs is
+        captured if explain is True. When the connection is closed the
+        queries are logged (web2py.dal, warning) and their statistics are
+        added to filename, if set. caller is logged with each query, eg
+        the controller/function of the request.
+
+        Example::
+
+            db.log_slow_queries(0.2, explain=True, filename='slow.json')
+            ...
+            stats = SlowQueryLog.load('slow.json')
+
+        Returns the SlowQueryLog.
+        """
+        self._slow_log = SlowQueryLog(threshold=threshold, explain=explain,
+                                      filename=filename, caller=caller)
+        return self._slow_log
+
     def check_reserved_keyword(self, name):
         """
         Validates ``name`` against SQL keywords
@@ -8177,7 +8749,7 @@ def index():
             finally:
                 GLOBAL_LOCKER.release()
         else:
-            table._dbt = None
+            table._dbt = table._dbi = None
         on_define = args_get('on_define',None)
         if on_define: on_define(table)
         return table
@@ -8689,6 +9261,23 @@ class Table(object):
         for field in virtual_fields:
             self[field.name] = field
 
+        # indexes created and dropped by migrations
+        self._indexes = {}
+        for field in fields:
+            if field.index:
+                name = '%s_%s_idx' % (tablename, field.name)
+                self._indexes[name] = [field.name]
+        for name, index_fields in (args.get('indexes') or {}).iteritems():
+            if isinstance(index_fields, (str, Field)):
+                index_fields = [index_fields]
+            fieldnames = [getattr(f, 'name', f) for f in index_fields]
+            for k in fieldnames:
+                if k not in self.fields:
+                    raise SyntaxError(
+                        "index %s: no field %s in table %s" \
+                            % (name, k, tablename))
+            self._indexes[name] = fieldnames
+
     @property
     def fields(self):
         return self._fields
@@ -9667,7 +10256,7 @@ class Field(Expression):
 
         a = Field(name, 'string', length=32, default=None, required=False,
             requires=IS_NOT_EMPTY(), ondelete='CASCADE',
-            notnull=False, unique=False,
+            notnull=False, unique=False, index=False,
             uploadfield=True, widget=None, label=None, comment=None,
             uploadfield=True, # True means store on disk,
                               # 'a_field_name' means store in this field in db
@@ -9723,7 +10312,8 @@ class Field(Expression):
         filter_out = None,
         custom_qualifier = None,
         map_none = None,
-        rname = None
+        rname = None,
+        index = False
         ):
         self._db = self.db = None # both for backward compatibility
         self.op = None
@@ -9771,6 +10361,7 @@ class Field(Expression):
         self.requires = requires if requires!=None else []
         self.map_none = map_none
         self._rname = rname
+        self.index = index
 
     def set_attributes(self,*args,**attributes):
         self.__dict__.update(*args,**attributes)
@@ -9944,7 +10535,7 @@ class Field(Expression):
         'custom_qualifier', 'unique', 'writable', 'compute',
         'map_none', 'default', 'type', 'required', 'readable',
         'requires', 'comment', 'label', 'length', 'notnull',
-        'custom_retrieve_file_properties', 'filter_in')
+        'custom_retrieve_file_properties', 'filter_in', 'index')
         serializable = (int, long, basestring, float, tuple,
                         bool, type(None))
 
@@ -15,7 +15,8 @@ Contains the classes for the global used variables:
 """
 
 from gluon.storage import Storage, List
-from gluon.streamer import streamer, stream_file_or_304_or_206, DEFAULT_CHUNK_SIZE
+from gluon.streamer import streamer, stream_file_or_304_or_206, \
+    FileSender, DEFAULT_CHUNK_SIZE
 from gluon.xmlrpc import handler
 from gluon.contenttype import contenttype
 from gluon.html import xmlescape, TABLE, TR, PRE, URL
@@ -553,6 +554,8 @@ class Response(Storage):
 
         if request and env.web2py_use_wsgi_file_wrapper:
             wrapped = env.wsgi_file_wrapper(stream, chunk_size)
+        elif hasattr(stream, 'fileno'):
+            wrapped = FileSender(stream, chunk_size=chunk_size)
         else:
             wrapped = streamer(stream, chunk_size=chunk_size)
         return wrapped
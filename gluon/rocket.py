@@ -1593,6 +1593,13 @@ import sys
 import socket
 from wsgiref.headers import Headers
 from wsgiref.util import FileWrapper
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
 
 # Import Package Modules
 # package imports removed in monolithic build
@@ -1778,6 +1785,48 @@ class WSGIWorker(Worker):
                 # resulting in a socket error.
                 self.closeConnection = True
 
+    def can_sendfile(self, output):
+        """ Return True if the output is a file that can be transmitted
+        with sendfile(). """
+        return sendfile is not None \
+            and hasattr(output, 'sendfile_range') \
+            and not self.error[0] \
+            and 'Content-Length' in self.header_set \
+            and self.environ.get('wsgi.url_scheme') != 'https'
+
+    def write_file(self, output):
+        """ Write the headers then copy the file to the output socket with
+        sendfile() so the body never passes through python buffers. """
+        (fileno, offset, count) = output.sendfile_range()
+        self.send_headers('', None)
+
+        if self.request_method == 'HEAD':
+            return
+
+        sock = self.conn.fileno()
+        timeout = self.conn.socket.gettimeout()
+        try:
+            while count > 0:
+                try:
+                    sent = sendfile(sock, fileno, offset, count)
+                except (OSError, IOError):
+                    err = sys.exc_info()[1]
+                    if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    # The socket is non-blocking when it has a timeout.
+                    if not select.select([], [sock], [], timeout)[1]:
+                        raise socket.timeout('timed out')
+                    continue
+                if not sent:
+                    break
+                offset += sent
+                count -= sent
+        except socket.timeout:
+            self.closeConnection = True
+        except (socket.error, OSError, IOError):
+            # Clients may close the connection before the file is sent.
+            self.closeConnection = True
+
     def start_response(self, status, response_headers, exc_info=None):
         """ Store the HTTP status and headers to be sent when self.write is
         called. """
@@ -1845,10 +1894,13 @@ class WSGIWorker(Worker):
             if hasattr(output, '__len__'):
                 sections = len(output)
 
-            for data in output:
-                # Don't send headers until body appears
-                if data:
-                    self.write(data, sections)
+            if self.can_sendfile(output):
+                self.write_file(output)
+            else:
+                for data in output:
+                    # Don't send headers until body appears
+                    if data:
+                        self.write(data, sections)
 
             if self.chunked:
                 # If chunked, send our final chunk length
@@ -40,6 +40,37 @@ def streamer(stream, chunk_size=DEFAULT_CHUNK_SIZE, bytes=None):
     stream.close()
 
 
+class FileSender(object):
+    """
+    Iterable over an open file that also exposes the file descriptor, offset
+    and byte count so a server (rocket) can transmit it with sendfile()
+    instead of reading it into python buffers. Servers that do not know
+    about it iterate over the chunks as with streamer().
+    """
+
+    def __init__(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, bytes=None):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.bytes = bytes
+
+    def __iter__(self):
+        return streamer(self.stream, chunk_size=self.chunk_size,
+                        bytes=self.bytes)
+
+    def sendfile_range(self):
+        """Returns (fileno, offset, count) of the bytes to send"""
+        fileno = self.stream.fileno()
+        offset = self.stream.tell()
+        if self.bytes is None:
+            count = os.fstat(fileno)[stat.ST_SIZE] - offset
+        else:
+            count = self.bytes
+        return (fileno, offset, count)
+
+    def close(self):
+        self.stream.close()
+
+
 def stream_file_or_304_or_206(
     static_file,
     chunk_size=DEFAULT_CHUNK_SIZE,
@@ -118,5 +149,5 @@ def stream_file_or_304_or_206(
     if request and request.env.web2py_use_wsgi_file_wrapper:
         wrapped = request.env.wsgi_file_wrapper(stream, chunk_size)
     else:
-        wrapped = streamer(stream, chunk_size=chunk_size, bytes=bytes)
+        wrapped = FileSender(stream, chunk_size=chunk_size, bytes=bytes)
     raise HTTP(status, wrapped, **headers)
@@ -12,6 +12,7 @@ from test_validators import *
 from test_utils import *
 from test_contribs import *
 from test_web import *
+from test_rocket import *
 
 import sys
 if sys.version[:3] == '2.7':
@@ -7,6 +7,8 @@
 import sys
 import os
 import glob
+import shutil
+import tempfile
 
 import unittest
 import datetime
@@ -43,7 +45,8 @@ def fix_sys_path():
 
 fix_sys_path()
 
-from dal import DAL, Field, Table, SQLALL
+from dal import DAL, Field, Table, SQLALL, ConnectionPool, SQLiteAdapter, \
+    SlowQueryLog, sql_shape
 
 #for travis-ci
 DEFAULT_URI = os.environ.get('DB', 'sqlite:memory')
@@ -557,6 +560,236 @@ class TestMigrations(unittest.TestCase):
         if os.path.exists('.storage.table'):
             os.unlink('.storage.table')
 
+class TestIndexes(unittest.TestCase):
+
+    def testRun(self):
+        db = DAL(DEFAULT_URI, check_reserved=['all'])
+        db.define_table('tt', Field('aa', index=True), Field('bb'),
+                        Field('cc'), indexes={'tt_bb_cc': ['bb', 'cc']})
+        self.assertEqual(db.tt._indexes,
+                         {'tt_aa_idx': ['aa'], 'tt_bb_cc': ['bb', 'cc']})
+        self.assertRaises(SyntaxError, db.define_table, 'tu', Field('aa'),
+                          indexes={'tu_bb': ['bb']})
+        if db._adapter.dbengine == 'sqlite':
+            rows = db.executesql("SELECT name FROM sqlite_master "
+                                 "WHERE type='index' AND tbl_name='tt';")
+            self.assertEqual(sorted(r[0] for r in rows),
+                             ['tt_aa_idx', 'tt_bb_cc'])
+            self.assertEqual(
+                db._adapter.full_scans(db(db.tt.aa == 'x')._select()), [])
+            self.assertEqual(
+                db._adapter.full_scans(db(db.tt.cc == 'x')._select()),
+                ['tt'])
+        db.tt.drop()
+        db.commit()
+        db.close()
+
+    def testMigrations(self):
+        if not DEFAULT_URI.startswith('sqlite'):
+            return
+        def indexes(db):
+            rows = db.executesql("SELECT name FROM sqlite_master "
+                                 "WHERE type='index' AND tbl_name='tt';")
+            return sorted(r[0] for r in rows)
+        db = DAL('sqlite://storage.db', folder=self.folder)
+        db.define_table('tt', Field('aa', index=True), Field('bb'))
+        self.assertEqual(indexes(db), ['tt_aa_idx'])
+        self.assertTrue(os.path.exists(db.tt._dbi))
+        db.close()
+        db = DAL('sqlite://storage.db', folder=self.folder)
+        db.define_table('tt', Field('aa'), Field('bb'), Field('cc'),
+                        indexes={'tt_bb_cc': ['bb', 'cc']})
+        self.assertEqual(indexes(db), ['tt_bb_cc'])
+        db.close()
+        db = DAL('sqlite://storage.db', folder=self.folder)
+        db.define_table('tt', Field('aa'), Field('bb'), Field('cc'),
+                        indexes={'tt_bb_cc': ['bb', 'cc']})
+        self.assertEqual(indexes(db), ['tt_bb_cc'])
+        dbi = db.tt._dbi
+        db.tt.drop()
+        self.assertFalse(os.path.exists(dbi))
+        db.close()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+class TestSQLiteReaders(unittest.TestCase):
+
+    def testRun(self):
+        if not DEFAULT_URI.startswith('sqlite'):
+            return
+        adapter_args = dict(journal_mode='WAL', busy_timeout=2000,
+                            synchronous='NORMAL', cache_size=-4000,
+                            readers=2)
+        db = DAL('sqlite://storage.db', folder=self.folder, pool_size=1,
+                 adapter_args=adapter_args)
+        self.assertEqual(db.executesql('PRAGMA journal_mode;')[0][0], 'wal')
+        self.assertEqual(db.executesql('PRAGMA busy_timeout;')[0][0], 2000)
+        self.assertEqual(db.executesql('PRAGMA synchronous;')[0][0], 1)
+        db.define_table('tt', Field('aa'))
+        db.commit()
+        readers = db._adapter.READERS
+        dbpath = db._adapter.dbpath
+        # uncommitted writes are read by the writer
+        db.tt.insert(aa='x')
+        self.assertEqual(db(db.tt).count(), 1)
+        self.assertEqual(readers.get(dbpath, []), [])
+        db.commit()
+        # select and count are routed to a read-only connection
+        self.assertEqual(db(db.tt).select().first().aa, 'x')
+        self.assertEqual(db(db.tt).count(), 1)
+        self.assertEqual(len(readers[dbpath]), 1)
+        reader = readers[dbpath][0]
+        self.assertEqual(
+            reader.execute('PRAGMA busy_timeout;').fetchone()[0], 2000)
+        self.assertRaises(Exception, reader.execute,
+                          "INSERT INTO tt (aa) VALUES ('y');")
+        # the writer is pooled, at most one connection
+        db.close()
+        self.assertEqual(len(ConnectionPool.POOLS[dbpath]), 1)
+        db = DAL('sqlite://storage.db', folder=self.folder, pool_size=5,
+                 adapter_args=adapter_args)
+        self.assertEqual(db._adapter.pool_size, 1)
+        db.close()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        dbpath = os.path.join(self.folder, 'storage.db')
+        for pool in (SQLiteAdapter.READERS, ConnectionPool.POOLS):
+            for connection in pool.pop(dbpath, []):
+                connection.close()
+        shutil.rmtree(self.folder)
+
+
+class TestQueryRecorder(unittest.TestCase):
+
+    def testRun(self):
+        db = DAL(DEFAULT_URI, check_reserved=['all'])
+        db.define_table('tt', Field('aa'), Field('bb', 'integer'))
+        closed = []
+        recorder = db.record_queries(on_close=closed.append)
+        db.tt.insert(aa='x', bb=1)
+        db.tt.insert(aa='y', bb=2)
+        rows = db(db.tt).select()
+        self.assertEqual(len(recorder), 3)
+        self.assertEqual(recorder.queries[-1]['rows'], 2)
+        self.assertTrue(recorder.queries[-1]['frame'].endswith(' testRun'))
+        self.assertEqual(recorder.repeated(), [])
+        for row in rows:
+            db(db.tt.id == row.id).select()
+        db(db.tt.aa.belongs(['x', 'y'])).select()
+        db(db.tt.aa.belongs(['x'])).select()
+        repeated = recorder.repeated(minimum=2)
+        self.assertEqual(len(repeated), 3)
+        self.assertEqual(len(repeated[0][1]), 2)
+        self.assertEqual(
+            sorted(shape.split(' WHERE ')[-1] for shape, unused in repeated),
+            ['(tt.aa IN (?));', '(tt.id = ?);',
+             'INSERT INTO tt(aa,bb) VALUES (?);'])
+        self.assertTrue('N+1' not in recorder.summary())
+        db(db.tt.id == 1).select()
+        self.assertTrue('N+1 candidate, 3 times' in recorder.summary())
+        recorder.MAX_QUERIES = len(recorder.queries) + 1
+        for i in range(3):
+            db(db.tt).select()
+        self.assertEqual(len(recorder.queries), recorder.MAX_QUERIES)
+        self.assertEqual(len(recorder), recorder.MAX_QUERIES + 2)
+        self.assertEqual(recorder.queries[-1]['rows'], 2)
+        self.assertTrue('2 queries not recorded' in recorder.summary())
+        db.tt.drop()
+        db.close()
+        self.assertEqual(closed, [recorder])
+
+    def testShape(self):
+        self.assertEqual(
+            sql_shape("SELECT tt.id FROM tt WHERE (tt.aa = 'it''s') "
+                      "AND (tt.bb IN (1,2,-3.5)) LIMIT 10 OFFSET 0;"),
+            "SELECT tt.id FROM tt WHERE (tt.aa = ?) "
+            "AND (tt.bb IN (?)) LIMIT ? OFFSET ?;")
+
+
+class TestSlowQueryLog(unittest.TestCase):
+
+    def testRun(self):
+        db = DAL(DEFAULT_URI, check_reserved=['all'])
+        db.define_table('tt', Field('aa'), Field('bb', 'integer'))
+        filename = os.path.join(self.folder, 'slow.json')
+        log = db.log_slow_queries(0, explain=True, filename=filename,
+                                  caller='default/index')
+        db.tt.insert(aa='secret', bb=1)
+        db(db.tt.aa == 'secret').select()
+        self.assertEqual(len(log), 2)
+        query = log.queries[-1]
+        self.assertTrue(query['fingerprint'].endswith(
+                'FROM tt WHERE (tt.aa = ?);'))
+        self.assertEqual(query['rows'], 1)
+        self.assertEqual(query['caller'], 'default/index')
+        self.assertTrue(query['frame'].endswith(' testRun'))
+        if DEFAULT_URI.startswith('sqlite'):
+            self.assertTrue(query['plan'][0].startswith('SCAN'))
+        self.assertEqual(log.queries[0]['plan'], None)
+        db(db.tt.aa == 'other').select()
+        db.close()
+        self.assertEqual(len(log), 0)
+        stats = SlowQueryLog.load(filename)
+        self.assertEqual(len(stats), 2)
+        self.assertFalse('secret' in open(filename).read())
+        select = stats[query['fingerprint']]
+        self.assertEqual(select['count'], 2)
+        self.assertEqual(select['rows'], 1)
+        self.assertEqual(select['callers'], {'default/index': 2})
+        self.assertTrue(select['max'] <= select['seconds'])
+
+        # statistics are added to the file
+        db = DAL(DEFAULT_URI, check_reserved=['all'])
+        db.define_table('tt', Field('aa'), Field('bb', 'integer'))
+        log = db.log_slow_queries(0, filename=filename)
+        db(db.tt.aa == 'x').select()
+        log.threshold = 3600
+        db(db.tt.aa == 'y').select()
+        db.tt.drop()
+        db.close()
+        select = SlowQueryLog.load(filename)[query['fingerprint']]
+        self.assertEqual(select['count'], 3)
+        self.assertEqual(len(select['callers']), 2)
+
+    def testPlan(self):
+        class Adapter(object):
+            def explain(self, sql):
+                return ['Seq Scan on tt  (cost=0.00..25.88 rows=6 width=36)',
+                        "  Filter: (aa = 'secret'::text)"]
+        log = SlowQueryLog(0, explain=True)
+        log.record(Adapter(), "SELECT tt.id FROM tt WHERE (tt.aa = 'secret');",
+                   1.0)
+        self.assertEqual(log.queries[0]['plan'], [
+                'Seq Scan on tt  (cost=0.00..25.88 rows=6 width=36)',
+                '  Filter: (aa = ?::text)'])
+
+    def testMaxQueries(self):
+        log = SlowQueryLog(0)
+        log.MAX_QUERIES = 2
+        for i in range(5):
+            log.record(None, 'SELECT tt.id FROM tt;', 1.0)
+        self.assertEqual(len(log.queries), 2)
+        self.assertEqual(len(log), 5)
+        self.assertEqual(log.dropped_seconds, 3.0)
+        self.assertEqual(log.last, None)
+        log.close()
+        self.assertEqual(len(log), 0)
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
 class TestReference(unittest.TestCase):
 
     def testRun(self):
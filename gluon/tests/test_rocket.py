@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for rocket.py """
+
+import sys
+import os
+import unittest
+
+
+def fix_sys_path():
+    """
+    logic to have always the correct sys.path
+     '', web2py/gluon, web2py/site-packages, web2py/ ...
+    """
+
+    def add_path_first(path):
+        sys.path = [path] + [p for p in sys.path if (
+            not p == path and not p == (path + '/'))]
+
+    path = os.path.dirname(os.path.abspath(__file__))
+
+    if not os.path.isfile(os.path.join(path,'web2py.py')):
+        i = 0
+        while i<10:
+            i += 1
+            if os.path.exists(os.path.join(path,'web2py.py')):
+                break
+            path = os.path.abspath(os.path.join(path, '..'))
+
+    paths = [path,
+             os.path.abspath(os.path.join(path, 'site-packages')),
+             os.path.abspath(os.path.join(path, 'gluon')),
+             '']
+    [add_path_first(path) for path in paths]
+
+fix_sys_path()
+
+
+import socket
+import tempfile
+import threading
+import rocket
+from rocket import Connection, WSGIWorker
+from streamer import FileSender
+from wsgiref.headers import Headers
+
+
+def python_sendfile(out_fd, in_fd, offset, count):
+    """ Stand-in for os.sendfile where it is not available. """
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    return os.write(out_fd, os.read(in_fd, min(count, 65536)))
+
+
+class TestWSGIWorker(unittest.TestCase):
+    """ Tests rocket.WSGIWorker """
+
+    def setUp(self):
+        self.sendfile = rocket.sendfile
+        if rocket.sendfile is None:
+            rocket.sendfile = python_sendfile
+        # Larger than the socket buffers so sendfile() has to wait for the
+        # client on the non-blocking socket.
+        self.data = os.urandom(1024 * 1024)
+        self.tmp = tempfile.TemporaryFile()
+        self.tmp.write(self.data)
+        self.tmp.seek(0)
+        (self.server, self.client) = socket.socketpair()
+
+    def tearDown(self):
+        rocket.sendfile = self.sendfile
+        self.tmp.close()
+        self.server.close()
+        self.client.close()
+
+    def worker(self, method='GET'):
+        worker = WSGIWorker(
+            {'server_software': 'test', 'wsgi_app': lambda e, s: []},
+            None, None)
+        worker.conn = Connection((self.server, ('127.0.0.1', 0)), 80)
+        worker.environ = {'SERVER_PROTOCOL': 'HTTP/1.1'}
+        worker.request_method = method
+        worker.error = (None, None)
+        worker.header_set = Headers(
+            [('Content-Length', str(len(self.data)))])
+        return worker
+
+    def receive(self):
+        """ Read the client end until it is closed. """
+        received = []
+
+        def read():
+            while True:
+                data = self.client.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        return (thread, received)
+
+    def test_write_file(self):
+        worker = self.worker()
+        self.assertTrue(worker.can_sendfile(FileSender(self.tmp)))
+        (thread, received) = self.receive()
+        worker.write_file(FileSender(self.tmp))
+        self.server.shutdown(socket.SHUT_WR)
+        thread.join()
+        (headers, body) = ''.join(received).split('\r\n\r\n', 1)
+        self.assertTrue(headers.startswith('HTTP/1.1 200 OK'))
+        self.assertTrue(
+            'Content-Length: %s' % len(self.data) in headers.split('\r\n'))
+        self.assertEqual(body, self.data)
+        self.assertFalse(worker.closeConnection)
+
+    def test_write_file_head(self):
+        worker = self.worker(method='HEAD')
+        (thread, received) = self.receive()
+        worker.write_file(FileSender(self.tmp))
+        self.server.shutdown(socket.SHUT_WR)
+        thread.join()
+        (headers, body) = ''.join(received).split('\r\n\r\n', 1)
+        self.assertTrue(headers.startswith('HTTP/1.1 200 OK'))
+        self.assertEqual(body, '')
+
+
+if __name__ == '__main__':
+    unittest.main()